@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Replay ACK traces through the bandwidth estimators of PEPesc, with and without
+the ACK aggregation filter, and compare the estimates against the bottleneck bandwidth.
+
+Each trace is a text file whose header lines start with '#', with "# bottleneck: <pkts/sec.>"
+giving the true bandwidth. Every other line is an ACK:
+    <ack time> <number of packets acked> <send time of the newest acked packet>
+
+Usage:
+    python3 replay.py                   # replay all *.dat traces in this directory
+    python3 replay.py trace.dat ...     # replay the given traces
+    python3 replay.py --generate        # regenerate the corpus (deterministic)
+"""
+import os
+import sys
+import glob
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from congestion import AckSample, RttEstimator, JerseyController, BBRController
+
+# an estimate within this relative error of the bottleneck passes,
+# and the filter may not make the worst error larger by more than Regression
+Tolerance  = 0.25
+Regression = 0.01
+
+
+def LoadTrace(path) :
+    bottleneck = None
+    acks = []
+    with open(path) as f :
+        for line in f :
+            if line.startswith('#') :
+                fields = line[1:].split(':')
+                if fields[0].strip() == 'bottleneck' :
+                    bottleneck = float(fields[1])
+                continue
+            if line.strip() :
+                ackTime, numAcked, sendTime = line.split()
+                acks.append((float(ackTime), int(numAcked), float(sendTime)))
+    return bottleneck, acks
+
+
+def Replay(acks, cc, useAggregationFilter) :
+    """ Feed the ACKs to a controller, the same way as pepApp.RecvDataAck does.
+        Return the max. bandwidth estimates (pkts/sec.) after each ACK and the max. extra-acked.
+    """
+    if not useAggregationFilter :
+        cc.m_ackAggregation.IsAggregated = lambda : False
+        cc.m_ackAggregation.ExtraAcked   = lambda bw : 0
+        cc.m_ackAggregation.FilteredBw   = lambda : None
+    rttEstimator = RttEstimator()
+    # packets sent are replayed as send events, to take the delivery-rate state at sending
+    events = sorted([(s, 1, i) for i, (a, n, s) in enumerate(acks)] + [(a, 2, i) for i, (a, n, s) in enumerate(acks)])
+    delivered, lastAckTime, lastAckedSentTime = 0, -1.0, -1.0
+    stateAtSend = {}
+    estimates = []
+    maxExtraAcked = 0.0
+    for t, kind, i in events :
+        ackTime, numAcked, sendTime = acks[i]
+        if kind == 1 :
+            stateAtSend[i] = (delivered, lastAckTime if lastAckTime != -1 else t, lastAckedSentTime if lastAckedSentTime != -1 else t)
+            cc.OnPacketSent(t, 3, i, 0)
+            continue
+        deliveredAsOfSend, deliveredTime, firstSentTime = stateAtSend.pop(i)
+        delivered += numAcked
+        rttEstimator.Update(ackTime, ackTime - sendTime)
+        sample = AckSample(ackTime, numAcked, ackTime - sendTime, rttEstimator.SRtt(), rttEstimator.MinRtt(),
+                           delivered - deliveredAsOfSend, ackTime - deliveredTime, sendTime - firstSentTime,
+                           deliveredAsOfSend, delivered, 0, False, sendTime)
+        lastAckTime, lastAckedSentTime = ackTime, sendTime
+        cc.OnAckReceived(sample)
+        estimates.append((ackTime, cc.m_estBwMax))
+        maxExtraAcked = max(maxExtraAcked, cc.m_ackAggregation.m_extraAcked)
+    return estimates, maxExtraAcked
+
+
+def Generate(directory) :
+    """ Build the corpus: a smooth return link, TDMA frames and DVB-S2 style bunches with jitter,
+        of one ACK every few packets as PEPesc sends them, and of cumulative ACKs
+    """
+    def Write(name, comment, bottleneck, acks) :
+        with open(os.path.join(directory, name), 'w') as f :
+            f.write("# %s\n" % comment)
+            f.write("# bottleneck: %f\n" % bottleneck)
+            for ackTime, numAcked, sendTime in acks :
+                f.write("%.6f %d %.6f\n" % (ackTime, numAcked, sendTime))
+
+    def Link(bottleneck, duration, owd) :
+        # packets sent back to back at the bottleneck rate, (send time, arrival time at receiver)
+        return [(i / bottleneck, i / bottleneck + owd) for i in range(int(duration * bottleneck))]
+
+    bottleneck = 200.0
+    acks = [(arrive + 0.3, 1, send) for send, arrive in Link(bottleneck, 10, 0.3)]
+    Write('smooth-200pps.dat', 'smooth return link, one ACK per packet, 600ms RTT', bottleneck, acks)
+
+    # TDMA return link: ACKs queue up until the terminal's slot in every frame, then leave at 20us spacing
+    for bottleneck, frame, owd in ((200.0, 0.04, 0.3), (400.0, 0.12, 0.3), (400.0, 0.25, 0.3), (1000.0, 0.1, 0.05)) :
+        acks = []
+        slot, n = -1, 0
+        for send, arrive in Link(bottleneck, 10, owd) :
+            nextSlot = (int(arrive / frame) + 1) * frame
+            slot, n = (nextSlot, 0) if nextSlot != slot else (slot, n + 1)
+            acks.append((slot + owd + 0.00002 * n, 1, send))
+        Write('tdma-%dpps-%dms-rtt%dms.dat' % (bottleneck, frame * 1000, owd * 2000),
+              'TDMA return link, ACKs released once per %dms frame, %dms RTT' % (frame * 1000, owd * 2000), bottleneck, acks)
+
+    # DVB-S2 return link: the ACKs queued meanwhile leave together in baseband frames of random fill time,
+    # either one every ackInterval packets (20us apart) or one cumulative ACK per frame
+    bottleneck = 300.0
+    for name, ackInterval, comment in (('dvbs2-300pps-bunched.dat', 4, 'an ACK every 4 packets'),
+                                       ('dvbs2-300pps-cumulative.dat', None, 'cumulative ACKs')) :
+        rng = random.Random(1)
+        acks = []
+        pending = []
+        release = 0.0
+        for send, arrive in Link(bottleneck, 10, 0.3) :
+            while arrive > release :
+                groups = [pending[i : i + ackInterval] for i in range(0, len(pending), ackInterval)] if ackInterval else [pending]
+                for n, group in enumerate(group for group in groups if group) :
+                    acks.append((release + 0.3 + 0.00002 * n, len(group), group[-1]))
+                pending = []
+                release += rng.uniform(0.02, 0.1)
+            pending.append(send)
+        Write(name, 'DVB-S2 return link, %s bunched every 20-100ms' % comment, bottleneck, acks)
+
+
+def Main(argv) :
+    directory = os.path.dirname(os.path.abspath(__file__))
+    if argv and argv[0] == '--generate' :
+        Generate(directory)
+        return 0
+    traces = argv if argv else sorted(glob.glob(os.path.join(directory, '*.dat')))
+    failed = 0
+    for path in traces :
+        bottleneck, acks = LoadTrace(path)
+        print(os.path.basename(path))
+        for cc in (JerseyController, BBRController) :
+            unfiltered = None
+            for useFilter in (False, True) :
+                estimates, maxExtraAcked = Replay(acks, cc(4), useFilter)
+                # skip the first seconds, the estimators are warming up
+                steady = [bw for t, bw in estimates if t - estimates[0][0] > 2]
+                worst = max(abs(bw - bottleneck) / bottleneck for bw in steady)
+                passed = worst <= Tolerance
+                if useFilter :
+                    passed = passed and worst <= unfiltered + Regression
+                    failed += 0 if passed else 1
+                else :
+                    unfiltered = worst
+                print("  %-6s filter: %-5s max-bw: %8.1f (bottleneck %6.1f) worst-error: %6.1f%% extra-acked: %6.1f %s"
+                      % (cc.name, useFilter, steady[-1], bottleneck, worst * 100, maxExtraAcked, 'ok' if passed else 'FAIL'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__' :
+    sys.exit(Main(sys.argv[1:]))
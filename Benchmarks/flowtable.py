@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Benchmark the connection bookkeeping of PEPesc with tens of thousands of concurrent flows.
+
+Two parts:
+  - table: allocate a channel id and a flow record per flow, look every flow up, then close
+    them all, with the free list of channel.py against the former lowest-free-id linear scan
+    (the scan is only run up to --maxScanFlows, it is quadratic);
+  - storm: open the flows as real loopback TCP connections in bursts against a non-blocking
+    listener, and accept them into channels with batched accept() against one accept() per poll.
+    Every poll round walks all open channels as PollChannels() does, so that a round costs
+    what a loop of PEPesc costs.
+    The number of connections is bounded by the open-file limit (two descriptors per connection).
+
+Usage:
+    python3 flowtable.py                        # 10000 and 50000 flows
+    python3 flowtable.py --flows 20000 --burst 2000
+"""
+import os
+import sys
+import time
+import socket
+import select
+import resource
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import channel
+from channel   import Channel, OpenInConnChannel, CloseChannel, FindOneFreeChannel
+from flowtable import FlowTable
+from protocol  import MaxAcceptBatch
+
+
+def Address(i) :
+    # NATed subscriber pool: many sources, few destinations
+    return ('10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), 1024 + i % 60000), ('192.0.2.%d' % (i % 8), 443)
+
+
+def LegacyFindOneFreeChannel(chans) :
+    i = 0
+    while True:
+        if i not in chans.keys():
+            break
+        i += 1
+    return i
+
+
+def BenchTable(numFlows, findFreeChannel) :
+    chans = {}
+    flows = FlowTable()
+    start = time.perf_counter()
+    for i in range(numFlows) :
+        neighbor, remote = Address(i)
+        chid = findFreeChannel(chans)
+        chans[chid] = Channel(None, neighbor, remote)
+        flows.Add(neighbor, remote).chid = chid
+    opened = time.perf_counter()
+    for i in range(numFlows) :
+        neighbor, remote = Address(i)
+        flow = flows.Find(neighbor, remote)
+        flow.sentBufLen += 1
+    found = time.perf_counter()
+    for flow in flows :
+        del chans[flow.chid]
+        channel.freeChids.append(flow.chid)
+        flows.Remove(flow)
+    closed = time.perf_counter()
+    del channel.freeChids[:]
+    channel.nextChid = 0
+    return opened - start, found - opened, closed - found
+
+
+def BenchStorm(numConns, burst, batched) :
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(4096)
+    listener.setblocking(0)
+    poller = select.poll()
+    poller.register(listener.fileno(), select.POLLIN)
+
+    chans = {}
+    flows = FlowTable()
+    clients = []
+    polls = 0
+    acceptTime = 0.0
+    while len(flows) < numConns :
+        # a burst of connection requests, kept within the listen backlog
+        for i in range(min(burst, numConns - len(clients))) :
+            c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            c.setblocking(0)
+            c.connect_ex(listener.getsockname())
+            clients.append(c)
+        pending = len(clients) - len(flows)
+        start = time.perf_counter()
+        while pending > 0 :
+            if not poller.poll(100) :
+                break
+            polls += 1
+            for chid in list(chans) :
+                chans[chid].eventmask = 0
+            for i in range(MaxAcceptBatch if batched else 1) :
+                try :
+                    sock, neighbor = listener.accept()
+                except BlockingIOError :
+                    break
+                remote = sock.getsockname()
+                flows.Add(neighbor, remote).chid = OpenInConnChannel(chans, sock, remote, 0.02)
+                pending -= 1
+        acceptTime += time.perf_counter() - start
+
+    for chid in list(chans) :
+        CloseChannel(chans, chid)
+    for c in clients :
+        c.close()
+    listener.close()
+    del channel.freeChids[:]
+    channel.nextChid = 0
+    return acceptTime, polls
+
+
+def Main(argv) :
+    parser = argparse.ArgumentParser(description="Benchmark PEPesc's flow table")
+    parser.add_argument('--flows', type=int, nargs='+', default=[10000, 50000], help="number of concurrent flows")
+    parser.add_argument('--burst', type=int, default=1000, help="connection requests per burst in the storm")
+    parser.add_argument('--maxScanFlows', type=int, default=10000, help="largest table run with the linear id scan")
+    args = parser.parse_args(argv)
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    maxConns = (hard - 64) // 2
+
+    for numFlows in args.flows :
+        print("%d flows" % numFlows)
+        for name, findFreeChannel in (('free-list', FindOneFreeChannel), ('linear-scan', LegacyFindOneFreeChannel)) :
+            if findFreeChannel is LegacyFindOneFreeChannel and numFlows > args.maxScanFlows :
+                continue
+            opened, found, closed = BenchTable(numFlows, findFreeChannel)
+            print("  table %-11s open: %7.3f s (%5.2f us/flow) find: %5.2f us/flow close: %5.2f us/flow"
+                  % (name, opened, opened / numFlows * 1e6, found / numFlows * 1e6, closed / numFlows * 1e6))
+
+        numConns = min(numFlows, maxConns)
+        if numConns < numFlows :
+            print("  storm limited to %d connections by the open-file limit %d" % (numConns, hard))
+        for batched in (True, False) :
+            acceptTime, polls = BenchStorm(numConns, args.burst, batched)
+            print("  storm %-11s poll+accept+open: %7.3f s (%5.2f us/conn) polls: %d"
+                  % ('batched' if batched else 'one-by-one', acceptTime, acceptTime / numConns * 1e6, polls))
+    return 0
+
+
+if __name__ == '__main__' :
+    sys.exit(Main(sys.argv[1:]))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Benchmark the per-packet overhead of the Python binding of libstreamc.
+
+Source packets are pushed through an encoder, and the serialized packets through a decoder,
+without losses, so that the C library does little more than copy symbols and the time left is
+mostly the binding's:
+  - raw: the ctypes prototypes as PEPesc used them, from_buffer_copy() into the encoder,
+    string_at() out of serialize_packet(), a .contents proxy per field access and
+    bytes(cast(...)[0]) out of the recovered table;
+  - session: the Encoder/Decoder API of pystreamc.py, bytes passed in place, serialized
+    packets and recovered payloads seen through memoryviews.
+The same packets are also sent through a repair-only path, to set the overhead against the
+cost of encoding a repair packet over a window.
+
+Usage:
+    python3 streamc.py                          # 20000 packets
+    python3 streamc.py --packets 50000 --window 64
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ctypes    import sizeof, c_int, c_ubyte, string_at, byref, cast, POINTER
+
+from pystreamc import DEC_ALLOC, StreamcLibraryPath, parameters, streamc, Encoder, Decoder
+from protocol  import PacketSize
+
+
+def Parameters() :
+    cp = parameters()
+    cp.gfpower = 8
+    cp.pktsize = PacketSize
+    cp.repfreq = 0.0
+    cp.seed    = 0
+    return cp
+
+
+def Wire(payloads) :
+    """ The packets as they arrive at the peer
+    """
+    enc = Encoder(Parameters())
+    wire = []
+    for i, payload in enumerate(payloads) :
+        enc.Enqueue(i, payload)
+        packet = enc.OutputSource()
+        wire.append(bytes(packet.View()))
+        packet.Free()
+    enc.Free()
+    return wire
+
+
+def BenchRaw(payloads, wire) :
+    cp = Parameters()
+    enc = streamc.initialize_encoder(byref(cp), None, 0)
+    dec = streamc.initialize_decoder(byref(cp))
+    start = time.perf_counter()
+    for i, payload in enumerate(payloads) :
+        buf = (c_ubyte * cp.pktsize).from_buffer_copy(payload)
+        streamc.enqueue_packet(enc, i, buf)
+        cpkt = streamc.output_source_packet(enc)
+        pktstr = streamc.serialize_packet(enc, cpkt)
+        string_at(pktstr, cp.pktsize + 4 * sizeof(c_int))
+        cpkt.contents.sourceid
+        streamc.free_packet(cpkt)
+        streamc.free_serialized_packet(pktstr)
+        streamc.flush_acked_packets(enc, i)
+        enc.contents.headsid, enc.contents.nextsid
+    encoded = time.perf_counter()
+    for data in wire :
+        rpkt = streamc.deserialize_packet(dec, cast(data, POINTER(c_ubyte)))
+        sourceId = rpkt.contents.sourceid
+        streamc.receive_packet(dec, rpkt)
+        if dec.contents.inorder >= sourceId :
+            bytes(cast(dec.contents.recovered[sourceId % DEC_ALLOC], POINTER(c_ubyte * cp.pktsize))[0])
+    decoded = time.perf_counter()
+    streamc.free_encoder(enc)
+    streamc.free_decoder(dec)
+    return encoded - start, decoded - encoded
+
+
+def BenchSession(payloads, wire) :
+    cp = Parameters()
+    enc = Encoder(cp)
+    dec = Decoder(cp)
+    start = time.perf_counter()
+    for i, payload in enumerate(payloads) :
+        enc.Enqueue(i, payload)
+        packet = enc.OutputSource()
+        packet.View()
+        packet.sourceId
+        packet.Free()
+        enc.Flush(i)
+        enc.headsid, enc.nextsid
+    encoded = time.perf_counter()
+    for data in wire :
+        sourceId = dec.Receive(data)[0]
+        if dec.inorder >= sourceId :
+            dec.Recovered(sourceId)
+    decoded = time.perf_counter()
+    enc.Free()
+    dec.Free()
+    return encoded - start, decoded - encoded
+
+
+def BenchRepair(payloads, window) :
+    cp = Parameters()
+    enc = Encoder(cp)
+    for i, payload in enumerate(payloads[:window]) :
+        enc.Enqueue(i, payload)
+        enc.OutputSource().Free()
+    start = time.perf_counter()
+    for i in range(len(payloads)) :
+        enc.OutputRepair(window).Free()
+    elapsed = time.perf_counter() - start
+    enc.Free()
+    return elapsed
+
+
+def Main(argv) :
+    parser = argparse.ArgumentParser(description="Benchmark the per-packet overhead of PEPesc's streamc binding")
+    parser.add_argument('--packets', type=int, default=20000, help="number of source packets")
+    parser.add_argument('--window', type=int, default=32, help="source packets a repair packet is encoded over")
+    args = parser.parse_args(argv)
+
+    print("libstreamc: %s, %d-byte packets" % (StreamcLibraryPath, PacketSize))
+    payloads = [os.urandom(PacketSize) for i in range(args.packets)]
+    wire = Wire(payloads)
+    for name, bench in (('raw', BenchRaw), ('session', BenchSession)) :
+        encoded, decoded = bench(payloads, wire)
+        print("  %-8s encode: %7.3f s (%5.2f us/packet) decode: %7.3f s (%5.2f us/packet)"
+              % (name, encoded, encoded / args.packets * 1e6, decoded, decoded / args.packets * 1e6))
+    elapsed = BenchRepair(payloads, args.window)
+    print("  repair over %d packets: %7.3f s (%5.2f us/packet)" % (args.window, elapsed, elapsed / args.packets * 1e6))
+    return 0
+
+
+if __name__ == '__main__' :
+    sys.exit(Main(sys.argv[1:]))
@@ -0,0 +1,148 @@
+import math
+
+from protocol import MaxBufferQueueLength, AdmissionMinBacklog, AdmissionMaxBacklog, AdmissionBdpGain, \
+                     DefaultTargetQueueDelay, IngressCodelTarget, IngressCodelInterval, IngressCodelMinQueued
+
+
+class AdmissionController :
+    """ Admission of TCP data into the encoder, sized from the path rather than a fixed number of packets.
+        The unsent backlog is held to what the source packet rate sends within the target queue delay, so
+        that ACK gaps on a fat pipe do not starve it while a thin link does not queue seconds of data in
+        PEPesc; the encoder occupancy (source packets enqueued and not yet acked in order) is held to
+        AdmissionBdpGain BDPs beyond that backlog, and to what the decoder of the peer keeps. Until rate
+        and min RTT are measured, MaxBufferQueueLength packets of backlog are admitted as before.
+        The delay of the backlog at the source packet rate is kept as a metric.
+    """
+    def __init__(self, targetQueueDelay=DefaultTargetQueueDelay) :
+        self.m_target         = targetQueueDelay
+        self.m_backlogLimit   = MaxBufferQueueLength    # source packets enqueued but not sent
+        self.m_occupancyLimit = None                    # source packets enqueued but not acked in order, None if unbounded
+        self.m_backlogDelay   = 0.0     # sec., of the current backlog at the source packet rate
+
+        # time-weighted statistics of the backlog delay
+        self.m_lastTime      = -1.0
+        self.m_duration      = 0.0
+        self.m_sumDelay      = 0.0
+        self.m_maxDelay      = 0.0
+        self.m_overTarget    = 0.0
+
+        # ingress sojourn time of TCP segments, from reading to sending, and pauses of reading by FlowCodel
+        self.m_numSojourns   = 0
+        self.m_sumSojourn    = 0.0
+        self.m_maxSojourn    = 0.0
+        self.m_numPauses     = 0
+
+    def Update(self, currentTime, sourceRate, rttMin, maxOccupancy, backlog) :
+        """ Size the limits from the rate source packets are sent at (pkts/sec., 0 if unknown), the min RTT
+            (sec., 1e6 if unknown) and the source packets the peer decoder keeps, and sample the backlog delay
+        """
+        if sourceRate > 0 :
+            self.m_backlogLimit = min(max(math.ceil(sourceRate * self.m_target), AdmissionMinBacklog), AdmissionMaxBacklog)
+            self.m_backlogDelay = backlog / sourceRate
+        else :
+            self.m_backlogLimit = MaxBufferQueueLength
+            self.m_backlogDelay = 0.0
+        self.m_occupancyLimit = maxOccupancy
+        if sourceRate > 0 and rttMin != 1e6 :
+            bdpLimit = math.ceil(AdmissionBdpGain * sourceRate * rttMin) + self.m_backlogLimit
+            self.m_occupancyLimit = min(bdpLimit, maxOccupancy) if maxOccupancy else bdpLimit
+
+        if self.m_lastTime > 0 :
+            elapsed = currentTime - self.m_lastTime
+            self.m_duration += elapsed
+            self.m_sumDelay += self.m_backlogDelay * elapsed
+            self.m_overTarget += elapsed if self.m_backlogDelay > self.m_target else 0.0
+        self.m_maxDelay = max(self.m_maxDelay, self.m_backlogDelay)
+        self.m_lastTime = currentTime
+
+    def Allowance(self, backlog, occupancy) :
+        """ Source packets that may be enqueued next, given those not sent and those not acked in order
+        """
+        allowance = self.m_backlogLimit - backlog
+        if self.m_occupancyLimit is not None :
+            allowance = min(allowance, self.m_occupancyLimit - occupancy)
+        return max(allowance, 0)
+
+    def OnSojourn(self, sojourn, paused) :
+        self.m_numSojourns += 1
+        self.m_sumSojourn  += sojourn
+        self.m_maxSojourn   = max(self.m_maxSojourn, sojourn)
+        self.m_numPauses   += 1 if paused else 0
+
+    def __str__(self) :
+        duration = max(self.m_duration, 1e-9)
+        return "target: %.1f ms backlogDelay mean/max: %.1f/%.1f ms overTarget: %.1f%% backlogLimit: %d occupancyLimit: %s" \
+            " ingress sojourn mean/max: %.1f/%.1f ms pauses: %d" \
+            % (self.m_target * 1000, self.m_sumDelay / duration * 1000, self.m_maxDelay * 1000, self.m_overTarget / duration * 100,
+               self.m_backlogLimit, self.m_occupancyLimit, self.m_sumSojourn / max(self.m_numSojourns, 1) * 1000,
+               self.m_maxSojourn * 1000, self.m_numPauses)
+
+
+class FlowCodel :
+    """ CoDel (RFC 8289) on the ingress of one TCP flow, fed with the sojourn time of its segments from
+        reading to sending. PEPesc cannot drop what it has acked to the neighbor, so where CoDel drops,
+        reading the socket of the flow is paused instead, until half of its queued segments are sent (or
+        for an interval at most), and TCP flow control slows the sender down. Pauses follow the CoDel control law
+        while the sojourn time stays above target. Sparse flows, with few segments queued, are never paused,
+        so that interactive flows keep reading next to bulk ones.
+    """
+    __slots__ = ('m_target', 'm_interval', 'm_numQueued', 'm_firstAboveTime', 'm_pausing', 'm_count', 'm_lastCount',
+                 'm_pauseNext', 'm_resumeTime', 'm_resumeQueued')
+
+    def __init__(self, target=IngressCodelTarget, interval=IngressCodelInterval) :
+        self.m_target   = target
+        self.m_interval = interval
+        self.m_numQueued      = 0       # segments read and not sent yet
+        self.m_firstAboveTime = 0.0     # when the sojourn time will have been above target for an interval
+        self.m_pausing        = False   # CoDel dropping state
+        self.m_count          = 0       # pauses since entering the pausing state
+        self.m_lastCount      = 0
+        self.m_pauseNext      = 0.0
+        self.m_resumeTime     = 0.0     # reading is paused until then
+        self.m_resumeQueued   = 0       # or until no more segments are queued
+
+    def Readable(self, currentTime) :
+        return currentTime >= self.m_resumeTime
+
+    def OnEnqueue(self) :
+        self.m_numQueued += 1
+
+    def OnDequeue(self, currentTime, sojourn) :
+        """ A segment of the flow is sent after sojourn sec., return whether reading is paused for it
+        """
+        self.m_numQueued = max(self.m_numQueued - 1, 0)
+        if self.m_numQueued <= self.m_resumeQueued :
+            self.m_resumeTime = 0.0
+        okToPause = self.OkToPause(currentTime, sojourn)
+        if self.m_pausing :
+            if not okToPause :
+                self.m_pausing = False
+            elif currentTime >= self.m_pauseNext :
+                self.m_count += 1
+                self.m_pauseNext = self.ControlLaw(self.m_pauseNext)
+                return self.Pause(currentTime)
+        elif okToPause :
+            self.m_pausing = True
+            delta = self.m_count - self.m_lastCount
+            self.m_count = delta if delta > 1 and currentTime - self.m_pauseNext < 16 * self.m_interval else 1
+            self.m_lastCount = self.m_count
+            self.m_pauseNext = self.ControlLaw(currentTime)
+            return self.Pause(currentTime)
+        return False
+
+    def OkToPause(self, currentTime, sojourn) :
+        if sojourn < self.m_target or self.m_numQueued <= IngressCodelMinQueued :
+            self.m_firstAboveTime = 0.0
+            return False
+        if self.m_firstAboveTime == 0.0 :
+            self.m_firstAboveTime = currentTime + self.m_interval
+            return False
+        return currentTime >= self.m_firstAboveTime
+
+    def ControlLaw(self, t) :
+        return t + self.m_interval / math.sqrt(self.m_count)
+
+    def Pause(self, currentTime) :
+        self.m_resumeTime   = currentTime + self.m_interval
+        self.m_resumeQueued = self.m_numQueued // 2
+        return True
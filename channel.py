@@ -5,7 +5,7 @@ import errno
 
 from collections import deque
 from select      import POLLIN, POLLOUT, POLLERR, POLLHUP, POLLNVAL, POLLRDHUP
-from protocol    import MsgDataMaxLength, ScPacketSize, PollChannelMsg
+from protocol    import MsgDataMaxLength, ScPacketSize, PollChannelMsg, TcpRecvChunkSize, TcpRecvPoolSize, TcpSendMaxIov
 
 # Channel log file
 channelLogFlag = False
@@ -26,9 +26,12 @@ CH_READ  = POLLIN
 CH_WRITE = POLLOUT
 CH_ERROR = POLLERR
 
-# Record the last time when all sockets received data without blocking,
-# to control the receiving rate not to exceed the available bandwidth of the link.
-lastDoRecvTimes = {}
+# Channel ids released by closed channels, reused before new ids are taken from nextChid
+freeChids = []
+nextChid  = 0
+
+# Preallocated receive buffers returned by channels for reuse
+recvBufferPool = deque()
 
 # Map channel's socket handle fileno to channel id.
 mapHandleFilenoToChid = {}
@@ -45,18 +48,44 @@ udpChid       = -1
 # poller for polling channels
 poller = select.poll()
 
+# Length of the messages TCP data is sliced into, the symbol size of the data packets PEPesc sends
+msgDataLength = MsgDataMaxLength
+
+def SetMsgDataLength(length) :
+    global msgDataLength
+    msgDataLength = length
+
 class Buffer:
     """ Message buffer
         Each buffer contains the serialized wait-to-send/wait-to-receive ccfd packet
     """
+    __slots__ = ('data', 'length', 'pos', 'chunk', 'time')
+
     def __init__(self, data=None) :
         if not data :
             self.data = bytearray()        # message itself
-            self.length = MsgDataMaxLength # length of message to receive
+            self.length = msgDataLength    # length of message to receive
         else :
             self.data = data
             self.length = len(data)        # length of message to receive
         self.pos = 0                       # Position of read/write
+        self.chunk = None                  # RecvChunk the message is sliced from
+        self.time = 0                      # when the (first bytes of the) message were read from the handle
+
+class RecvChunk :
+    """ A preallocated buffer of TcpRecvChunkSize bytes that TCP data is read into,
+        shared by the message segments sliced from it. It goes back to recvBufferPool
+        once none of its segments is in use.
+    """
+    def __init__(self) :
+        self.data = recvBufferPool.pop() if recvBufferPool else bytearray(TcpRecvChunkSize)
+        self.view = memoryview(self.data)
+        self.refs = 0
+
+    def release(self) :
+        self.refs -= 1
+        if self.refs <= 0 and len(recvBufferPool) < TcpRecvPoolSize :
+            recvBufferPool.append(self.data)
 
 class MsgQueue :
     def __init__(self) :
@@ -68,6 +97,9 @@ class MsgQueue :
     def dequeue(self) :
         return self.messages.popleft()
 
+    def pop(self) :
+        return self.messages.pop()
+
     def size(self) :
         return len(self.messages)
 
@@ -96,6 +128,9 @@ class Channel :
         But we additionally create channels for tcpListener and udpSocketFd,
         just to be able to poll them together in the function PollChannels.
     """
+    __slots__ = ('chid', 'handle', 'neighbor', 'remote', 'state', 'sendq', 'recvq', 'eventmask', 'lastDoRecvTime',
+                 'maxWaitTime', 'recvCredit', 'lastCreditTime', 'readAllowance', 'readPaused', 'lastReceived')
+
     def __init__(self, handle=-1, neighbor=None, remote=None, maxWaitTime=0.01) :
         self.chid           = -1
         self.handle         = handle           # handle of the channel with neighbor (fd)
@@ -107,53 +142,87 @@ class Channel :
         self.eventmask      = 0                # events on the handle
         self.lastDoRecvTime = 0                # last receiving TCP data time in this channel, for avoiding long time waiting
         self.maxWaitTime    = maxWaitTime      # max waiting time for reading channel
+        self.recvCredit     = 0                # bytes allowed to be read from the handle
+        self.lastCreditTime = 0                # last time the credit was refilled, to keep the receiving rate within the link bandwidth
+        self.readAllowance  = 0                # bytes the channel may read next, its share of the data admitted into the encoder
+        self.readPaused     = False            # reading is paused by the ingress AQM of the flow, TCP flow control pushes back
+        self.lastReceived   = None             # message returned by receive(), its chunk is released on the next call
 
     def setChannelId(self, id) :
         self.chid = id
 
     def send(self, data) :
-        self.sendq.enqueue(Buffer(data))
+        if len(data) > 0 :
+            self.sendq.enqueue(Buffer(data))
         return
 
     def receive(self) :
+        """ Return the next message (a memoryview of at most msgDataLength bytes),
+            which stays valid until the next call
+        """
+        if self.lastReceived :
+            self.lastReceived.chunk.release()
+            self.lastReceived = None
         if not self.recvq.isEmpty() : #and self.recvq.first().length == self.recvq.first().pos :
-            return self.recvq.dequeue().data    # class 'bytes'
+            self.lastReceived = self.recvq.dequeue()
+            return self.lastReceived.data       # class 'memoryview'
         else:
             self.eventmask &= CH_READ
             return None
 
-    def doRecv(self) :
-        """ Receive from the handle and store messages to recvq
+    def doRecv(self, maxBytes=TcpRecvChunkSize) :
+        """ Receive at most maxBytes from the handle into a pooled chunk,
+            and store it to recvq as messages of msgDataLength bytes sliced without copying
         """
-        if self.recvq.isEmpty():
-            self.recvq.enqueue(Buffer())
-        
-        # A complete message is here, set ready to process.
-        if self.recvq.last().length == self.recvq.last().pos :
-            self.eventmask |= CH_READ
+        # No credit left, set ready to process if a complete message is here.
+        if maxBytes <= 0 :
+            if not self.recvq.isEmpty() and self.recvq.last().length == self.recvq.last().pos :
+                self.eventmask |= CH_READ
             return
         
+        # Refill the partial message at the tail, so that every message but the last one stays full
+        start = 0
+        if not self.recvq.isEmpty() and self.recvq.last().length < msgDataLength :
+            start = self.recvq.last().length
+        
+        chunk = RecvChunk()
         try :
-            data, addr = self.handle.recvfrom(self.recvq.last().length - self.recvq.last().pos, socket.MSG_DONTWAIT)
+            cc = self.handle.recv_into(chunk.view[start : start + min(maxBytes, TcpRecvChunkSize - start)], 0, socket.MSG_DONTWAIT)
+        except BlockingIOError :
+            chunk.release()
+            return
         except Exception as details :
-            print("Channel.doread() cannot recvfrom(). Error: %s" % (details, ))
+            print("Channel.doread() cannot recv_into(). Error: %s" % (details, ))
             self.eventmask = CH_ERROR
             return
         
-        if len(data) == 0 :
+        if cc == 0 :
+            chunk.release()
             #print("Channel.doread() didn't read anything, something is wrong")
             #self.eventmask = CH_ERROR
             if self.state == CH_STATE_PARTIAL_CLOSE :
                 self.state = CH_STATE_PRECLOSE
             return
         
-        self.recvq.last().data += data
-        self.recvq.last().pos  += len(data)
-        
-        currentTime = time.time()
+        currentTime = time.monotonic()
+        firstTime = currentTime
+        if start > 0 :
+            tail = self.recvq.pop()
+            chunk.view[0 : start] = tail.data
+            tail.chunk.release()
+            firstTime = tail.time
+        end = start + cc
+        for offset in range(0, end, msgDataLength) :
+            buf = Buffer(chunk.view[offset : min(offset + msgDataLength, end)])
+            buf.pos   = buf.length
+            buf.chunk = chunk
+            buf.time  = firstTime if offset == 0 else currentTime
+            chunk.refs += 1
+            self.recvq.enqueue(buf)
+        self.recvCredit -= cc
 
         # If a complete message is received, mark the channel as readable
-        if self.recvq.last().length == self.recvq.last().pos or currentTime - self.lastDoRecvTime >= self.maxWaitTime :
+        if end >= msgDataLength or currentTime - self.lastDoRecvTime >= self.maxWaitTime :
             #print("[Channel] recvq of channel %s is readable" % (self.chid))
             self.eventmask |= CH_READ
         
@@ -161,23 +230,37 @@ class Channel :
         return
 
     def doSend(self) :
-        """ Write messages in send queue to socket
+        """ Write messages in send queue to socket, gathering them into one sendmsg() per call
+            until the queue is empty or the socket buffer is full
         """
-        if self.sendq.isEmpty() :
-            return
-        
-        offset = self.sendq.first().pos
-        cc = self.handle.send(self.sendq.first().data[offset : ])  # FIXME: am I non-blocking?
-        
-        if cc < 0:
-            self.eventmask = CH_ERROR
-            return
-        
-        self.sendq.first().pos += cc
-        
-        # remove message if sent was complete
-        if self.sendq.first().pos == self.sendq.first().length :
-            self.sendq.dequeue()
+        while not self.sendq.isEmpty() :
+            iov = []
+            for buf in self.sendq.messages :
+                iov.append(memoryview(buf.data)[buf.pos : ] if buf.pos else buf.data)
+                if len(iov) == TcpSendMaxIov :
+                    break
+            
+            try :
+                cc = self.handle.sendmsg(iov)
+            except BlockingIOError :
+                return
+            except Exception as details :
+                print("Channel.dosend() cannot sendmsg(). Error: %s" % (details, ))
+                self.eventmask = CH_ERROR
+                return
+            
+            # remove messages sent completely, and remember where the partially sent one stops
+            while cc > 0 :
+                buf = self.sendq.first()
+                sent = min(cc, buf.length - buf.pos)
+                buf.pos += sent
+                cc -= sent
+                if buf.pos == buf.length :
+                    self.sendq.dequeue()
+            
+            if not self.sendq.isEmpty() and self.sendq.first().pos > 0 :
+                # Socket buffer is full
+                return
         
         return
 
@@ -209,7 +292,6 @@ def OpenInConnChannel(chans, sockfd, remote, maxWaitTime) :
     ch.state = CH_STATE_CONNECT
     ch.setChannelId(chid)
     chans[chid] = ch
-    lastDoRecvTimes[chid] = 0
     mapHandleFilenoToChid[sockfd.fileno()] = chid
     poller.register(sockfd.fileno(), POLLIN | POLLOUT | POLLRDHUP)
     return chid
@@ -223,7 +305,6 @@ def OpenOutConnChannel(chans, neighbor, remote, maxWaitTime) :
     sockfd.setblocking(0)
     err = sockfd.connect_ex(neighbor)
     ch = Channel(sockfd, neighbor, remote, maxWaitTime)
-    lastDoRecvTimes[chid] = 0
     mapHandleFilenoToChid[sockfd.fileno()] = chid
     poller.register(sockfd.fileno(), POLLIN | POLLOUT | POLLRDHUP)
     if not err:
@@ -241,9 +322,9 @@ def OpenOutConnChannel(chans, neighbor, remote, maxWaitTime) :
     else:
         # Other errors
         print("Cannot open outgoing channel to %s:%d: %s" % (neighbor[0], neighbor[1], errno.errorcode[err]))
-        del lastDoRecvTimes[chid]
         del mapHandleFilenoToChid[sockfd.fileno()]
         poller.unregister(sockfd.fileno())
+        freeChids.append(chid)
         return -1
 
 def CloseChannel(chans, chid):
@@ -254,24 +335,33 @@ def CloseChannel(chans, chid):
             poller.unregister(chans[chid].handle.fileno())
         if chid != tcpListenChid and chid != udpChid :
             del mapHandleFilenoToChid[chans[chid].handle.fileno()]
-            del lastDoRecvTimes[chid]
         chans[chid].handle.close()
         del chans[chid]
+        freeChids.append(chid)
     except Exception as details :
         print("Error: close channel: %s" % (details, ))
 
+def CloseChannelWhenSent(chans, chid):
+    """ Close the channel once its queues are empty, so that data queued to the neighbor is not dropped
+    """
+    chans[chid].state = CH_STATE_PRECLOSE
+
 def FindOneFreeChannel(chans):
     """ Find a free channel, return the id
     """
-    i = 0
-    while True:
-        if i not in chans.keys():
-            break
-        i += 1
-    return i
+    global nextChid
+    while freeChids :
+        chid = freeChids.pop()
+        if chid not in chans :
+            return chid
+    while nextChid in chans :
+        nextChid += 1
+    nextChid += 1
+    return nextChid - 1
 
 def PollChannels(chans, tcpAvailableBw, bufferRemain, udpPollEvents) :
-    """ Poll channels in the list, return readable TCP channel ids and reports
+    """ Poll channels in the list, return readable TCP channel ids and reports.
+        bufferRemain is the number of source packets PEPesc admits into the encoder.
     """
     global poller 
 
@@ -319,18 +409,22 @@ def PollChannels(chans, tcpAvailableBw, bufferRemain, udpPollEvents) :
     # Poll
     result = poller.poll(1)
     
-    # Get number of readable TCP channel. Be careful not to count tcpListener and udpSocktFd.
-    readableTcpChannelNumber = len([fd for fd, event in result if event & (POLLIN | POLLRDHUP) and fd != tcpListenerFd and fd != udpSocketFd])
-
-    # DoRecv function call interval, definition: 
-    #     the maximum allowable length of the socket to receive data at one time,
-    #     divided by the estimated available bandwidth of the current link(unit: bps), 
-    #     multiplied by the current number of channels.
-    doRecvInterval = MsgDataMaxLength * 8 / tcpAvailableBw * readableTcpChannelNumber / 1.2
-    currentTime = time.time()
+    # Get number of readable TCP channel. Be careful not to count tcpListener and udpSocktFd,
+    # nor channels whose reading is paused, so that the active ones share the admitted data.
+    readableTcpChannelNumber = len([fd for fd, event in result if event & (POLLIN | POLLRDHUP) and fd != tcpListenerFd and fd != udpSocketFd
+                                    and not chans[mapHandleFilenoToChid[fd]].readPaused])
+
+    # Byte credit of each readable channel, definition:
+    #     refilled at the estimated available bandwidth of the current link(unit: bps)
+    #     shared by the current number of channels, up to one receive chunk,
+    #     and bounded by its share of the source packets admitted into the encoder (its read allowance),
+    #     none while its reading is paused.
+    recvRate = tcpAvailableBw / 8 / max(readableTcpChannelNumber, 1) * 1.2
+    maxCredit = min(TcpRecvChunkSize, max(bufferRemain, 0) * msgDataLength // max(readableTcpChannelNumber, 1))
+    currentTime = time.monotonic()
 
     if channelLogFlag == True and len(chans) != 0 :
-        channelLog.write("doRecvInterval %f %f\n" % (currentTime, doRecvInterval))
+        channelLog.write("recvRate %f %f\n" % (currentTime, recvRate))
         channelLog.write("socketNumber %f %d\n" % (currentTime, len(chans)))
         channelLog.write("readableChannelIds %f %d\n" % (currentTime, readableTcpChannelNumber))
 
@@ -369,10 +463,13 @@ def PollChannels(chans, tcpAvailableBw, bufferRemain, udpPollEvents) :
                 msg = PollChannelMsg['CONNECT_SUCCESS']
                 pollReports.append((i, msg, chans[i].neighbor, chans[i].remote))
         else:
-            if event & (POLLIN | POLLRDHUP) and currentTime - lastDoRecvTimes[i] >= doRecvInterval and bufferRemain > 0 :
-                # try our best to receive
-                chans[i].doRecv()
-                lastDoRecvTimes[i] = currentTime
+            if event & (POLLIN | POLLRDHUP) :
+                chans[i].readAllowance = 0 if chans[i].readPaused else maxCredit
+                chans[i].recvCredit = min(chans[i].recvCredit + (currentTime - chans[i].lastCreditTime) * recvRate, chans[i].readAllowance)
+                chans[i].lastCreditTime = currentTime
+                # Read as much as the credit allows in one call, once it covers a message or the neighbor has closed
+                if (chans[i].readAllowance > 0 and chans[i].recvCredit >= min(msgDataLength, chans[i].readAllowance)) or event & POLLRDHUP :
+                    chans[i].doRecv(int(chans[i].recvCredit))
             if not chans[i].sendq.isEmpty() and (event & POLLOUT) :
                 # try out best to send
                 chans[i].doSend()
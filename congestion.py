@@ -0,0 +1,839 @@
+import math
+import random
+import logging
+
+from abc         import ABC, abstractmethod
+from collections import deque
+from protocol    import ScPacketSize, CwndGain, PacingGain, BwWindowPeriod, MinRttWindowPeriod, \
+                        AckAggregationThreshold, AckCompressionRatio, AckAggregationSpan, ExtraAckedWindowPeriod, ExtraAckedMaxTime, \
+                        CongestionBackoffFactor, MinCongestionRateFactor, CongestionRecoveryStep, EcnGain, DispersionGain, \
+                        BBRStartupGain, BBRDrainGain, BBRCwndGain, BBRPacingGainCycle, BBRBwWindowRounds, \
+                        BBRMinRttWindow, BBRProbeRttDuration, BBRMinCWnd, BBRFullBwThreshold, BBRFullBwRounds, \
+                        DefaultTargetQueueDelay, DelayGain, DelayDecreaseRate, DelayFilterLength, DelayMinCWnd, \
+                        QueueDelayHistogramBin, QueueDelayHistogramLength
+
+
+class MaxBwFilter :
+    def __init__(self, roundPeriod) :
+        self.m_roundPeriod = roundPeriod
+        self.m_estTime     = deque()
+        self.m_BwQueue     = deque()
+        self.m_BwMaxQueue  = deque()
+
+    def GetMaxBw(self) :
+        return self.m_BwMaxQueue[0]
+
+    def IsEmpty(self) :
+        return (not len(self.m_BwQueue))
+
+    def Insert(self, newEstTime, newBw) :
+        self.m_estTime.append(newEstTime)
+        self.m_BwQueue.append(newBw)
+
+        while self.m_estTime[0] <= newEstTime - self.m_roundPeriod :
+            if self.m_BwQueue[0] == self.m_BwMaxQueue[0] :
+                self.m_BwMaxQueue.popleft()
+            self.m_estTime.popleft()
+            self.m_BwQueue.popleft()
+
+        while len(self.m_BwMaxQueue) != 0 and newBw > self.m_BwMaxQueue[-1] :
+            self.m_BwMaxQueue.pop()
+        self.m_BwMaxQueue.append(newBw)
+
+
+class MinRttFilter :
+    def __init__(self, roundPeriod) :
+        self.m_roundPeriod = roundPeriod
+        self.m_estTime     = deque()
+        self.m_RttQueue    = deque()
+        self.m_RttMinQueue = deque()
+
+    def GetMinRtt(self) :
+        return self.m_RttMinQueue[0]
+
+    def IsEmpty(self) :
+        return (not len(self.m_RttQueue))
+
+    def Insert(self, newEstTime, newRtt) :
+        self.m_estTime.append(newEstTime)
+        self.m_RttQueue.append(newRtt)
+
+        while self.m_estTime[0] <= newEstTime - self.m_roundPeriod :
+            if self.m_RttQueue[0] == self.m_RttMinQueue[0] :
+                self.m_RttMinQueue.popleft()
+            self.m_estTime.popleft()
+            self.m_RttQueue.popleft()
+
+        while len(self.m_RttMinQueue) != 0 and newRtt < self.m_RttMinQueue[-1] :
+            self.m_RttMinQueue.pop()
+        self.m_RttMinQueue.append(newRtt)
+
+
+class RttEstimator :
+    """ Smoothed RTT, RTT variance (RFC 6298) and min RTT over the last windowPeriod seconds.
+        Samples come from the sending timestamps echoed in data ACKs and from probe ACKs.
+    """
+    def __init__(self, windowPeriod=MinRttWindowPeriod) :
+        self.m_srtt         = 0.0
+        self.m_rttVar       = 0.0
+        self.m_latestRtt    = 0.0
+        self.m_minRttFilter = MinRttFilter(windowPeriod)
+
+    def Update(self, sampleTime, newRtt) :
+        if newRtt <= 0 :
+            return
+        alpha, beta = 0.9, 0.25
+        if self.m_srtt == 0 :
+            self.m_srtt   = newRtt
+            self.m_rttVar = newRtt / 2
+        else :
+            self.m_rttVar = (1 - beta) * self.m_rttVar + beta * abs(self.m_srtt - newRtt)
+            self.m_srtt   = alpha * self.m_srtt + (1 - alpha) * newRtt
+        self.m_latestRtt = newRtt
+        self.m_minRttFilter.Insert(sampleTime, newRtt)
+
+    def SRtt(self) :
+        return self.m_srtt
+
+    def RttVar(self) :
+        return self.m_rttVar
+
+    def MinRtt(self) :
+        return 1e6 if self.m_minRttFilter.IsEmpty() else self.m_minRttFilter.GetMinRtt()
+
+
+class AckAggregationFilter :
+    """ Detect ACKs arriving in bunches (e.g. DVB-S2/TDMA return links), where the ACK interval
+        understates the time the acked packets took to be delivered.
+        An ACK is compressed if it arrives much closer to the previous ACK than the packets they acknowledge
+        were sent. An epoch starts at every ACK that is not compressed, so a bunch is one epoch.
+        The excess of an epoch over the delivery expected at the reference bandwidth (extra-acked) is kept
+        in a windowed max filter as an allowance for cWnd. Bandwidth samples within an aggregated epoch
+        are dropped; instead, a sample over whole epochs spanning AckAggregationSpan aggregation intervals
+        is taken when the epoch ends, over the longer of the span of the epochs and the time the packets
+        acked were sent over, so that bunches leaving at irregular times or carrying a packet more or less
+        than the others do not show as rate.
+    """
+    def __init__(self, windowPeriod=ExtraAckedWindowPeriod) :
+        self.m_lastAckTime  = -1.0
+        self.m_lastSendTime = -1.0
+        self.m_epochStart   = -1.0
+        self.m_epochAcked   = 0
+        self.m_extraAckedFilter = MaxBwFilter(windowPeriod)
+        self.m_extraAcked   = 0.0
+        self.m_aggregated   = False         # in an aggregated epoch
+        self.m_epochClosed  = False         # an aggregated epoch just ended with the current ACK
+        self.m_aggregationInterval = 0.0    # smoothed duration of aggregated epochs
+        self.m_cumAcked     = 0
+        self.m_epochHistory = deque()       # (start time, cumulative acked before, send time of the newest packet acked before) of the recent epochs
+
+    def OnAck(self, ackTime, numAcked, sendTime, bw) :
+        """ sendTime is the sending time of the newest packet acked,
+            bw is the reference bandwidth (pkts/sec.) the ACKs are expected to arrive at
+        """
+        ackInterval  = ackTime - self.m_lastAckTime
+        sendInterval = sendTime - self.m_lastSendTime
+        lastSendTime = self.m_lastSendTime
+        self.m_lastAckTime = ackTime
+        self.m_epochClosed = False
+        self.m_cumAcked += numAcked
+        if sendInterval <= 0 and self.m_epochStart != -1.0 :
+            # Acking nothing sent later than the previous ACK did, no hint on the ACK pattern
+            self.m_epochAcked += numAcked
+            return
+        self.m_lastSendTime = sendTime
+
+        if ackInterval >= AckCompressionRatio * sendInterval :
+            # ACKs are paced as the packets were sent, a new epoch starts
+            if self.m_aggregated and self.m_epochAcked > AckAggregationThreshold :
+                duration = ackTime - self.m_epochStart
+                self.m_aggregationInterval = duration if self.m_aggregationInterval == 0 \
+                                             else 0.9 * self.m_aggregationInterval + 0.1 * duration
+                self.m_epochClosed = True
+            self.m_epochStart = ackTime
+            self.m_epochAcked = 0
+            self.m_aggregated = False
+            self.m_epochHistory.append((ackTime, self.m_cumAcked - numAcked, lastSendTime))
+            # Keep the newest epoch started before the span of a filtered sample as the reference point
+            span = AckAggregationSpan * self.m_aggregationInterval
+            while len(self.m_epochHistory) > 2 and self.m_epochHistory[1][0] <= ackTime - span :
+                self.m_epochHistory.popleft()
+        else :
+            self.m_aggregated = True
+        self.m_epochAcked += numAcked
+
+        extraAcked = self.m_epochAcked - bw * (ackTime - self.m_epochStart) if bw > 0 else 0.0
+        self.m_extraAckedFilter.Insert(ackTime, max(extraAcked, 0.0))
+        self.m_extraAcked = self.m_extraAckedFilter.GetMaxBw()
+
+    def IsAggregated(self) :
+        return self.m_aggregated
+
+    def ExtraAcked(self, bw) :
+        """ Allowance (pkts) on top of the BDP, so that sending is not stalled between ACK bunches
+        """
+        return min(self.m_extraAcked, bw * ExtraAckedMaxTime)
+
+    def FilteredBw(self) :
+        """ Delivery rate (pkts/sec.) over the whole epochs spanning at least AckAggregationSpan aggregation intervals,
+            only available at the ACK ending an aggregated epoch, None otherwise
+        """
+        if not self.m_epochClosed or len(self.m_epochHistory) < 2 :
+            return None
+        refTime, refAcked, refSendTime = self.m_epochHistory[0]
+        endTime, endAcked, endSendTime = self.m_epochHistory[-1]
+        if refTime > endTime - AckAggregationSpan * self.m_aggregationInterval :
+            return None
+        return (endAcked - refAcked) / max(endTime - refTime, endSendTime - refSendTime)
+
+    def __str__(self) :
+        return "aggregated: %s extraAcked: %f aggregationInterval: %f" % (self.m_aggregated, self.m_extraAcked, self.m_aggregationInterval)
+
+
+class AckSample :
+    """ What the sender learns from one data ACK, handed to the congestion controller.
+        So the members in the class are as follows:
+            - arrive time of the ACK;
+            - number of packets newly acked by it;
+            - RTT sample of the latest received packet (-1 if not valid);
+            - smoothed and minimum RTT of the sender;
+            - BBR delivery-rate sample: delivered, ack elapsed and send elapsed;
+            - number of packets delivered when the latest received packet was sent, and in total;
+            - packets in flight after the ACK;
+            - whether the sender had no new data to send;
+            - sending time of the latest received packet.
+    """
+    def __init__(self, ackTime=0.0, numAcked=0, rttSample=-1, rtt=0.0, rttMin=1e6, delivered=0, ackElapsed=0.0, sendElapsed=0.0,
+                 deliveredAsOfSend=0, totalDelivered=0, packetsInFlight=0, appLimited=False, sendTime=-1.0) :
+        self.ackTime           = ackTime
+        self.numAcked          = numAcked
+        self.rttSample         = rttSample
+        self.rtt               = rtt
+        self.rttMin            = rttMin
+        self.delivered         = delivered
+        self.ackElapsed        = ackElapsed
+        self.sendElapsed       = sendElapsed
+        self.deliveredAsOfSend = deliveredAsOfSend
+        self.totalDelivered    = totalDelivered
+        self.packetsInFlight   = packetsInFlight
+        self.appLimited        = appLimited
+        self.sendTime          = sendTime
+
+    def DeliveryRate(self) :
+        # BBR's delivery rate estimation algorithm
+        # https://datatracker.ietf.org/doc/html/draft-cheng-iccrg-delivery-rate-estimation
+        deliveryElapsed = max(self.ackElapsed, self.sendElapsed)
+        return self.delivered / deliveryElapsed if deliveryElapsed > 0 else 0.0    # pkts/sec.
+
+
+class CongestionStats :
+    """ Statistics of one congestion control mode, to compare the modes on the same path:
+        queue delay (RTT sample - min RTT) distribution against the target, cWnd and goodput.
+    """
+    def __init__(self, name, targetQueueDelay) :
+        self.m_name       = name
+        self.m_target     = targetQueueDelay
+        self.m_startTime  = -1.0
+        self.m_lastTime   = -1.0
+        self.m_numAcked   = 0
+        self.m_numSamples = 0
+        self.m_sumQueueDelay = 0.0
+        self.m_maxQueueDelay = 0.0
+        self.m_overTarget    = 0
+        self.m_sumCWnd       = 0.0
+        self.m_ceMarked      = 0
+        self.m_histogram     = [0] * QueueDelayHistogramLength
+
+    def OnAck(self, sample, cWnd) :
+        if self.m_startTime < 0 :
+            self.m_startTime = sample.ackTime
+        self.m_lastTime = sample.ackTime
+        self.m_numAcked += sample.numAcked
+        if sample.rttSample < 0 or sample.rttMin == 1e6 :
+            return
+        queueDelay = max(0.0, sample.rttSample - sample.rttMin)
+        self.m_numSamples += 1
+        self.m_sumQueueDelay += queueDelay
+        self.m_maxQueueDelay = max(self.m_maxQueueDelay, queueDelay)
+        self.m_overTarget += 1 if queueDelay > self.m_target else 0
+        self.m_sumCWnd += cWnd
+        self.m_histogram[min(int(queueDelay / QueueDelayHistogramBin), QueueDelayHistogramLength - 1)] += 1
+
+    def OnEcnMarked(self, numMarked) :
+        self.m_ceMarked += numMarked
+
+    def QueueDelayPercentile(self, percentile) :
+        count = 0
+        for i in range(QueueDelayHistogramLength) :
+            count += self.m_histogram[i]
+            if count >= percentile * self.m_numSamples :
+                return min((i + 1) * QueueDelayHistogramBin, self.m_maxQueueDelay)
+        return 0.0
+
+    def __str__(self) :
+        n = max(self.m_numSamples, 1)
+        duration = self.m_lastTime - self.m_startTime
+        goodput = self.m_numAcked / duration if duration > 0 else 0.0
+        return "mode: %s target: %.1f ms queueDelay mean/p95/max: %.1f/%.1f/%.1f ms overTarget: %.1f%% meanCWnd: %.1f pkts goodput: %.1f pkts/s ceMarked: %d" \
+            % (self.m_name, self.m_target * 1000, self.m_sumQueueDelay / n * 1000, self.QueueDelayPercentile(0.95) * 1000,
+               self.m_maxQueueDelay * 1000, self.m_overTarget / n * 100, self.m_sumCWnd / n, goodput, self.m_ceMarked)
+
+
+class CongestionController(ABC) :
+    """ Interface of the congestion controllers between PEPesc entities.
+        pepApp reports packets sent, ACKs received, losses detected, packet-train probes and
+        timer events, and reads back cWnd (pkts), pacing flag, pacing rate (bytes/sec) and
+        the estimated bandwidth (pkts/sec).
+        Losses classified as congestive and ECN CE marks back off the rate by m_rateFactor in every controller.
+        A controller must handle ACKs; probes and dispersion samples are ignored unless it uses them.
+    """
+    name = None
+
+    def __init__(self, initCWnd) :
+        self.m_initCWnd   = initCWnd
+        self.m_cWnd       = initCWnd
+        self.m_pacing     = True
+        self.m_pacingRate = 5 * 1024 * 1024
+        self.m_estBw      = 0.0     # latest bandwidth sample (pkts/sec.)
+        self.m_estBwMax   = 0.0     # bandwidth used for sizing cWnd (pkts/sec.)
+        self.m_probeBw    = 0.0     # bandwidth of latest packet-train probe (pkts/sec.)
+        self.m_packetSize = ScPacketSize    # bytes of a data packet, of the symbol size agreed at handshake
+
+        # rate limits set by the user (pkts/sec.)
+        self.m_constBw      = None
+        self.m_maxAllowedBw = None
+
+        # bunched ACKs
+        self.m_ackAggregation = AckAggregationFilter()
+
+        # back-off on congestive losses
+        self.m_rateFactor      = 1.0
+        self.m_lastBackoffTime = -1.0
+        self.m_lastRecoverTime = -1.0
+
+        # DCTCP-like moving average of the fraction of CE-marked packets per RTT
+        self.m_ecnAlpha       = 0.0
+        self.m_ecnAcked       = 0
+        self.m_ecnMarked      = 0
+        self.m_ecnRoundStart  = -1.0
+
+        # standing queue delay to steer toward (Delay) or to report against (other modes)
+        self.m_targetQueueDelay = DefaultTargetQueueDelay
+        self.m_stats = CongestionStats(self.name, self.m_targetQueueDelay)
+
+    def SetRateLimits(self, constBw, maxAllowedBw) :
+        self.m_constBw      = constBw
+        self.m_maxAllowedBw = maxAllowedBw
+
+    def SetPacketSize(self, packetSize) :
+        self.m_packetSize = packetSize
+
+    def SetTargetQueueDelay(self, targetQueueDelay) :
+        self.m_targetQueueDelay = targetQueueDelay
+        self.m_stats.m_target   = targetQueueDelay
+
+    def UpdateStats(self, sample) :
+        self.m_stats.OnAck(sample, self.m_cWnd)
+
+    def OnPacketSent(self, sendTime, pktType, pktId, packetsInFlight) :
+        return
+
+    @abstractmethod
+    def OnAckReceived(self, sample) :
+        """ Update the bandwidth and RTT estimates, cWnd and the pacing rate from an AckSample
+        """
+
+    def OnLossDetected(self, currentTime, numRandomLoss, numCongestiveLoss, rtt) :
+        """ Random losses are covered by repair packets, only congestive ones reduce the rate.
+        """
+        if numCongestiveLoss > 0 :
+            # Back off at most once per RTT, as a single overflow usually drops several packets
+            if currentTime - self.m_lastBackoffTime >= rtt :
+                self.m_rateFactor = max(self.m_rateFactor * CongestionBackoffFactor, MinCongestionRateFactor)
+                self.m_lastBackoffTime = currentTime
+                self.m_lastRecoverTime = currentTime
+        elif self.m_rateFactor < 1.0 and currentTime - self.m_lastRecoverTime >= rtt :
+            # Grow the rate back once per RTT without congestive loss
+            self.m_rateFactor = min(1.0, self.m_rateFactor + CongestionRecoveryStep)
+            self.m_lastRecoverTime = currentTime
+
+    def OnEcnMarked(self, currentTime, numMarked, numAcked, rtt) :
+        """ CE marks signal congestion before the bottleneck queue overflows.
+            The rate backs off by half of the marked fraction (moving average), at most once per RTT.
+        """
+        self.m_stats.OnEcnMarked(numMarked)
+        if self.m_ecnRoundStart < 0 :
+            self.m_ecnRoundStart = currentTime
+        self.m_ecnAcked  += numAcked
+        self.m_ecnMarked += numMarked
+        if currentTime - self.m_ecnRoundStart < rtt or self.m_ecnAcked == 0 :
+            return
+        fraction = min(1.0, self.m_ecnMarked / self.m_ecnAcked)
+        self.m_ecnAlpha = (1 - EcnGain) * self.m_ecnAlpha + EcnGain * fraction
+        if self.m_ecnMarked > 0 :
+            self.m_rateFactor = max(self.m_rateFactor * (1 - self.m_ecnAlpha / 2), MinCongestionRateFactor)
+            self.m_lastBackoffTime = currentTime
+            self.m_lastRecoverTime = currentTime
+        self.m_ecnRoundStart = currentTime
+        self.m_ecnAcked  = 0
+        self.m_ecnMarked = 0
+
+    def OnBwProbe(self, currentTime, probeBw, sample) :
+        """ probeBw (pkts/sec.) is the bandwidth of a packet-train probe, only kept for reporting by default
+        """
+        self.m_probeBw = probeBw
+
+    def OnDispersionSample(self, currentTime, bw, sample) :
+        """ bw (pkts/sec.) is the bottleneck capacity from the arrival dispersion of back-to-back data packets
+        """
+        return
+
+    def OnTimer(self, currentTime, packetsInFlight) :
+        return
+
+    def __str__(self) :
+        return "cc: %s cWnd: %d pacingRate: %f estBw: %f maxBw: %f rateFactor: %f %s" \
+            % (self.name, self.m_cWnd, self.m_pacingRate, self.m_estBw, self.m_estBwMax, self.m_rateFactor, self.m_ackAggregation)
+
+
+class JerseyController(CongestionController) :
+    """ TCP Jersey's TSW bandwidth estimation, cWnd follows max bandwidth x min RTT.
+    """
+    name = 'Jersey'
+
+    def __init__(self, initCWnd) :
+        CongestionController.__init__(self, initCWnd)
+        self.m_maxBwFilter = MaxBwFilter(BwWindowPeriod)
+        self.m_lastAckTime = -1.0   # time of receiving last ACK (in sec.)
+
+    def OnAckReceived(self, sample) :
+        ackInterval = sample.ackTime - self.m_lastAckTime
+        self.m_ackAggregation.OnAck(sample.ackTime, sample.numAcked, sample.sendTime, self.m_estBwMax)
+        # No estimation on the first data ack, as the interval cannot be calculated
+        if self.m_lastAckTime != -1.0 :
+            # The ACK interval within a bunch says nothing about the bottleneck, use the rate over whole bunches
+            filteredBw = self.m_ackAggregation.FilteredBw()
+            if filteredBw is not None :
+                self.m_estBw = filteredBw
+                self.m_maxBwFilter.Insert(sample.ackTime, self.m_estBw)
+            elif not self.m_ackAggregation.IsAggregated() :
+                self.m_estBw = (sample.rtt * self.m_estBw + sample.numAcked) / (ackInterval + sample.rtt)
+                self.m_maxBwFilter.Insert(sample.ackTime, self.m_estBw)
+
+            log = "[Jersy-ABE] ackInterval: %f" % ackInterval
+            log += " numAcked: %d" % sample.numAcked
+            log += " Estimated-BW: %f" % self.m_estBw
+            log += " Current-Max-Bw: %f" % (self.m_maxBwFilter.GetMaxBw() if not self.m_maxBwFilter.IsEmpty() else 0)
+            log += " Aggregated: %s" % self.m_ackAggregation.IsAggregated()
+            logging.debug(log)
+        self.m_lastAckTime = sample.ackTime
+        self.UpdateCwnd(sample.packetsInFlight, sample.rttMin)
+
+    def OnBwProbe(self, currentTime, probeBw, sample) :
+        self.m_probeBw = probeBw
+        self.m_estBw = probeBw * 0.8
+        self.m_maxBwFilter.Insert(currentTime, self.m_estBw)
+        self.UpdateCwnd(sample.packetsInFlight, sample.rttMin)
+
+    def OnDispersionSample(self, currentTime, bw, sample) :
+        self.m_maxBwFilter.Insert(currentTime, bw * DispersionGain)
+        self.UpdateCwnd(sample.packetsInFlight, sample.rttMin)
+
+    def UpdateCwnd(self, packetsInFlight, rttMin) :
+        # Update estimated maximum bandwidth
+        if self.m_maxBwFilter.IsEmpty() :
+            self.m_estBwMax = self.m_probeBw * 0.8
+        else :
+            self.m_estBwMax = self.m_maxBwFilter.GetMaxBw()
+
+        # Update CWND
+        if self.m_constBw :
+            cWndPreset = self.m_constBw * rttMin * CwndGain
+        elif self.m_maxAllowedBw :
+            cWndPreset = min(self.m_maxAllowedBw / PacingGain, self.m_estBwMax) * rttMin * CwndGain * self.m_rateFactor
+        else :
+            cWndPreset = self.m_estBwMax * rttMin * CwndGain * self.m_rateFactor
+        if not self.m_constBw and rttMin != 1e6 :
+            cWndPreset += self.m_ackAggregation.ExtraAcked(self.m_estBwMax)
+        self.m_cWnd = math.floor(max(self.m_initCWnd, cWndPreset))
+        self.m_pacing = True if self.m_cWnd > self.m_initCWnd else False
+        # Update pacing rate
+        if self.m_pacing == True and self.m_cWnd > packetsInFlight :
+            self.m_pacingRate = self.m_constBw * self.m_packetSize if self.m_constBw \
+                                else self.m_estBwMax * self.m_packetSize * PacingGain * self.m_rateFactor
+
+
+# BBR states
+BBR_STARTUP   = 'STARTUP'
+BBR_DRAIN     = 'DRAIN'
+BBR_PROBE_BW  = 'PROBE_BW'
+BBR_PROBE_RTT = 'PROBE_RTT'
+
+class BBRController(CongestionController) :
+    """ BBR (v1) with delivery-rate estimation, a max bandwidth filter over BBRBwWindowRounds
+        round trips, startup/drain/probe_bw/probe_rtt states, pacing gain cycling in probe_bw
+        and min-RTT re-probing when the min-RTT has not been refreshed for BBRMinRttWindow.
+        https://datatracker.ietf.org/doc/html/draft-cardwell-iccrg-bbr-congestion-control
+    """
+    name = 'BBR'
+
+    def __init__(self, initCWnd) :
+        CongestionController.__init__(self, initCWnd)
+        self.m_state       = BBR_STARTUP
+        self.m_pacingGain  = BBRStartupGain
+        self.m_cWndGain    = BBRStartupGain
+        self.m_maxBwFilter = MaxBwFilter(BBRBwWindowRounds)    # windowed by round count
+        self.m_aggregatedBw = 0.0                               # latest delivery rate over whole ACK bunches
+
+        # round counting
+        self.m_roundCount         = 0
+        self.m_roundStart         = False
+        self.m_nextRoundDelivered = 0
+
+        # full pipe detection
+        self.m_filledPipe  = False
+        self.m_fullBw      = 0.0
+        self.m_fullBwCount = 0
+
+        # gain cycling
+        self.m_cycleIndex = 0
+        self.m_cycleStamp = 0.0
+
+        # min RTT and probe_rtt
+        self.m_minRtt           = 1e6
+        self.m_minRttStamp      = -1.0
+        self.m_probeRttDoneTime = 0.0
+        self.m_probeRttRoundDone = False
+        self.m_priorCWnd        = initCWnd
+
+        self.m_packetsInFlight  = 0
+        self.m_delivered        = 0
+        self.m_pacing           = False
+
+    def BtlBw(self) :
+        if self.m_maxBwFilter.IsEmpty() :
+            return self.m_probeBw * 0.8
+        return self.m_maxBwFilter.GetMaxBw()
+
+    def Bdp(self, gain) :
+        if self.m_minRtt == 1e6 or self.BtlBw() == 0 :
+            return self.m_initCWnd
+        return gain * self.BtlBw() * self.m_minRtt
+
+    def OnPacketSent(self, sendTime, pktType, pktId, packetsInFlight) :
+        self.m_packetsInFlight = packetsInFlight
+
+    def OnAckReceived(self, sample) :
+        self.m_packetsInFlight = sample.packetsInFlight
+        self.m_delivered = sample.totalDelivered
+        self.UpdateRound(sample)
+        self.UpdateBw(sample)
+        self.CheckFullPipe(sample)
+        self.CheckDrain(sample.ackTime)
+        self.UpdateCyclePhase(sample.ackTime, sample.numAcked > 0 and sample.delivered == 0)
+        self.UpdateMinRtt(sample.ackTime, sample.rttSample)
+        self.CheckProbeRtt(sample.ackTime)
+        self.UpdateCwnd(sample.numAcked, sample.totalDelivered)
+
+    def OnBwProbe(self, currentTime, probeBw, sample) :
+        self.m_probeBw = probeBw
+        self.m_estBw = probeBw * 0.8
+        self.m_maxBwFilter.Insert(self.m_roundCount, self.m_estBw)
+        self.UpdateMinRtt(currentTime, sample.rttSample)
+        self.UpdateCwnd(0, sample.totalDelivered)
+
+    def OnDispersionSample(self, currentTime, bw, sample) :
+        self.m_maxBwFilter.Insert(self.m_roundCount, bw * DispersionGain)
+        self.UpdateCwnd(0, sample.totalDelivered)
+
+    def OnTimer(self, currentTime, packetsInFlight) :
+        # ACKs can be sparse when the link is idle, so min-RTT expiry and probe_rtt exit are checked here as well
+        self.m_packetsInFlight = packetsInFlight
+        if self.m_state == BBR_PROBE_RTT or (self.m_minRttStamp >= 0 and currentTime > self.m_minRttStamp + BBRMinRttWindow) :
+            self.CheckProbeRtt(currentTime)
+            self.SetCwnd(0, 0)
+
+    def UpdateRound(self, sample) :
+        self.m_roundStart = False
+        if sample.deliveredAsOfSend >= self.m_nextRoundDelivered :
+            self.m_nextRoundDelivered = sample.totalDelivered
+            self.m_roundCount += 1
+            self.m_roundStart = True
+
+    def UpdateBw(self, sample) :
+        self.m_ackAggregation.OnAck(sample.ackTime, sample.numAcked, sample.sendTime, self.BtlBw())
+        bw = sample.DeliveryRate()
+        if bw <= 0 :
+            return
+        # Bunched ACKs shorten ackElapsed, bound the sample by the rate over whole bunches
+        filteredBw = self.m_ackAggregation.FilteredBw()
+        if filteredBw is not None :
+            bw = self.m_aggregatedBw = filteredBw
+        elif self.m_ackAggregation.IsAggregated() :
+            if self.m_aggregatedBw > 0 :
+                bw = min(bw, self.m_aggregatedBw)
+            elif not self.m_maxBwFilter.IsEmpty() :
+                return
+        self.m_estBw = bw
+        # An app-limited sample only tells the bandwidth is at least this much
+        if not sample.appLimited or self.m_maxBwFilter.IsEmpty() or bw >= self.m_maxBwFilter.GetMaxBw() :
+            self.m_maxBwFilter.Insert(self.m_roundCount, bw)
+        logging.debug("[BBR-ABE] delivered: %d ackElapsed: %f sendElapsed: %f Estimated-BW: %f Current-Max-Bw: %f" \
+            % (sample.delivered, sample.ackElapsed, sample.sendElapsed, bw, self.BtlBw()))
+
+    def CheckFullPipe(self, sample) :
+        if self.m_filledPipe or not self.m_roundStart or sample.appLimited :
+            return
+        if self.BtlBw() >= self.m_fullBw * BBRFullBwThreshold :
+            self.m_fullBw = self.BtlBw()
+            self.m_fullBwCount = 0
+            return
+        self.m_fullBwCount += 1
+        if self.m_fullBwCount >= BBRFullBwRounds :
+            self.m_filledPipe = True
+
+    def CheckDrain(self, currentTime) :
+        if self.m_state == BBR_STARTUP and self.m_filledPipe :
+            self.EnterState(BBR_DRAIN, currentTime)
+        if self.m_state == BBR_DRAIN and self.m_packetsInFlight <= max(self.Bdp(1.0), BBRMinCWnd) :
+            self.EnterState(BBR_PROBE_BW, currentTime)
+
+    def EnterState(self, state, currentTime) :
+        logging.info("[BBR] %s -> %s" % (self.m_state, state))
+        self.m_state = state
+        if state == BBR_STARTUP :
+            self.m_pacingGain = BBRStartupGain
+            self.m_cWndGain   = BBRStartupGain
+        elif state == BBR_DRAIN :
+            self.m_pacingGain = BBRDrainGain
+            self.m_cWndGain   = BBRStartupGain
+        elif state == BBR_PROBE_BW :
+            # Start from a random phase other than the draining one
+            self.m_cycleIndex = random.choice([i for i in range(len(BBRPacingGainCycle)) if i != 1])
+            self.m_cycleStamp = currentTime
+            self.m_pacingGain = BBRPacingGainCycle[self.m_cycleIndex]
+            self.m_cWndGain   = BBRCwndGain
+        else :
+            self.m_pacingGain = 1.0
+            self.m_cWndGain   = 1.0
+
+    def UpdateCyclePhase(self, currentTime, lossy) :
+        if self.m_state != BBR_PROBE_BW :
+            return
+        isFullLength = currentTime - self.m_cycleStamp > self.m_minRtt
+        if self.m_pacingGain == 1.0 :
+            advance = isFullLength
+        elif self.m_pacingGain > 1.0 :
+            advance = isFullLength and (lossy or self.m_packetsInFlight >= self.Bdp(self.m_pacingGain))
+        else :
+            advance = isFullLength or self.m_packetsInFlight <= max(self.Bdp(1.0), BBRMinCWnd)
+        if advance :
+            self.m_cycleIndex = (self.m_cycleIndex + 1) % len(BBRPacingGainCycle)
+            self.m_cycleStamp = currentTime
+            self.m_pacingGain = BBRPacingGainCycle[self.m_cycleIndex]
+
+    def UpdateMinRtt(self, currentTime, rttSample) :
+        if rttSample is None or rttSample < 0 :
+            return
+        expired = self.m_minRttStamp >= 0 and currentTime > self.m_minRttStamp + BBRMinRttWindow
+        if rttSample <= self.m_minRtt or expired :
+            self.m_minRtt = rttSample
+            self.m_minRttStamp = currentTime
+
+    def CheckProbeRtt(self, currentTime) :
+        expired = self.m_minRttStamp >= 0 and currentTime > self.m_minRttStamp + BBRMinRttWindow
+        if self.m_state != BBR_PROBE_RTT and expired :
+            self.m_priorCWnd = max(self.m_priorCWnd, self.m_cWnd) if self.m_state == BBR_PROBE_BW else self.m_cWnd
+            self.EnterState(BBR_PROBE_RTT, currentTime)
+            self.m_probeRttDoneTime = 0.0
+
+        if self.m_state != BBR_PROBE_RTT :
+            return
+
+        if self.m_probeRttDoneTime == 0.0 and self.m_packetsInFlight <= BBRMinCWnd :
+            self.m_probeRttDoneTime  = currentTime + max(BBRProbeRttDuration, self.m_minRtt if self.m_minRtt != 1e6 else 0)
+            self.m_probeRttRoundDone = False
+            self.m_nextRoundDelivered = self.m_delivered
+        elif self.m_probeRttDoneTime != 0.0 :
+            if self.m_roundStart :
+                self.m_probeRttRoundDone = True
+            if self.m_probeRttRoundDone and currentTime > self.m_probeRttDoneTime :
+                self.m_minRttStamp = currentTime
+                self.m_cWnd = max(self.m_cWnd, self.m_priorCWnd)
+                self.EnterState(BBR_PROBE_BW if self.m_filledPipe else BBR_STARTUP, currentTime)
+
+    def UpdateCwnd(self, numAcked, totalDelivered) :
+        self.m_estBwMax = self.BtlBw()
+        self.SetCwnd(numAcked, totalDelivered)
+        self.SetPacingRate()
+
+    def SetCwnd(self, numAcked, totalDelivered) :
+        bw = self.m_estBwMax * self.m_rateFactor
+        if self.m_maxAllowedBw :
+            bw = min(bw, self.m_maxAllowedBw)
+        targetCWnd = self.m_cWndGain * bw * self.m_minRtt + 3 + self.m_ackAggregation.ExtraAcked(bw) if self.m_minRtt != 1e6 and bw > 0 else self.m_initCWnd
+        if self.m_filledPipe :
+            cWnd = min(self.m_cWnd + numAcked, targetCWnd)
+        elif self.m_cWnd < targetCWnd or totalDelivered < self.m_initCWnd :
+            cWnd = self.m_cWnd + numAcked
+        else :
+            cWnd = self.m_cWnd
+        cWnd = max(cWnd, BBRMinCWnd)
+        if self.m_state == BBR_PROBE_RTT :
+            cWnd = min(cWnd, BBRMinCWnd)
+        if self.m_constBw :
+            cWnd = self.m_constBw * self.m_minRtt if self.m_minRtt != 1e6 else self.m_initCWnd
+        self.m_cWnd = math.floor(cWnd)
+
+    def SetPacingRate(self) :
+        if self.m_constBw :
+            self.m_pacing = True
+            self.m_pacingRate = self.m_constBw * self.m_packetSize
+            return
+        bw = self.m_estBwMax * self.m_rateFactor
+        if self.m_maxAllowedBw :
+            bw = min(bw, self.m_maxAllowedBw)
+        if bw <= 0 :
+            self.m_pacing = False
+            return
+        rate = self.m_pacingGain * bw * self.m_packetSize
+        # Do not slow down in startup before the pipe is filled, nor go below the initial window per min RTT
+        if self.m_state == BBR_STARTUP and not self.m_filledPipe and self.m_pacing :
+            rate = max(rate, self.m_pacingRate)
+        if self.m_minRtt != 1e6 :
+            rate = max(rate, self.m_pacingGain * BBRMinCWnd / self.m_minRtt * self.m_packetSize)
+        self.m_pacing = True
+        self.m_pacingRate = rate
+
+    def __str__(self) :
+        return CongestionController.__str__(self) + " state: %s pacingGain: %f cWndGain: %f minRtt: %f round: %d" \
+            % (self.m_state, self.m_pacingGain, self.m_cWndGain, self.m_minRtt, self.m_roundCount)
+
+
+class DelayController(CongestionController) :
+    """ Delay-target control (LEDBAT-like), keeping the standing queue at the bottleneck short
+        for interactive flows behind the PEP. The queue delay, i.e. the min of the latest
+        DelayFilterLength RTT samples minus the min RTT, is steered toward m_targetQueueDelay:
+        cWnd grows by up to DelayGain pkts per RTT below the target and shrinks by up to
+        DelayDecreaseRate of itself per RTT above it. cWnd is doubled per RTT (slow start) until
+        the queue delay first reaches half of the target. Packets are paced at cWnd over min RTT + target.
+        https://datatracker.ietf.org/doc/html/rfc6817
+    """
+    name = 'Delay'
+
+    def __init__(self, initCWnd) :
+        CongestionController.__init__(self, initCWnd)
+        self.m_maxBwFilter  = MaxBwFilter(BwWindowPeriod)
+        self.m_rttSamples   = deque(maxlen=DelayFilterLength)
+        self.m_delayCWnd    = float(initCWnd)    # cWnd in fractional pkts
+        self.m_minRtt       = 1e6
+        self.m_queueDelay   = 0.0
+        self.m_slowStart    = True
+        self.m_pacing       = False
+
+    def OnAckReceived(self, sample) :
+        self.m_ackAggregation.OnAck(sample.ackTime, sample.numAcked, sample.sendTime, self.m_estBwMax)
+        self.m_minRtt = sample.rttMin
+        self.UpdateBw(sample)
+        if sample.rttSample > 0 and self.m_minRtt != 1e6 :
+            self.m_rttSamples.append(sample.rttSample)
+            self.m_queueDelay = max(0.0, min(self.m_rttSamples) - self.m_minRtt)
+            self.UpdateDelayCwnd(sample.numAcked)
+        self.UpdateCwnd()
+        logging.debug("[Delay-CC] queueDelay: %f target: %f cWnd: %f slowStart: %s Estimated-BW: %f Current-Max-Bw: %f" \
+            % (self.m_queueDelay, self.m_targetQueueDelay, self.m_delayCWnd, self.m_slowStart, self.m_estBw, self.m_estBwMax))
+
+    def OnLossDetected(self, currentTime, numRandomLoss, numCongestiveLoss, rtt) :
+        lastBackoffTime = self.m_lastBackoffTime
+        CongestionController.OnLossDetected(self, currentTime, numRandomLoss, numCongestiveLoss, rtt)
+        # The queue has overflowed past the target, back off cWnd itself instead of the rate factor
+        if self.m_lastBackoffTime != lastBackoffTime :
+            self.m_slowStart = False
+            self.m_delayCWnd = max(self.m_delayCWnd * CongestionBackoffFactor, DelayMinCWnd)
+            self.UpdateCwnd()
+        self.m_rateFactor = 1.0
+
+    def OnEcnMarked(self, currentTime, numMarked, numAcked, rtt) :
+        rateFactor = self.m_rateFactor
+        CongestionController.OnEcnMarked(self, currentTime, numMarked, numAcked, rtt)
+        # As for congestive losses, the backoff is applied to cWnd itself
+        if self.m_rateFactor < rateFactor :
+            self.m_slowStart = False
+            self.m_delayCWnd = max(self.m_delayCWnd * self.m_rateFactor / rateFactor, DelayMinCWnd)
+            self.UpdateCwnd()
+        self.m_rateFactor = 1.0
+
+    def OnBwProbe(self, currentTime, probeBw, sample) :
+        self.m_probeBw = probeBw
+        self.m_estBw = probeBw * 0.8
+        self.m_maxBwFilter.Insert(currentTime, self.m_estBw)
+        # Start from the probed BDP rather than growing from the initial window over long RTTs
+        if self.m_slowStart and sample.rttMin != 1e6 :
+            self.m_minRtt = sample.rttMin
+            self.m_delayCWnd = max(self.m_delayCWnd, self.m_estBw * self.m_minRtt)
+        self.UpdateCwnd()
+
+    def OnDispersionSample(self, currentTime, bw, sample) :
+        # Only bounds cWnd, the queue delay decides how much of the capacity is used
+        self.m_maxBwFilter.Insert(currentTime, bw * DispersionGain)
+        self.UpdateCwnd()
+
+    def UpdateBw(self, sample) :
+        bw = sample.DeliveryRate()
+        filteredBw = self.m_ackAggregation.FilteredBw()
+        if filteredBw is not None :
+            bw = filteredBw
+        elif self.m_ackAggregation.IsAggregated() :
+            return
+        if bw > 0 :
+            self.m_estBw = bw
+            self.m_maxBwFilter.Insert(sample.ackTime, bw)
+
+    def UpdateDelayCwnd(self, numAcked) :
+        target = self.m_targetQueueDelay
+        if self.m_slowStart :
+            if self.m_queueDelay < target / 2 :
+                self.m_delayCWnd += numAcked
+                return
+            self.m_slowStart = False
+        offTarget = (target - self.m_queueDelay) / target
+        if offTarget >= 0 :
+            self.m_delayCWnd += DelayGain * offTarget * numAcked / self.m_delayCWnd
+        else :
+            self.m_delayCWnd += max(offTarget, -1.0) * DelayDecreaseRate * numAcked
+        # Do not run away from the delivery rate when the sender is app-limited
+        if self.m_estBwMax > 0 :
+            self.m_delayCWnd = min(self.m_delayCWnd, 2 * self.m_estBwMax * (self.m_minRtt + target) + self.m_initCWnd)
+        self.m_delayCWnd = max(self.m_delayCWnd, DelayMinCWnd)
+
+    def UpdateCwnd(self) :
+        self.m_estBwMax = self.m_probeBw * 0.8 if self.m_maxBwFilter.IsEmpty() else self.m_maxBwFilter.GetMaxBw()
+        if self.m_constBw :
+            self.m_cWnd = math.floor(max(self.m_initCWnd, self.m_constBw * self.m_minRtt)) if self.m_minRtt != 1e6 else self.m_initCWnd
+            self.m_pacing = True
+            self.m_pacingRate = self.m_constBw * self.m_packetSize
+            return
+        cWnd = self.m_delayCWnd
+        if self.m_maxAllowedBw and self.m_minRtt != 1e6 :
+            cWnd = min(cWnd, self.m_maxAllowedBw * (self.m_minRtt + self.m_targetQueueDelay))
+        self.m_cWnd = math.floor(max(cWnd, DelayMinCWnd))
+        if self.m_minRtt == 1e6 :
+            self.m_pacing = False
+            return
+        self.m_pacing = True
+        self.m_pacingRate = cWnd / (self.m_minRtt + self.m_targetQueueDelay) * self.m_packetSize
+        if self.m_slowStart :
+            # Let slow start reach the next window within one RTT
+            self.m_pacingRate *= 2
+
+    def __str__(self) :
+        return CongestionController.__str__(self) + " queueDelay: %f target: %f slowStart: %s minRtt: %f" \
+            % (self.m_queueDelay, self.m_targetQueueDelay, self.m_slowStart, self.m_minRtt)
+
+
+# Congestion controllers selectable by --congestionControl
+CongestionControllers = {
+                JerseyController.name : JerseyController,
+                BBRController.name    : BBRController,
+                DelayController.name  : DelayController,
+}
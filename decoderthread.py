@@ -0,0 +1,108 @@
+import queue
+import logging
+import threading
+
+from collections import deque
+
+from protocol    import DecoderQueueLength
+
+
+class DecoderEvent :
+    """ A change of the decoder state the I/O loop reacts to: activation by a loss, inactivation
+        after decoding, or in-order delivery advanced by more than one packet
+    """
+    __slots__ = ('oldState', 'newState', 'oldInorder', 'newInorder', 'repairId', 'receiveTime')
+
+    def __init__(self, oldState, newState, oldInorder, newInorder, repairId, receiveTime) :
+        self.oldState    = oldState
+        self.newState    = newState
+        self.oldInorder  = oldInorder
+        self.newInorder  = newInorder
+        self.repairId    = repairId
+        self.receiveTime = receiveTime
+
+
+class DecoderThread(threading.Thread) :
+    """ Owns the streamc Decoder, so that Gaussian elimination over a large window does not stall
+        the I/O loop: ctypes releases the GIL during receive_packet(). Serialized packets come in
+        through a bounded queue and are deserialized here too, as deserialize_packet() draws the
+        coding coefficients from the PRNG of the decoder, and after each one the decoder state is
+        published as plain members (inorder last, so that recovered payloads up to it are complete)
+        together with DecoderEvents.
+        With threaded=False packets are decoded inline on Submit(), as before.
+    """
+    def __init__(self, dec, threaded=True) :
+        threading.Thread.__init__(self, name='decoder', daemon=True)
+        self.m_dec      = dec
+        self.m_threaded = threaded
+        self.m_input    = queue.Queue(maxsize=DecoderQueueLength)
+        self.m_events   = deque()
+
+        # published decoder state
+        self.m_active   = dec.active
+        self.m_winS     = dec.winS
+        self.m_winE     = dec.winE
+        self.m_dof      = dec.dof
+        self.m_inorder  = dec.inorder
+        self.m_numDecoded = 0
+
+    def Submit(self, data, receiveTime) :
+        """ Hand a serialized packet (class 'bytes') over to the decoder
+        """
+        if self.m_threaded :
+            self.m_input.put((data, receiveTime))
+        else :
+            self.Decode(data, receiveTime)
+
+    def run(self) :
+        while True :
+            item = self.m_input.get()
+            if item is None :
+                break
+            self.Decode(*item)
+
+    def Decode(self, data, receiveTime) :
+        dec = self.m_dec
+        oldState, oldInorder = dec.active, dec.inorder
+
+        sourceId, repairId, winS, winE = dec.Receive(data)
+
+        newState, newInorder = dec.active, dec.inorder
+        self.m_active = newState
+        self.m_winS   = dec.winS
+        self.m_winE   = dec.winE
+        self.m_dof    = dec.dof
+        self.m_inorder = newInorder
+        self.m_numDecoded += 1
+
+        if oldState != newState or newInorder - oldInorder > 1 :
+            self.m_events.append(DecoderEvent(oldState, newState, oldInorder, newInorder, repairId, receiveTime))
+
+        if logging.getLogger().isEnabledFor(logging.DEBUG) :
+            log = "[DecoderStatus] inorder: %d" % newInorder
+            log += " SOURCE packet %d" % sourceId if sourceId != -1 else " REPAIR packet %d" % repairId
+            if repairId != -1 :
+                log += " encoding window: [ %d , %d ]" % (winS, winE)
+            if newState :
+                log += " current decoder state: active with window: [ %d , %d ]" % (self.m_winS, self.m_winE)
+            else :
+                log += " current decoder state: inactive"
+            logging.debug(log)
+
+            # Record the time of decoding source packets
+            for i in range(oldInorder+1, newInorder+1) :
+                logging.debug("[RecvDataPacket] Receive SOURCE packet %d" % i)
+
+    def PopEvent(self) :
+        return self.m_events.popleft() if self.m_events else None
+
+    def Payload(self, sourceId) :
+        """ Payload of an in-order source packet (a memoryview over decoder memory), valid for ids
+            up to m_inorder, None if there is none
+        """
+        return self.m_dec.Recovered(sourceId)
+
+    def Stop(self) :
+        if self.m_threaded and self.is_alive() :
+            self.m_input.put(None)
+            self.join()
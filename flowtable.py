@@ -0,0 +1,51 @@
+from admission import FlowCodel
+
+
+class Flow :
+    """ State of one intercepted TCP connection, between the neighbor TCP Point of this PEPesc
+        and the remote TCP Point behind the peer PEPesc
+    """
+    __slots__ = ('neighbor', 'remote', 'chid', 'tcpReceiver', 'sentBufLen', 'recvBufLen', 'toBeClosedLen', 'codel')
+
+    def __init__(self, neighbor, remote) :
+        self.neighbor      = neighbor   # neighbor TCP Point address tuple (ip, port)
+        self.remote        = remote     # remote TCP Point address tuple (ip, port)
+        self.chid          = -1         # id of the channel with the neighbor, -1 until it is open
+        self.tcpReceiver   = None       # intercepted socket waiting for the peer PEPesc to connect the remote
+        self.sentBufLen    = 0          # length of TCP data from the neighbor enqueued to the peer PEPesc
+        self.recvBufLen    = 0          # length of TCP data from the peer PEPesc queued to the neighbor
+        self.toBeClosedLen = -1         # length the peer PEPesc reported when the remote exited, close after receiving it all
+        self.codel         = FlowCodel()    # ingress AQM, pauses reading from the neighbor while its data queues too long
+
+    def __str__(self) :
+        return "{%s:%d -> %s:%d} chid: %d sent: %d recv: %d" \
+            % (self.neighbor[0], self.neighbor[1], self.remote[0], self.remote[1], self.chid, self.sentBufLen, self.recvBufLen)
+
+
+class FlowTable :
+    """ All intercepted TCP connections, keyed by (neighbor ip, neighbor port, remote ip, remote port)
+    """
+    def __init__(self) :
+        self.m_flows = {}
+
+    def Key(self, neighbor, remote) :
+        return (neighbor[0], neighbor[1], remote[0], remote[1])
+
+    def Add(self, neighbor, remote) :
+        flow = Flow(neighbor, remote)
+        self.m_flows[self.Key(neighbor, remote)] = flow
+        return flow
+
+    def Find(self, neighbor, remote) :
+        """ Return the flow, None if there is none
+        """
+        return self.m_flows.get(self.Key(neighbor, remote))
+
+    def Remove(self, flow) :
+        self.m_flows.pop(self.Key(flow.neighbor, flow.remote), None)
+
+    def __len__(self) :
+        return len(self.m_flows)
+
+    def __iter__(self) :
+        return iter(list(self.m_flows.values()))
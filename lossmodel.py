@@ -0,0 +1,247 @@
+import math
+
+from protocol import DeliveryDelayPercentile, RepairWindowDelay, MinRepairWindowLength, MaxRepairWindowLength, \
+                     MaxRepairsPerWindow, LossModelUpdateInterval, LossModelForgetFactor, ExtraRepairRate, \
+                     CongestionRttInflation, CongestionMinQueueDelay, CongestionRateDrop
+
+
+class GilbertElliottEstimator :
+    """ Two-state (Gilbert-Elliott) loss model fitted online from the ACK stream.
+        The channel is either in the good state G or the bad state B, each with its own
+        loss probability (g, h). Transitions G->B and B->G happen with probability p and r
+        per packet. The parameters are re-estimated with exponentially forgotten soft counts
+        derived from the forward (filtered) state belief, i.e. a light-weight online EM.
+    """
+    def __init__(self, forgetFactor=LossModelForgetFactor) :
+        self.m_forget = forgetFactor
+
+        # model parameters
+        self.m_p = 0.01         # P(G -> B)
+        self.m_r = 0.2          # P(B -> G)
+        self.m_g = 0.001        # loss probability in G
+        self.m_h = 0.5          # loss probability in B
+
+        # belief of being in B after the latest observed packet
+        self.m_belief = 0.0
+
+        # soft counts (with forgetting) of transitions and emissions
+        self.m_nGG, self.m_nGB = 99.0, 1.0
+        self.m_nBG, self.m_nBB = 1.0, 4.0
+        self.m_lossInG, self.m_numInG = 0.1, 100.0
+        self.m_lossInB, self.m_numInB = 2.5, 5.0
+
+        self.m_observed = 0     # number of packets observed
+        self.m_lost     = 0     # number of packets observed lost
+        self.m_numBursts = 0    # number of bursts advertised by the receiver
+
+    def Observe(self, lost) :
+        """ Feed the outcome of one packet (True if lost) into the model
+        """
+        p, r, g, h, b = self.m_p, self.m_r, self.m_g, self.m_h, self.m_belief
+        likeG, likeB = (g, h) if lost else (1 - g, 1 - h)
+
+        # joint probability of (previous state, current state, outcome)
+        xiGG = (1 - b) * (1 - p) * likeG
+        xiGB = (1 - b) * p * likeB
+        xiBG = b * r * likeG
+        xiBB = b * (1 - r) * likeB
+        z = xiGG + xiGB + xiBG + xiBB
+        if z <= 0 :
+            return
+        xiGG, xiGB, xiBG, xiBB = xiGG / z, xiGB / z, xiBG / z, xiBB / z
+        postB = xiGB + xiBB
+
+        f = self.m_forget
+        self.m_nGG = self.m_nGG * f + xiGG
+        self.m_nGB = self.m_nGB * f + xiGB
+        self.m_nBG = self.m_nBG * f + xiBG
+        self.m_nBB = self.m_nBB * f + xiBB
+        self.m_numInG  = self.m_numInG * f + (1 - postB)
+        self.m_numInB  = self.m_numInB * f + postB
+        self.m_lossInG = self.m_lossInG * f + (1 - postB) * lost
+        self.m_lossInB = self.m_lossInB * f + postB * lost
+
+        self.m_belief = postB
+        self.m_observed += 1
+        self.m_lost += 1 if lost else 0
+
+    def OnAck(self, numLost, numReceived) :
+        """ An ACK reports numLost newly lost packets followed by numReceived received ones
+        """
+        for i in range(max(0, numLost)) :
+            self.Observe(True)
+        for i in range(max(0, numReceived)) :
+            self.Observe(False)
+
+    def OnBurstAdvertised(self, burstTime, burstLength) :
+        """ The receiver reports a run of burstLength missing ids, ended by a received one. The ACKs
+            covering them only attribute the losses to B as far as the belief goes, the burst says
+            they were all spent in B: count its transitions and losses in B as certain.
+        """
+        if burstLength <= 0 :
+            return
+        self.m_nBB     += burstLength - 1
+        self.m_nBG     += 1
+        self.m_numInB  += burstLength
+        self.m_lossInB += burstLength
+        self.m_numBursts += 1
+
+    def Refit(self) :
+        """ Re-estimate the parameters from the soft counts
+        """
+        clamp = lambda x : min(max(x, 1e-4), 1 - 1e-4)
+        self.m_p = clamp(self.m_nGB / (self.m_nGG + self.m_nGB))
+        self.m_r = clamp(self.m_nBG / (self.m_nBG + self.m_nBB))
+        self.m_g = clamp(self.m_lossInG / self.m_numInG)
+        self.m_h = clamp(self.m_lossInB / self.m_numInB)
+        # Keep B the lossy state, otherwise the two states may swap their meaning
+        if self.m_h < self.m_g :
+            self.m_h = self.m_g
+
+    def StationaryBadProbability(self) :
+        return self.m_p / (self.m_p + self.m_r)
+
+    def AverageLossRate(self) :
+        piB = self.StationaryBadProbability()
+        return (1 - piB) * self.m_g + piB * self.m_h
+
+    def MeanBurstLength(self) :
+        """ Expected number of consecutive packets spent in B
+        """
+        return 1 / self.m_r
+
+    def PredictBadProbability(self, lag) :
+        """ Probability of being in B lag packets after the latest observed one
+        """
+        piB = self.StationaryBadProbability()
+        return piB + (self.m_belief - piB) * (1 - self.m_p - self.m_r) ** max(lag, 0)
+
+    def LossTailProbabilities(self, windowLength, maxRepairs) :
+        """ For k in [0, maxRepairs], return the probabilities that more than k packets are lost
+            among windowLength+k consecutive packets, starting from G and starting from B respectively.
+        """
+        p, r, g, h = self.m_p, self.m_r, self.m_g, self.m_h
+        size = maxRepairs + 2       # loss counts above maxRepairs+1 are lumped together
+        tails = []
+        for startB in (False, True) :
+            # distG[l] / distB[l]: probability of l losses so far and being in G / B
+            distG = [0.0] * size
+            distB = [0.0] * size
+            if startB :
+                distB[0] = 1.0
+            else :
+                distG[0] = 1.0
+            tail = []
+            for n in range(1, windowLength + maxRepairs + 1) :
+                newG = [0.0] * size
+                newB = [0.0] * size
+                for l in range(size) :
+                    if distG[l] == 0.0 and distB[l] == 0.0 :
+                        continue
+                    # state of the n-th packet
+                    toG = distG[l] * (1 - p) + distB[l] * r
+                    toB = distG[l] * p + distB[l] * (1 - r)
+                    lostL = min(l + 1, size - 1)
+                    newG[l]     += toG * (1 - g)
+                    newG[lostL] += toG * g
+                    newB[l]     += toB * (1 - h)
+                    newB[lostL] += toB * h
+                distG, distB = newG, newB
+                k = n - windowLength
+                if k >= 0 :
+                    tail.append(max(0.0, 1.0 - sum(distG[0 : k+1]) - sum(distB[0 : k+1])))
+            tails.append(tail)
+        return tails[0], tails[1]
+
+    def __str__(self) :
+        return "p: %f r: %f g: %f h: %f belief: %f meanBurst: %f lossRate: %f advertisedBursts: %d" \
+            % (self.m_p, self.m_r, self.m_g, self.m_h, self.m_belief, self.MeanBurstLength(), self.AverageLossRate(), self.m_numBursts)
+
+
+class RepairScheduler :
+    """ Decide how many repair packets to insert and how to space them, such that the
+        chosen percentile of in-order delivery delay stays within the repair window,
+        i.e. at most windowLength+k packets are needed to recover a window of source packets.
+    """
+    def __init__(self, lossModel, percentile=DeliveryDelayPercentile) :
+        self.m_lossModel  = lossModel
+        self.m_percentile = percentile
+
+        self.m_windowLength = 128           # repair window (source packets)
+        self.m_tailG        = []
+        self.m_tailB        = []
+        self.m_lastUpdateTime = -1.0
+
+        # current decision
+        self.m_repairFreq    = ExtraRepairRate
+        self.m_repairSpacing = 0            # min. source packets between two repair packets
+
+    def Update(self, currentTime, estBw, lag, burstAvoid=False) :
+        """ Refit the model periodically and recompute the repair frequency for packets sent now.
+            estBw is in pkts/sec., lag is the number of packets sent after the latest observed one.
+        """
+        if currentTime - self.m_lastUpdateTime >= LossModelUpdateInterval :
+            self.m_lastUpdateTime = currentTime
+            self.m_lossModel.Refit()
+            windowLength = round(RepairWindowDelay * estBw) if estBw > 0 else self.m_windowLength
+            # A window must be able to hold a burst together with the source packets around it
+            windowLength = max(windowLength, math.ceil(4 * self.m_lossModel.MeanBurstLength()))
+            self.m_windowLength = min(max(windowLength, MinRepairWindowLength), MaxRepairWindowLength)
+            self.m_tailG, self.m_tailB = self.m_lossModel.LossTailProbabilities(self.m_windowLength, MaxRepairsPerWindow)
+
+        if not self.m_tailG :
+            return
+
+        # Within the burst-avoid period after an advertised burst, protect as if in B
+        belief = 1.0 if burstAvoid else self.m_lossModel.PredictBadProbability(lag)
+        k = MaxRepairsPerWindow
+        for i in range(MaxRepairsPerWindow + 1) :
+            if (1 - belief) * self.m_tailG[i] + belief * self.m_tailB[i] <= 1 - self.m_percentile :
+                k = i
+                break
+
+        self.m_repairFreq = max(k / (self.m_windowLength + k), ExtraRepairRate)
+        # Spread repair packets over a burst, so that one burst does not wipe out consecutive repairs
+        spacing = math.floor(1 / self.m_repairFreq) - 1
+        self.m_repairSpacing = max(0, min(math.ceil(self.m_lossModel.MeanBurstLength()), spacing))
+
+    def RepairFrequency(self) :
+        return self.m_repairFreq
+
+    def RepairSpacing(self) :
+        return self.m_repairSpacing
+
+    def WindowLength(self) :
+        return self.m_windowLength
+
+
+class LossClassifier :
+    """ Tell random (link erasure) losses from congestive (bottleneck queue overflow) losses.
+        A loss is congestive if the RTT of the ACK revealing it is inflated against the minimum RTT,
+        together with a drop of delivery rate or a large inflation. Congestive losses are left for
+        the congestion controller to back off; only random losses are covered by repair packets.
+    """
+    def __init__(self) :
+        self.m_congestiveLosses = 0
+        self.m_randomLosses     = 0
+
+    def Classify(self, numLost, rttSample, rttMin, estBw, estBwMax) :
+        """ Return the number of random losses among numLost
+        """
+        if numLost <= 0 :
+            return 0
+        
+        queueDelay = rttSample - rttMin
+        threshold  = max(CongestionRttInflation * rttMin, CongestionMinQueueDelay)
+        inflated    = queueDelay > threshold
+        rateDropped = estBwMax > 0 and estBw < CongestionRateDrop * estBwMax
+        
+        if inflated and (rateDropped or queueDelay > 2 * threshold) :
+            self.m_congestiveLosses += numLost
+            return 0
+        
+        self.m_randomLosses += numLost
+        return numLost
+
+    def __str__(self) :
+        return "congestiveLosses: %d randomLosses: %d" % (self.m_congestiveLosses, self.m_randomLosses)
@@ -0,0 +1,397 @@
+#This file implements the streaming code of libstreamc.so in Python and NumPy, packet for packet
+#compatible with it: same serialize_packet() layout, same GF(2^8) field and same MT19937 coefficients
+import struct
+
+import numpy as np
+
+from protocol import SeqWrap, SeqUnwrap
+from pystreamc import DEC_ALLOC
+
+# GF(2^8) with the primitive polynomial of libstreamc, x^8 + x^4 + x^3 + x^2 + 1
+GfPrimitivePoly = 0x11d
+# log(0) is GfLogZero, beyond which exp() is 0: a product with 0 then needs no branch
+GfLogZero = 512
+
+# Coefficients of a repair packet are drawn from MT19937 seeded with repair id * RepairSeedFactor
+RepairSeedFactor = 100
+# A repair packet is encoded over at most this many source packets at a time, to bound temporary arrays
+EncodeChunkLength = 64
+# From this many source packets on, a repair packet is encoded bit by bit of its coefficients over 64-bit
+# words, rather than with one lookup per byte
+BitSlicedMinLength = 64
+# Packet buffer of a new encoder, doubled when full
+EncoderInitBufSize = 64
+# Span of source ids of the decoding matrices of a new decoder, doubled when outgrown
+DecoderInitSpan = 256
+
+SerializedHeaderFormat = 'iiii'     # sourceid, repairid, win_s, win_e
+SerializedHeaderLength = struct.calcsize(SerializedHeaderFormat)
+
+
+def BuildTables() :
+    exp = np.zeros(2 * GfLogZero + 1, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.uint16)
+    x = 1
+    for i in range(255) :
+        exp[i] = x
+        log[x] = i
+        x <<= 1
+        if x & 0x100 :
+            x ^= GfPrimitivePoly
+    exp[255:510] = exp[0:255]
+    log[0] = GfLogZero
+    return exp, log
+
+
+GfExp, GfLog = BuildTables()
+# Products of all pairs, for multiplying a region by a scalar with one lookup
+GfMul = GfExp[GfLog[:, None] + GfLog[None, :]]
+GfInv = np.zeros(256, dtype=np.uint8)
+GfInv[1:] = GfExp[255 - GfLog[1:]]
+
+
+def Coefficients(prng, repairId, width) :
+    """ Coefficients of a repair packet over width source packets, as libstreamc draws them
+    """
+    prng.seed((repairId * RepairSeedFactor) & 0xffffffff)
+    return (prng.randint(0, 2**32, size=width, dtype=np.uint32) & 0xff).astype(np.uint8)
+
+
+def SymbolWidth(pktsize) :
+    """ Bytes a symbol of pktsize bytes is stored in, whole 64-bit words
+    """
+    return -(-pktsize // 8) * 8
+
+
+def MultiplyAdd(coes, symbols) :
+    """ Sum over i of coes[:, i] * symbols[i] for a matrix of coefficients (packets x window) and
+        the symbols of the window (window x symbol bytes). Over a short window, one lookup per byte
+        in the rows of GfMul of the coefficients, laid end to end, then a XOR across the window;
+        over a long one, with symbols of whole 64-bit words, bit-sliced (see MultiplyAddBitSliced())
+    """
+    if coes.shape[1] >= BitSlicedMinLength and symbols.shape[1] % 8 == 0 :
+        return MultiplyAddBitSliced(coes, symbols)
+    result = np.zeros((coes.shape[0], symbols.shape[1]), dtype=np.uint8)
+    for i in range(0, coes.shape[1], EncodeChunkLength) :
+        chunk = coes[:, i:i+EncodeChunkLength]
+        offsets = np.arange(chunk.size, dtype=np.intp).reshape(chunk.shape + (1,)) * 256
+        products = np.take(GfMul[chunk].ravel(), symbols[i:i+EncodeChunkLength] + offsets)
+        result ^= np.bitwise_xor.reduce(products, axis=1)
+    return result
+
+
+def TimesX(words) :
+    """ Each byte of 64-bit words multiplied by x in GF(2^8)
+    """
+    carry = (words >> np.uint64(7)) & np.uint64(0x0101010101010101)
+    return ((words << np.uint64(1)) & np.uint64(0xfefefefefefefefe)) ^ (carry * np.uint64(GfPrimitivePoly & 0xff))
+
+
+def MultiplyAddBitSliced(coes, symbols) :
+    """ MultiplyAdd() by Horner's rule over the bits of the coefficients: the XOR of the symbols
+        whose coefficient has a bit set, times x, and so on down to bit 0, over 64-bit words,
+        i.e. eight XOR reductions across the window instead of a lookup per byte
+    """
+    words = symbols.view(np.uint64)
+    result = np.zeros((coes.shape[0], words.shape[1]), dtype=np.uint64)
+    for j in range(coes.shape[0]) :
+        for bit in range(7, -1, -1) :
+            result[j] = TimesX(result[j])
+            selected = (coes[j] >> bit) & 1 != 0
+            if selected.any() :
+                result[j] ^= np.bitwise_xor.reduce(words[selected], axis=0)
+    return result.view(np.uint8)
+
+
+class SerializedPacket :
+    """ A coded packet serialized as serialize_packet() lays it out, with the interface of
+        pystreamc.SerializedPacket. Its memory is Python's, Free() only ends the View().
+    """
+    __slots__ = ('sourceId', 'repairId', 'winS', 'winE', 'm_data')
+
+    def __init__(self, sourceId, repairId, winS, winE, symbol) :
+        self.sourceId = sourceId
+        self.repairId = repairId
+        self.winS     = winS
+        self.winE     = winE
+        self.m_data   = np.empty(SerializedHeaderLength + len(symbol), dtype=np.uint8)
+        struct.pack_into(SerializedHeaderFormat, self.m_data, 0, SeqWrap(sourceId), SeqWrap(repairId), SeqWrap(winS), SeqWrap(winE))
+        self.m_data[SerializedHeaderLength:] = symbol
+
+    def View(self) :
+        return memoryview(self.m_data)
+
+    def Free(self) :
+        self.m_data = None
+
+
+class Encoder :
+    """ Sliding-window encoder with the interface of pystreamc.Encoder. Source packets are kept in
+        a ring of rows indexed by source id, so that a repair packet is encoded as a handful of
+        vectorized operations over the window. Ids count from sourceBase and repairBase, coefficients
+        are drawn from the repair id counted from repairBase, as libstreamc.so counts it.
+    """
+    RepairCapable = True
+
+    def __init__(self, cp, sourceBase=0, repairBase=0) :
+        if cp.gfpower != 8 :
+            raise ValueError("Only GF(2^8) is implemented, gfpower %d requested" % cp.gfpower)
+        self.m_pktsize  = cp.pktsize
+        self.m_bufsize  = EncoderInitBufSize
+        self.m_symbols  = np.zeros((self.m_bufsize, SymbolWidth(self.m_pktsize)), dtype=np.uint8)
+        self.m_prng     = np.random.RandomState(0)
+        self.count      = 0
+        self.sourceBase = sourceBase
+        self.repairBase = repairBase
+        self.nextsid    = sourceBase
+        self.rcount     = repairBase
+        self.headsid    = -1
+        self.tailsid    = -1
+
+    def Grow(self) :
+        bufsize = 2 * self.m_bufsize
+        symbols = np.zeros((bufsize, self.m_symbols.shape[1]), dtype=np.uint8)
+        ids = np.arange(self.headsid, self.tailsid + 1)
+        symbols[ids % bufsize] = self.m_symbols[ids % self.m_bufsize]
+        self.m_bufsize, self.m_symbols = bufsize, symbols
+
+    def Enqueue(self, sourceId, data) :
+        """ Append a source packet: a bytes-like object of pktsize bytes
+        """
+        if self.headsid == -1 :
+            self.headsid = sourceId
+        elif sourceId - self.headsid >= self.m_bufsize :
+            self.Grow()
+        self.tailsid = sourceId
+        self.m_symbols[sourceId % self.m_bufsize, :self.m_pktsize] = np.frombuffer(data, dtype=np.uint8, count=self.m_pktsize)
+        return 0
+
+    def OutputSource(self) :
+        """ The next source packet as a SerializedPacket, None if all are output
+        """
+        if self.headsid == -1 or self.nextsid > self.tailsid :
+            return None
+        packet = SerializedPacket(self.nextsid, -1, 0, 0, self.m_symbols[self.nextsid % self.m_bufsize, :self.m_pktsize])
+        self.count   += 1
+        self.nextsid += 1
+        return packet
+
+    def RepairWindow(self, windowLength) :
+        if windowLength is None :
+            return self.headsid, self.nextsid if self.headsid == self.nextsid else self.nextsid - 1
+        return max(self.nextsid - windowLength, self.headsid), self.nextsid - 1 if self.headsid < self.nextsid else self.nextsid
+
+    def OutputRepair(self, windowLength=None) :
+        """ A repair packet over the last windowLength source packets output, or over all
+            unacknowledged ones, as a SerializedPacket
+        """
+        winS, winE = self.RepairWindow(windowLength)
+        coes = Coefficients(self.m_prng, self.rcount - self.repairBase, winE - winS + 1)
+        symbol = MultiplyAdd(coes[None, :], self.m_symbols[np.arange(winS, winE + 1) % self.m_bufsize])[0]
+        packet = SerializedPacket(-1, self.rcount, winS, winE, symbol[:self.m_pktsize])
+        self.count  += 1
+        self.rcount += 1
+        return packet
+
+    def Flush(self, inorder) :
+        if inorder < self.headsid :
+            return
+        if inorder == self.tailsid :
+            self.headsid, self.tailsid = -1, -1
+        else :
+            self.headsid = inorder + 1
+
+    def Free(self) :
+        self.m_symbols = None
+
+
+class Decoder :
+    """ Sliding-window decoder with the interface of pystreamc.Decoder. Received and decoded
+        source packets are kept in a table of capacity rows. Pending equations are the rows of a
+        coefficient matrix and a symbol matrix, preallocated and indexed by slot (id modulo their
+        size) over the span of ids not decoded in order yet: the row of a source id is its equation
+        while it is a pivot, with a coefficient 1 for it, 0 for every other pivot and every known
+        source packet (Gauss-Jordan form). A repair packet is reduced by the known source packets
+        and the pivot rows, and its first unknown id becomes a pivot, eliminated from the other
+        rows at once; a source packet that becomes known is eliminated from the rows it appears
+        in. Each step is a few vectorized operations over the rows, and a source packet is
+        recovered as soon as its row has no other coefficient left. The matrices are regrown
+        (doubled, up to capacity) when the span outgrows them. Received ids are unwrapped to
+        those of an Encoder counting from sourceBase and repairBase.
+    """
+    def __init__(self, cp, capacity=DEC_ALLOC, sourceBase=0, repairBase=0) :
+        if cp.gfpower != 8 :
+            raise ValueError("Only GF(2^8) is implemented, gfpower %d requested" % cp.gfpower)
+        self.m_pktsize   = cp.pktsize
+        self.m_width     = SymbolWidth(cp.pktsize)
+        self.capacity    = capacity
+        self.m_recovered = np.zeros((capacity, self.m_width), dtype=np.uint8)
+        self.m_slotIds   = np.full(capacity, -1, dtype=np.int64)
+        self.m_span      = min(DecoderInitSpan, capacity)
+        self.m_coes      = np.zeros((self.m_span, self.m_span), dtype=np.uint8)
+        self.m_symbols   = np.zeros((self.m_span, self.m_width), dtype=np.uint8)
+        self.m_isPivot   = np.zeros(self.m_span, dtype=bool)
+        self.m_pivots    = set()
+        self.m_prng      = np.random.RandomState(0)
+        self.sourceBase  = sourceBase
+        self.repairBase  = repairBase
+        self.m_maxSeen   = sourceBase - 1
+        self.m_maxRepairId = repairBase - 1
+        self.inorder     = sourceBase - 1
+
+    @property
+    def active(self) :
+        return 1 if self.m_maxSeen > self.inorder else 0
+
+    @property
+    def winS(self) :
+        return min(self.m_pivots) if self.m_pivots else self.inorder + 1
+
+    @property
+    def winE(self) :
+        return self.m_maxSeen
+
+    @property
+    def dof(self) :
+        return len(self.m_pivots)
+
+    def Known(self, sourceId) :
+        return self.m_slotIds[sourceId % self.capacity] == sourceId
+
+    def Fit(self, sourceId) :
+        """ Grow the matrices so that their slots tell ids apart up to sourceId, False if beyond capacity
+        """
+        span = sourceId - self.inorder
+        if span <= self.m_span :
+            return True
+        if span > self.capacity :
+            return False
+        size = self.m_span
+        while size < span :
+            size *= 2
+        size = min(size, self.capacity)
+        ids = np.arange(self.inorder + 1, self.inorder + 1 + self.m_span)
+        old, new = ids % self.m_span, ids % size
+        coes = np.zeros((size, size), dtype=np.uint8)
+        coes[new[:, None], new[None, :]] = self.m_coes[old[:, None], old[None, :]]
+        symbols = np.zeros((size, self.m_width), dtype=np.uint8)
+        symbols[new] = self.m_symbols[old]
+        isPivot = np.zeros(size, dtype=bool)
+        isPivot[new] = self.m_isPivot[old]
+        self.m_span, self.m_coes, self.m_symbols, self.m_isPivot = size, coes, symbols, isPivot
+        return True
+
+    def SlotId(self, slots) :
+        """ Source ids of slots of the matrices
+        """
+        return self.inorder + 1 + (slots - (self.inorder + 1)) % self.m_span
+
+    def Receive(self, data) :
+        """ Decode a packet from a bytes-like object laid out by serialize_packet(),
+            return its (sourceid, repairid, win_s, win_e)
+        """
+        sourceId, repairId, winS, winE = struct.unpack_from(SerializedHeaderFormat, data)
+        symbol = np.zeros(self.m_width, dtype=np.uint8)
+        symbol[:self.m_pktsize] = np.frombuffer(data, dtype=np.uint8, count=self.m_pktsize, offset=SerializedHeaderLength)
+        if sourceId != -1 :
+            sourceId = SeqUnwrap(sourceId, self.inorder)
+            if sourceId > self.inorder and not self.Known(sourceId) :
+                self.m_maxSeen = max(self.m_maxSeen, sourceId)
+                self.Solve([(sourceId, symbol)], [])
+            return sourceId, repairId, winS, winE
+        repairId = SeqUnwrap(repairId, self.m_maxRepairId)
+        winS, winE = SeqUnwrap(winS, self.inorder), SeqUnwrap(winE, self.inorder)
+        if winE > self.inorder and winS > self.inorder - self.capacity and winS >= self.sourceBase and self.Fit(winE) :
+            self.m_maxSeen = max(self.m_maxSeen, winE)
+            self.m_maxRepairId = max(self.m_maxRepairId, repairId)
+            coes = Coefficients(self.m_prng, repairId - self.repairBase, winE - winS + 1)
+            ids = np.arange(winS, winE + 1)
+            known = self.m_slotIds[ids % self.capacity] == ids
+            if not known[ids <= self.inorder].all() :
+                # a slot of the window was taken by a later packet, the repair packet is of no use
+                return sourceId, repairId, winS, winE
+            known &= coes != 0
+            if known.any() :
+                symbol ^= MultiplyAdd(coes[known][None, :], self.m_recovered[ids[known] % self.capacity])[0]
+            unknown = ~known & (ids > self.inorder)
+            row = np.zeros(self.m_span, dtype=np.uint8)
+            row[ids[unknown] % self.m_span] = coes[unknown]
+            self.Solve([], [(row, symbol)])
+        return sourceId, repairId, winS, winE
+
+    def Solve(self, known, equations) :
+        """ Eliminate the source packets that became known, (id, symbol), and the new equations,
+            (row of coefficients by slot, symbol), until neither is left
+        """
+        coes, symbols, isPivot = self.m_coes, self.m_symbols, self.m_isPivot
+        while known or equations :
+            if known :
+                sourceId, symbol = known.pop()
+                if self.Known(sourceId) :
+                    continue
+                self.m_recovered[sourceId % self.capacity] = symbol
+                self.m_slotIds[sourceId % self.capacity] = sourceId
+                if sourceId - self.inorder > self.m_span :
+                    # beyond the span of the matrices, no equation involves it
+                    continue
+                slot = sourceId % self.m_span
+                if isPivot[slot] :
+                    # its equation now bears on the other unknown ids only
+                    row, rowSymbol = coes[slot].copy(), symbols[slot] ^ symbol
+                    row[slot] = 0
+                    self.DropPivot(slot)
+                    equations.append((row, rowSymbol))
+                    continue
+                rows = np.flatnonzero(coes[:, slot])
+                if len(rows) == 0 :
+                    continue
+                symbols[rows] ^= GfMul[coes[rows, slot][:, None], symbol[None, :]]
+                coes[rows, slot] = 0
+            else :
+                row, symbol = equations.pop()
+                # reduce by the pivot rows, each has no coefficient for the others
+                pivots = np.flatnonzero(isPivot & (row != 0))
+                if len(pivots) :
+                    factors = row[pivots][None, :]
+                    row ^= MultiplyAdd(factors, coes[pivots])[0]
+                    symbol ^= MultiplyAdd(factors, symbols[pivots])[0]
+                nonzero = np.flatnonzero(row)
+                if len(nonzero) == 0 :
+                    continue
+                # its first unknown id becomes a pivot
+                ids = self.SlotId(nonzero)
+                slot = int(nonzero[np.argmin(ids)])
+                inv = GfInv[row[slot]]
+                row, symbol = GfMul[inv][row], GfMul[inv][symbol]
+                rows = np.flatnonzero(coes[:, slot])
+                if len(rows) :
+                    factors = coes[rows, slot][:, None]
+                    coes[rows] ^= GfMul[factors, row[None, :]]
+                    symbols[rows] ^= GfMul[factors, symbol[None, :]]
+                coes[slot], symbols[slot] = row, symbol
+                isPivot[slot] = True
+                self.m_pivots.add(int(self.SlotId(slot)))
+                rows = np.append(rows, slot)
+            # rows left with their pivot alone are solved
+            solved = rows[np.count_nonzero(coes[rows], axis=1) == 1]
+            for slot in solved :
+                known.append((int(self.SlotId(slot)), symbols[slot].copy()))
+                self.DropPivot(slot)
+        while self.Known(self.inorder + 1) :
+            self.inorder += 1
+
+    def DropPivot(self, slot) :
+        self.m_coes[slot] = 0
+        self.m_isPivot[slot] = False
+        self.m_pivots.discard(int(self.SlotId(slot)))
+
+    def Recovered(self, sourceId) :
+        """ memoryview over the payload of a received or decoded source packet, None if there is none.
+            It is only valid until the slot is reused capacity source packets later.
+        """
+        if not self.Known(sourceId) :
+            return None
+        return memoryview(self.m_recovered[sourceId % self.capacity, :self.m_pktsize])
+
+    def Free(self) :
+        self.m_recovered, self.m_coes, self.m_symbols, self.m_pivots = None, None, None, set()
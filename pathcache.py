@@ -0,0 +1,73 @@
+import os
+import json
+import math
+import time
+import logging
+
+from protocol import PathCacheLifetime, PathCacheMaxRtt, PathCacheMaxLossRate, ScPacketSize
+
+
+class PathCache :
+    """ Path parameters learned with each peer PEPesc (probed and max. bandwidth in pkts/sec.
+        of packetSize bytes, min RTT in sec. and loss rate), kept in a JSON file across restarts
+        so that a new connection to a known peer starts near full rate instead of from the
+        initial window.
+        Entries older than PathCacheLifetime or out of range are ignored.
+    """
+    def __init__(self, fileName) :
+        self.m_fileName = fileName
+
+    def Key(self, peerAddress) :
+        return "%s:%d" % (peerAddress[0], peerAddress[1])
+
+    def ReadAll(self) :
+        try :
+            with open(self.m_fileName, 'r') as f :
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except FileNotFoundError :
+            return {}
+        except (OSError, ValueError) as details :
+            logging.warning("[PathCache] Cannot read %s: %s" % (self.m_fileName, details))
+            return {}
+
+    def Load(self, peerAddress) :
+        """ Return the valid entry of the peer, None if there is none
+        """
+        entry = self.ReadAll().get(self.Key(peerAddress))
+        if not isinstance(entry, dict) :
+            return None
+        try :
+            savedAt  = float(entry['savedAt'])
+            probeBw  = float(entry['probeBw'])
+            estBwMax = float(entry['estBwMax'])
+            rttMin   = float(entry['rttMin'])
+            lossRate = float(entry['lossRate'])
+            packetSize = int(entry.get('packetSize', ScPacketSize))     # entries saved before the symbol size was agreed
+        except (KeyError, TypeError, ValueError) :
+            return None
+
+        age = time.time() - savedAt
+        if not all(math.isfinite(x) for x in (probeBw, estBwMax, rttMin, lossRate)) \
+            or not 0 <= age <= PathCacheLifetime \
+                or estBwMax <= 0 or probeBw < 0 \
+                    or not 0 < rttMin <= PathCacheMaxRtt \
+                        or not 0 <= lossRate <= PathCacheMaxLossRate \
+                            or packetSize <= 0 :
+            logging.info("[PathCache] Ignore expired or invalid entry of %s: %s" % (self.Key(peerAddress), entry))
+            return None
+        return {'probeBw' : probeBw, 'estBwMax' : estBwMax, 'rttMin' : rttMin, 'lossRate' : lossRate, 'packetSize' : packetSize,
+                'age' : age}
+
+    def Save(self, peerAddress, probeBw, estBwMax, rttMin, lossRate, packetSize) :
+        entries = self.ReadAll()
+        entries[self.Key(peerAddress)] = {'savedAt' : time.time(), 'probeBw' : probeBw, 'estBwMax' : estBwMax,
+                                          'rttMin' : rttMin, 'lossRate' : lossRate, 'packetSize' : packetSize}
+        # Write to a temporary file first, so that a crash never leaves a truncated cache behind
+        tmpFileName = self.m_fileName + '.tmp'
+        try :
+            with open(tmpFileName, 'w') as f :
+                json.dump(entries, f, indent=1)
+            os.replace(tmpFileName, self.m_fileName)
+        except OSError as details :
+            logging.warning("[PathCache] Cannot write %s: %s" % (self.m_fileName, details))
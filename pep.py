@@ -12,10 +12,16 @@ import argparse
 
 from pickle      import dumps
 from collections import deque
-from ctypes      import sizeof, c_int, c_ubyte, string_at, byref, POINTER, cast
 
-from pystreamc   import DEC_ALLOC, parameters, streamc
-from channel     import CH_READ, CH_WRITE, OpenTcpListenChannel, OpenUdpChannel, OpenInConnChannel, OpenOutConnChannel, PollChannels, CloseChannel
+from pystreamc   import DEC_ALLOC, parameters, CodecBackend, CodecBackends, Codec, Codecs
+from lossmodel   import GilbertElliottEstimator, RepairScheduler, LossClassifier
+from congestion  import AckSample, RttEstimator, CongestionControllers
+from pathcache   import PathCache
+from admission   import AdmissionController
+from flowtable   import FlowTable
+from decoderthread import DecoderThread
+from repairthread  import RepairThread
+from channel     import CH_READ, CH_WRITE, SetMsgDataLength, OpenTcpListenChannel, OpenUdpChannel, OpenInConnChannel, OpenOutConnChannel, PollChannels, CloseChannel, CloseChannelWhenSent
 from protocol    import *
 
 import cProfile
@@ -100,34 +106,6 @@ class BwQueue :
         self.m_BwMaxQueue.append(newBw)
 
 
-class MaxBwFilter :
-    def __init__(self, roundPeriod) :
-        self.m_roundPeriod = roundPeriod
-        self.m_estTime     = deque()
-        self.m_BwQueue     = deque()
-        self.m_BwMaxQueue  = deque()
-    
-    def GetMaxBw(self) :
-        return self.m_BwMaxQueue[0]
-    
-    def IsEmpty(self) :
-        return (not len(self.m_BwQueue))
-
-    def Insert(self, newEstTime, newBw) :
-        self.m_estTime.append(newEstTime)
-        self.m_BwQueue.append(newBw)
-        
-        while self.m_estTime[0] <= newEstTime - self.m_roundPeriod :
-            if self.m_BwQueue[0] == self.m_BwMaxQueue[0] :
-                self.m_BwMaxQueue.popleft()
-            self.m_estTime.popleft()
-            self.m_BwQueue.popleft()
-        
-        while len(self.m_BwMaxQueue) != 0 and newBw > self.m_BwMaxQueue[-1] :
-            self.m_BwMaxQueue.pop()
-        self.m_BwMaxQueue.append(newBw)
-
-
 class pepApp :
     def __init__(self) :
         # Sockets
@@ -159,31 +137,45 @@ class pepApp :
         self.m_detailFlag   = False 
         self.m_maxAllowedBw = None
         self.m_constBw      = None
+        self.m_maxAllowedBps = None     # rate limits set by the user, in bits/sec. as packet sizes vary
+        self.m_constBps      = None
 
         # Channels for non-blocking IO
         self.m_channels      = {}       # Every TCP channel only serves one TCP connection，format：{channel id : channel}
         self.m_tcpListenChid = -1       # Channel's id used by tcpListener 
         self.m_udpChid       = -1       # Channel's id used by udpSocket 
         
-        self.m_findChidForPEPescToSend = {}    # 存储TCP连接使用的channel的id，格式：{(from ip, from port ,to ip, to port) : channel id}
-        self.m_tcpSentBufLen   = {}            # 存储每个neighbor已enqueue TCP数据长度，当TCP Client断开连接时，通知对端PEPesc此时的长度，对端接收并发送完整长度TCP数据至TCP Server后，关闭连接。格式：{(from ip, from port ,to ip, to port) : int}
-        self.m_tcpRecvBufLen   = {}            # 存储每个neighbor已接收TCP数据长度，对端PEPesc通知该连接即将关闭后，在发送完整TCP数据后，关闭与TCP Server的连接。格式：{(from ip, from port ,to ip, to port) : int}
-        self.m_linkToBeClosed  = {}            # 存储将要被关闭的连接中对端PEPesc通知的TCP数据长度，当发送完整TCP数据后，即刻关闭。格式：{(from ip, from port ,to ip, to port) : int}
+        # Intercepted TCP connections, including those waiting for the peer PEPesc to connect the remote
+        self.m_flows         = FlowTable()
         
         # Waiting for a connection to be established
-        self.m_tcpReceiverWaiting = {}
         self.m_tcpSenderWaiting   = {}
             
-        # Parameters used for streaming coding
-        self.m_cp           = parameters()
-        self.m_cp.gfpower   = 8
-        self.m_cp.pktsize   = PacketSize
-        self.m_cp.repfreq   = 0.0               # This Sc parameter is not used in PEP, where the frequency of sending repair packet is determine by TimeToSendRepairPacket
-        self.m_cp.seed      = 0
+        # Symbol size (bytes of TCP data per data packet) of each direction, agreed at handshake from the path MTU
+        self.m_tunnelMtu         = 0        # MTU of the tunnel set by the user, 0 to probe it
+        self.m_msgDataLength     = MsgDataMaxLength
+        self.m_recvMsgDataLength = MsgDataMaxLength
+        self.m_scPacketSize      = ScPacketSize     # bytes of a data packet sent, the unit of the rates in pkts/sec.
+        self.m_largestProbedMtu  = 0        # IP datagram size of the largest MTU_PROBE received from the peer
         
-        # initialize encoder and decoder
-        self.m_enc = streamc.initialize_encoder(byref(self.m_cp), None, 0)
-        self.m_dec = streamc.initialize_decoder(byref(self.m_cp))
+        # encoder and decoder, of the codecs agreed at handshake for each direction
+        self.m_enc = None
+        self.m_dec = None
+        self.m_encodeCodec = None
+        self.m_decodeCodec = None
+        self.m_decoder = None       # DecoderThread owning m_dec
+        self.m_repairThread = None  # RepairThread encoding repair packets ahead, its lock guards m_enc
+
+        # Decoder window and coding epochs: the source packets the decoder of the peer keeps, and the ids
+        # (source, repair) the encoder of the coding epoch being started counts from, until the peer rebases
+        self.m_decoderWindow     = 0        # window asked of the peer, set by the user, 0 for DecoderWindowBdpGain BDPs
+        self.m_askedDecoderWindow = DEC_ALLOC
+        self.m_peerDecoderWindow = DEC_ALLOC
+        self.m_cappedDecoderWindow = 0      # peer decoder window the BDP was last found to exceed
+        self.m_peerRebase        = False    # the peer understands REBASE
+        self.m_rebase            = None
+        self.m_lastRebaseTime    = 0.0
+        self.m_heldPayloads      = deque()  # payloads enqueued while the peer rebases, for the next encoder
         
         # Parameters used for repair packets selective sending
         self.m_lastSentSourceTime       = 0.0
@@ -196,7 +188,10 @@ class pepApp :
         self.m_duplicatedInorder        = False
         self.m_lastStuckInorder         = -1
         self.m_numSentRepairAfterStuck  = 0
+        self.m_lastInorderTime          = 0.0   # the peer's in-order point last advanced, or had all sent
+        self.m_numRetransmissions       = 0
         self.m_numSentRepairAfterRtt    = 0
+        self.m_numSourceSinceLastRepair = 0
 
         # Detect consecutive packet loss and avoid again
         self.m_burstAvoidPeriod = 3.0
@@ -208,6 +203,13 @@ class pepApp :
         self.m_currentMaxSourceId   = -1
         self.m_lastStreamcQueueSize = 0
 
+        # Admission of TCP data into the encoder, and the ingress AQM of each flow: (source id, time read, flow)
+        # of the TCP data enqueued and not sent yet
+        self.m_admission    = AdmissionController()
+        self.m_ingressAqm   = True
+        self.m_ingressQueue = deque()
+        self.m_pausedFlows  = set()     # flows whose reading the ingress AQM paused
+
         # for sending ack
         self.m_latestRecvPktType     = -1
         self.m_latestRecvSourceNum   = 0    # decoder目前收到的源分组数目
@@ -216,11 +218,31 @@ class pepApp :
         self.m_inorderNext           = 0
         self.m_inorderAckId          = 0
         self.m_lastDataAckSendTime = 0
-        self.m_numRecvSinceLastSourceAck = 0
+        self.m_numRecvSinceLastAck   = 0    # data packets received since the latest ACK
+        self.m_firstUnackedRecvTime  = -1.0 # arrival time of the first packet not yet acked
+        self.m_recvRate              = 0.0  # smoothed rate of receiving data packets (pkts/sec.)
+        self.m_ackInterval           = 1    # N and T asked for by the peer, ack every packet until negotiated
+        self.m_ackMaxDelay           = 0.0
+        self.m_currentAckInterval    = 1    # N adapted to the return link
+        self.m_ackPending            = False # a due ACK waits for an outgoing data packet to ride on
+        self.m_ackPendingTime        = -1.0
+        self.m_peerPiggyback         = False # the peer understands SC_PROTECTED_ACK_PKT
+        self.m_latestRecvCeNum       = 0    # number of received packets marked CE
+        self.m_pairDispersions       = deque(maxlen=InbandSampleCount)  # arrival dispersion of recent back-to-back pairs
+        self.m_newPairDispersion     = False
         self.m_inorderAckPacketSize  = InorderACK().getPackedSize()+PepHeaderLength
+
+        # ECN on the tunnel socket
+        self.m_ecnEnabled  = False
+        self.m_lastRecvTos = 0      # TOS byte of the latest received datagram
+
+        # Arrival time (monotonic) of the latest received datagram, from the kernel timestamp when available
+        self.m_kernelTimestamps = False
+        self.m_lastPktRecvTime  = 0.0
         
         # for receiving ack
         self.m_inorderAck         = InorderACK()
+        self.m_lastAckedCeNum     = 0
         self.m_lastAckedSourceId  = -1
         self.m_lastAckedRepairId  = -1
         self.m_lastAckedInorderId = -1
@@ -234,17 +256,23 @@ class pepApp :
         self.m_initCWnd        = 10
         self.m_cWnd            = 10
         self.m_packetsInFlight = 0
+        self.m_rampCWnd        = None   # cWnd growing by slow start to that of the controller, None once there
+        self.m_tailProbe       = False  # a repair packet is due to probe a flight lost as a whole
+        self.m_lastRecoveryTime = -1.0
+        self.m_numRecoveries   = 0
         
         # rtt estimation
+        self.m_rttEstimator      = RttEstimator()
         self.m_rtt               = 0.0
+        self.m_rttVar            = 0.0
         self.m_rttMin            = 1e6
-        self.m_lastDecSuccTime   = 0.0      # Record the time when the client notified the last successful decoding, which is used to ignore the RTT estimation of some packets
+        self.m_lastRecvTimestamp = -1.0     # sending timestamp carried by the latest received data packet, echoed in ACK
+        self.m_lastRecvTime      = 0.0
         
-        # bandwidth estimation
-        self.m_useJersyFlag      = True
+        # bandwidth estimation and congestion control
+        self.m_cc                = CongestionControllers['Jersey'](self.m_initCWnd)
         self.m_estBw             = 0.0      # estimated end-to-end bandwidth (in pkt/sec)
         self.m_estBwMax          = 0.0
-        self.m_maxBwFilter       = MaxBwFilter(BwWindowPeriod)
         self.m_lastAckTime       = -1.0     # time of receiving last ACK (in sec.)
         self.m_lastFirstSentTime = -1.0     # sent time of last acked packet (in sec.)
         #self.m_bwWindowLength    = 10
@@ -256,6 +284,10 @@ class pepApp :
         
         # loss rate estimation
         self.m_lossRate = 0.0               # estimated transmission loss rate based on ACKs
+        self.m_lastTotalLoss   = 0
+        self.m_lossModel       = GilbertElliottEstimator()
+        self.m_repairScheduler = RepairScheduler(self.m_lossModel)
+        self.m_lossClassifier  = LossClassifier()
         
         # pacing
         self.m_pacing      = True#False
@@ -266,6 +298,10 @@ class pepApp :
         # bookkeeping information for sent not-yet acked packets
         self.m_pktInfoQueue = InfoQueue()
 
+        # in-band bandwidth estimation: packets sent since the last back-to-back pair, and whether the pair is open
+        self.m_numSentSincePair = 0
+        self.m_pairOpen         = False
+
         # active bandwidth probe
         self.m_activeProbeBw        = True
         self.m_lastProbedTime       = -1
@@ -275,25 +311,61 @@ class pepApp :
         self.m_firstProbeArriveTime = 0
         self.m_lastProbeArrivedId   = -1
 
+        # path parameters cached across restarts
+        self.m_pathCache    = None
+        self.m_pathSeedBw   = 0      # bandwidth seeded from the cache, until validated by the first probe (pkts/sec.)
+        self.m_pathMeasured = False  # something has been measured on the path in this run
+
 
     def SetAttribute(self, args) :
         self.m_selfAddress   = (args.selfIp, args.selfPort)
         self.m_peerAddress   = (args.peerIp, args.peerPort)
-        # self.m_cp.pktsize    = packetSize
         self.m_detailFlag    = args.detail
         self.m_activeProbeBw = not args.deactivateProbeBw#False if args.maxBw else not args.deactivateProbeBw
-        self.m_maxAllowedBw  = float(args.maxBw[0:-4]) / PacingGain * 1024 * 1024 / (ScPacketSize * 8) if args.maxBw else None
-        self.m_constBw       = float(args.ConstBw[0:-4]) * 1024 * 1024 / (ScPacketSize * 8) if args.ConstBw else None
-        self.m_useJersyFlag  = False if args.bwEstMethod == "BBR" else True
+        # N and T this entity asks the peer to ack its data packets with, and the values agreed by the peer
+        self.m_askAckInterval  = min(max(args.ackInterval, 1), MaxAckInterval)
+        self.m_askAckMaxDelay  = min(max(args.ackMaxDelay / 1000, 0.0), MaxDataAckDelay)
+        self.m_peerAckInterval = 1
+        self.m_peerAckMaxDelay = 0.0
+        self.m_maxAllowedBps = float(args.maxBw[0:-4]) * 1024 * 1024 if args.maxBw else None
+        self.m_constBps      = float(args.ConstBw[0:-4]) * 1024 * 1024 if args.ConstBw else None
+        self.m_tunnelMtu     = args.tunnelMtu
+        self.m_decoderWindow = max(args.decoderWindow, 0)
+        self.UpdatePacketSize(min(max(MsgDataLengthForMtu(self.m_tunnelMtu), MinMsgDataLength), MaxMsgDataLength) if self.m_tunnelMtu else MsgDataMaxLength)
+        self.m_ccName        = args.congestionControl
+        self.m_targetQueueDelay = args.targetQueueDelay / 1000 if args.targetQueueDelay else None
+        self.CreateCongestionController()
+        self.m_admission     = AdmissionController(self.m_targetQueueDelay or DefaultTargetQueueDelay)
+        self.m_ingressAqm    = not args.deactivateIngressAqm
+        self.m_pathCache     = PathCache(args.pathCache) if not args.deactivatePathCache else None
+        # The codec this entity asks the peer to decode its data packets with; encoder and decoder
+        # are created once the codec of each direction is agreed at handshake
+        self.m_askCodec      = args.codec
+        self.m_codecBackend  = args.codecBackend
+        CodecBackend(args.codecBackend)
+        self.m_decoderThreaded = not args.deactivateDecoderThread
+        self.m_repairThreaded  = not args.deactivateRepairThread
         
         self.m_tcpListener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.m_tcpListener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.m_tcpListener.setsockopt(socket.SOL_IP, socket.IP_TRANSPARENT, 1)
         self.m_tcpListener.bind(("0.0.0.0", self.m_selfAddress[1]))
-        self.m_tcpListener.listen(128)
+        self.m_tcpListener.listen(TcpListenBacklog)
+        self.m_tcpListener.setblocking(0)
 
         self.m_udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.m_udpSocket.bind((self.m_selfAddress[0], self.m_selfAddress[1]))
+        # Mark tunnel datagrams ECT(0) and receive the TOS byte of each datagram, so that CE marks are fed back
+        self.m_ecnEnabled    = not args.deactivateEcn and hasattr(socket, 'IP_RECVTOS')
+        if self.m_ecnEnabled :
+            self.m_udpSocket.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, EcnECT0)
+            self.m_udpSocket.setsockopt(socket.IPPROTO_IP, socket.IP_RECVTOS, 1)
+        # Take the arrival time of tunnel datagrams from the kernel, so that the time they wait for the loop is not measured
+        try :
+            self.m_udpSocket.setsockopt(socket.SOL_SOCKET, SoTimestampNs, 1)
+            self.m_kernelTimestamps = True
+        except OSError as details :
+            logging.warning("[SetAttribute] Kernel receive timestamps not available: %s" % details)
 
         self.m_tcpListenChid = OpenTcpListenChannel(self.m_channels, self.m_tcpListener)
         self.m_udpChid = OpenUdpChannel(self.m_channels, self.m_udpSocket)
@@ -301,6 +373,161 @@ class pepApp :
         return 
     
     
+    def CreateCongestionController(self) :
+        self.m_cc = CongestionControllers[self.m_ccName](self.m_initCWnd)
+        self.m_cc.SetRateLimits(self.m_constBw, self.m_maxAllowedBw)
+        self.m_cc.SetPacketSize(self.m_scPacketSize)
+        if self.m_targetQueueDelay :
+            self.m_cc.SetTargetQueueDelay(self.m_targetQueueDelay)
+        self.UpdateCwnd()
+
+
+    def LoadPathParameters(self) :
+        # Seed the estimators with what was learned with the peer before, instead of starting from the initial window
+        if not self.m_pathCache :
+            return
+        entry = self.m_pathCache.Load(self.m_peerAddress)
+        if not entry :
+            return
+        currentTime = time.monotonic()
+        self.RttEstimation(currentTime, currentTime - entry['rttMin'])
+        self.m_lossRate   = entry['lossRate']
+        # in packets of the symbol size agreed now, which may differ from that of the saved session
+        self.m_pathSeedBw = entry['estBwMax'] * entry['packetSize'] / self.m_scPacketSize
+        sample = AckSample(currentTime, 0, entry['rttMin'], self.m_rtt, self.m_rttMin)
+        self.RampCwnd()
+        self.m_cc.OnBwProbe(currentTime, self.m_pathSeedBw, sample)
+        self.UpdateCwnd()
+        log = "Path to %s:%d seeded from cache (%.0f s old): maxBw %f Mbps, min RTT %f ms, loss rate %f" \
+            % (self.m_peerAddress[0], self.m_peerAddress[1], entry['age'], self.m_pathSeedBw*self.m_scPacketSize*8/1024/1024, self.m_rttMin*1000, self.m_lossRate)
+        self.HandleLog('INFO', "[PathCache] ", log, self.m_detailFlag)
+
+
+    def SavePathParameters(self) :
+        if not self.m_pathCache or not self.m_pathMeasured or self.m_estBwMax <= 0 or self.m_rttMin == 1e6 :
+            return
+        self.m_pathCache.Save(self.m_peerAddress, self.m_probeBw, self.m_estBwMax, self.m_rttMin, self.m_lossRate, self.m_scPacketSize)
+        logging.info("[PathCache] Path to %s:%d saved: probeBw %f maxBw %f minRtt %f lossRate %f" \
+            % (self.m_peerAddress[0], self.m_peerAddress[1], self.m_probeBw, self.m_estBwMax, self.m_rttMin, self.m_lossRate))
+
+
+    def UpdatePacketSize(self, msgDataLength) :
+        # The symbol size of the data packets this entity sends, which the rates in pkts/sec. count in
+        self.m_msgDataLength = msgDataLength
+        self.m_scPacketSize  = ScPacketLength(msgDataLength)
+        self.m_maxAllowedBw  = self.m_maxAllowedBps / (self.m_scPacketSize * 8) if self.m_maxAllowedBps else None
+        self.m_constBw       = self.m_constBps / (self.m_scPacketSize * 8) if self.m_constBps else None
+        self.m_cc.SetRateLimits(self.m_constBw, self.m_maxAllowedBw)
+        self.m_cc.SetPacketSize(self.m_scPacketSize)
+        SetMsgDataLength(msgDataLength)
+
+
+    def CodingParameters(self, msgDataLength) :
+        # Parameters used for streaming coding, of a direction whose symbol size is msgDataLength
+        cp         = parameters()
+        cp.gfpower = 8
+        cp.pktsize = TcpHeaderLength + msgDataLength
+        cp.repfreq = 0.0        # This Sc parameter is not used in PEP, where the frequency of sending repair packet is determine by TimeToSendRepairPacket
+        cp.seed    = 0
+        return cp
+
+
+    def CreateEncoder(self, codec, msgDataLength, sourceBase=0, repairBase=0) :
+        # The encoder of the data packets this entity sends, with the codec and symbol size the peer agreed to decode,
+        # counting ids from those of the coding epoch
+        self.m_encodeCodec  = codec
+        self.UpdatePacketSize(msgDataLength)
+        encoderClass, _     = Codec(codec, self.m_codecBackend)
+        self.m_enc          = encoderClass(self.CodingParameters(msgDataLength), sourceBase, repairBase)
+        self.m_repairThread = RepairThread(self.m_enc, self.m_repairThreaded and self.m_enc.RepairCapable)
+        if self.m_repairThread.m_threaded :
+            self.m_repairThread.start()
+        logging.info("[PEPesc] Encode with codec %s (%s), %d-byte symbols from source id %d repair id %d" \
+            % (codec, encoderClass.__module__, msgDataLength, sourceBase, repairBase))
+
+
+    def CreateDecoder(self, codec, msgDataLength, window=DEC_ALLOC, sourceBase=0, repairBase=0) :
+        # The decoder of the data packets of the peer, with the codec it asked for, the symbol size agreed and
+        # the window it asked for within MinDecoderWindow and MaxDecoderWindowBytes, counting ids from those of the epoch.
+        # A decoder of fixed window (libstreamc.so) takes its own, which is what the peer is answered
+        self.m_decodeCodec  = codec
+        self.m_recvMsgDataLength = msgDataLength
+        _, decoderClass     = Codec(codec, self.m_codecBackend)
+        cp                  = self.CodingParameters(msgDataLength)
+        window              = min(max(window, MinDecoderWindow), MaxDecoderWindowBytes // cp.pktsize)
+        fixedWindow         = getattr(decoderClass, 'FixedCapacity', None)
+        if fixedWindow is not None and window != fixedWindow :
+            logging.info("[PEPesc] Decoder window of %d packets asked, %s keeps %d" % (window, decoderClass.__module__, fixedWindow))
+            window = fixedWindow
+        self.m_dec          = decoderClass(cp, window, sourceBase, repairBase)
+        self.m_decoder      = DecoderThread(self.m_dec, self.m_decoderThreaded)
+        if self.m_decoder.m_threaded :
+            self.m_decoder.start()
+        logging.info("[PEPesc] Decode with codec %s (%s), %d-byte symbols, window of %d packets from source id %d repair id %d" \
+            % (codec, decoderClass.__module__, msgDataLength, self.m_dec.capacity, sourceBase, repairBase))
+
+
+    def AskDecoderWindow(self) :
+        # The decoder window asked of the peer: set by the user, or DecoderWindowBdpGain BDPs of the path as measured
+        # (or cached before), DEC_ALLOC without either
+        if self.m_decoderWindow :
+            return self.m_decoderWindow
+        bw, rttMin = self.m_estBwMax, self.m_rttMin
+        if (bw <= 0 or rttMin == 1e6) and self.m_pathCache :
+            entry = self.m_pathCache.Load(self.m_peerAddress)
+            if entry :
+                bw, rttMin = entry['estBwMax'] * entry['packetSize'] / self.m_scPacketSize, entry['rttMin']
+        if bw <= 0 or rttMin == 1e6 :
+            return DEC_ALLOC
+        return max(math.ceil(DecoderWindowBdpGain * bw * rttMin), MinDecoderWindow)
+
+
+    def RebaseDue(self, currentTime) :
+        # An epoch of source packets is encoded and all are acked: ask the peer to rebase, again every RebaseInterval
+        return self.m_peerRebase and self.m_currentMaxSourceId + 1 - self.m_enc.sourceBase >= CodingEpochLength \
+            and self.m_inorderAck.inorder == self.m_currentMaxSourceId and currentTime - self.m_lastRebaseTime >= RebaseInterval
+
+
+    def SendRebase(self, currentTime) :
+        # The next epoch starts at the next source id and at the repair id following the last sent, payloads are held
+        # from now on until the peer has rebased its decoder
+        if self.m_rebase is None :
+            self.m_rebase = (self.m_currentMaxSourceId + 1, self.m_lastSentRepairId + 1)
+        message = "%d %d %d" % (self.m_rebase[0], self.m_rebase[1], self.AskDecoderWindow())
+        self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['REBASE']), message.encode()).packed(), self.m_peerAddress)
+        self.m_lastRebaseTime = currentTime
+        logging.info("[Rebase] Ask peer to rebase: %s" % message)
+
+
+    def RebaseEncoder(self, capacity) :
+        # The peer decodes the new epoch, replace the encoder and enqueue the payloads held meanwhile
+        sourceBase, repairBase = self.m_rebase
+        self.m_repairThread.Stop()
+        self.m_enc.Free()
+        self.CreateEncoder(self.m_encodeCodec, self.m_msgDataLength, sourceBase, repairBase)
+        self.m_peerDecoderWindow = capacity
+        self.m_rebase = None
+        while self.m_heldPayloads :
+            self.EnqueuePackets(*self.m_heldPayloads.popleft())
+        logging.info("[Rebase] Encoder rebased to source id %d repair id %d, peer decoder window %d" % (sourceBase, repairBase, capacity))
+
+
+    def RebaseDecoder(self, message) :
+        # The peer starts an epoch at source id B and repair id R with decoder window W ("B R W"): replace the decoder
+        # once all payloads before B are handed over, and ack with the window taken (also again, if already rebased)
+        sourceBase, repairBase, window = (int(field) for field in message)
+        if self.m_dec is None :
+            return
+        if self.m_dec.sourceBase != sourceBase :
+            if self.m_decoder.m_inorder != sourceBase - 1 or self.m_inorderNext != sourceBase :
+                return
+            self.m_decoder.Stop()
+            self.m_dec.Free()
+            self.CreateDecoder(self.m_decodeCodec, self.m_recvMsgDataLength, window, sourceBase, repairBase)
+        message = "%d %d" % (sourceBase, self.m_dec.capacity)
+        self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['REBASE_ACK']), message.encode()).packed(), self.m_peerAddress)
+
+
     def HandleLog(self, logLevel, logType, log, detailFlag=False) :
         if logLevel == 'DEBUG' :
             logging.debug(logType + log)
@@ -314,71 +541,71 @@ class pepApp :
             print("[%s][%s:%d] %s."  % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], log))
 
 
-    def EnqueuePackets(self, msg, tcpSourceAddr=None, tcpDestinationAddr=None, contents=b"") :
+    def EnqueuePackets(self, msg, tcpSourceAddr=None, tcpDestinationAddr=None, contents=b"", recvTime=None, flow=None) :
+        if self.m_rebase is not None :
+            # contents may be a view of the receive buffer of the channel, only valid until its next read
+            self.m_heldPayloads.append((msg, tcpSourceAddr, tcpDestinationAddr, bytes(contents), recvTime, flow))
+            return
         if msg != ScProtectedMsg['TCP_RAW_DATA'] :
             scPayLoad = SCPayload(msg, tcpSourceAddr, tcpDestinationAddr, contents)
-            buf = (c_ubyte * self.m_cp.pktsize).from_buffer_copy(scPayLoad.packed())         # class bytes to ctypes.c_ubyte_Array
-            streamc.enqueue_packet(self.m_enc, self.m_currentMaxSourceId+1, buf)
+            with self.m_repairThread.m_lock :
+                self.m_enc.Enqueue(self.m_currentMaxSourceId+1, scPayLoad.packed(self.m_msgDataLength))
             self.m_currentMaxSourceId += 1
             logging.debug("[EncoderStatus] headsid: %d tailsid: %d nextsid: %d" \
-                % (self.m_enc.contents.headsid, self.m_enc.contents.tailsid, self.m_enc.contents.nextsid))
+                % (self.m_enc.headsid, self.m_enc.tailsid, self.m_enc.nextsid))
 
         else :
-            num = math.ceil(len(contents) / MsgDataMaxLength)
+            num = math.ceil(len(contents) / self.m_msgDataLength)
             for i in range(num) :
-                tcpRawData = contents[i * MsgDataMaxLength : (i+1) * MsgDataMaxLength] # class 'bytes'
+                tcpRawData = contents[i * self.m_msgDataLength : (i+1) * self.m_msgDataLength] # class 'bytes'
                 scPayLoad = SCPayload(msg, tcpSourceAddr, tcpDestinationAddr, tcpRawData)
-                buf = (c_ubyte * self.m_cp.pktsize).from_buffer_copy(scPayLoad.packed())    # class bytes to ctypes.c_ubyte_Array
-                streamc.enqueue_packet(self.m_enc, self.m_currentMaxSourceId+1, buf)
+                with self.m_repairThread.m_lock :
+                    self.m_enc.Enqueue(self.m_currentMaxSourceId+1, scPayLoad.packed(self.m_msgDataLength))
                 self.m_currentMaxSourceId += 1
+                if flow is not None and recvTime is not None :
+                    # the sojourn of the data in PEPesc is taken when it is sent
+                    self.m_ingressQueue.append((self.m_currentMaxSourceId, recvTime, flow))
+                    if self.m_ingressAqm :
+                        flow.codel.OnEnqueue()
                 logging.debug("[EncoderStatus] headsid: %d tailsid: %d nextsid: %d" \
-                    % (self.m_enc.contents.headsid, self.m_enc.contents.tailsid, self.m_enc.contents.nextsid))
+                    % (self.m_enc.headsid, self.m_enc.tailsid, self.m_enc.nextsid))
 
 
-    def RttEstimation(self, receiveTime, sendTime) :
-        if sendTime == -1 :
-            return 
-        alpha = 0.9
-        historyRtt = self.m_rtt
-        newRtt = receiveTime - sendTime
-        
-        if historyRtt == 0 :
-            self.m_rtt    = newRtt
-            self.m_rttMin = newRtt
-        else :
-            self.m_rtt = alpha * historyRtt + (1 - alpha) * newRtt    # smoothed RTT estimation (follow standard TCP, Karn's algorithm is not needed since no retransmission is incurred)
-            self.m_rttMin = min(self.m_rttMin, newRtt)                # update minimum rtt observed (which should be close to the true propagation delay)
-    
+    def FlowChannel(self, flow) :
+        # The channel of the flow with its neighbor, None if it is closed (and its id maybe reused)
+        ch = self.m_channels.get(flow.chid)
+        return ch if ch is not None and ch.neighbor == flow.neighbor else None
 
-    def BwEstimationJersy(self, numAcked) :
-        # TCP Jersy's TSW algorithm
-        currentTime = time.time()
-        ackInterval = currentTime - self.m_lastAckTime
 
-        if self.m_lastAckTime == -1.0 :
-            # The first data ack, the interval cannot be calculated, no estimation is made
-            self.m_lastAckTime = currentTime 
-            return 
-        
-        self.m_estBw = (self.m_rtt * self.m_estBw + numAcked) / (ackInterval + self.m_rtt)
-        self.m_maxBwFilter.Insert(currentTime , self.m_estBw)
-        
-        log = "[Jersy-ABE] ackInterval: %f" % ackInterval
-        log += " numAcked: %d" % numAcked
-        log += " Estimated-BW: %f" % self.m_estBw
-        log += " Current-Max-Bw: %f" % self.m_maxBwFilter.GetMaxBw()
-        logging.debug(log)
+    def PauseFlow(self, flow) :
+        # The ingress AQM of the flow paused reading from its neighbor
+        ch = self.FlowChannel(flow)
+        if ch is not None :
+            ch.readPaused = True
+            self.m_pausedFlows.add(flow)
 
 
-    def BwEstimationBBR(self, delivered, ackElapsed, sendElapsed) :
-        # BBR's delivery rate estimation algorithm
-        # https://datatracker.ietf.org/doc/html/draft-cheng-iccrg-delivery-rate-estimation
-        deliveryElapsed = max(ackElapsed, sendElapsed)
-        self.m_estBw = delivered / deliveryElapsed      # pkts/sec.
-        self.m_maxBwFilter.Insert(time.time() , self.m_estBw)
-        log = "[BBR-ABE] delivered: %d ackElapsed: %f sendElapsed: %f Estimated-BW: %f Current-Max-Bw: %f" \
-            % (delivered, ackElapsed, sendElapsed, self.m_estBw, self.m_maxBwFilter.GetMaxBw())
-        logging.debug(log)
+    def ResumeFlows(self, currentTime) :
+        # Resume reading the paused flows whose pause is over, by its deadline or as their queue drained
+        for flow in list(self.m_pausedFlows) :
+            if flow.codel.Readable(currentTime) :
+                ch = self.FlowChannel(flow)
+                if ch is not None :
+                    ch.readPaused = False
+                self.m_pausedFlows.discard(flow)
+            elif self.FlowChannel(flow) is None :
+                self.m_pausedFlows.discard(flow)
+
+
+    def RttEstimation(self, receiveTime, sendTime) :
+        if sendTime == -1 :
+            return 
+        # smoothed RTT estimation (follow standard TCP, Karn's algorithm is not needed since no retransmission is incurred)
+        # and minimum rtt observed in the recent window (which should be close to the current propagation delay)
+        self.m_rttEstimator.Update(receiveTime, receiveTime - sendTime)
+        self.m_rtt    = self.m_rttEstimator.SRtt()
+        self.m_rttVar = self.m_rttEstimator.RttVar()
+        self.m_rttMin = self.m_rttEstimator.MinRtt()
 
 
     def PeEstimation(self, nTotalLoss, nTotalSent) :
@@ -391,46 +618,122 @@ class pepApp :
 
 
     def UpdateCwnd(self) :
-        cWndGain = CwndGain #if self.m_useJersyFlag else 1.2
-        
-        # Update estimated maximum bandwidth
-        if self.m_maxBwFilter.IsEmpty() :
-            self.m_estBwMax = self.m_probeBw * 0.8
-        else :
-            self.m_estBwMax = self.m_maxBwFilter.GetMaxBw()
-
-        # Update CWND
-        if self.m_constBw :
-            cWndPreset = self.m_constBw * self.m_rttMin * cWndGain
-        elif self.m_maxAllowedBw :
-            cWndPreset = min(self.m_maxAllowedBw, self.m_estBwMax) * self.m_rttMin * cWndGain
-        else :
-            cWndPreset = self.m_estBwMax * self.m_rttMin * cWndGain
-        self.m_cWnd = math.floor(max(10.0, cWndPreset))
-        self.m_pacing = True if self.m_cWnd > 10 else False
-        #self.m_pacing = False if self.m_constBw else self.m_pacing
-        # Update pacing rate
-        if self.m_pacing == True and self.m_cWnd > self.m_packetsInFlight :
-            self.m_pacingRate = self.m_constBw * ScPacketSize if self.m_constBw \
-                                else self.m_estBwMax * ScPacketSize * PacingGain
+        # Take cWnd, pacing and bandwidth estimation from the congestion controller, cWnd within the ramp if any
+        self.m_cWnd       = self.m_cc.m_cWnd
+        if self.m_rampCWnd is not None :
+            if self.m_rampCWnd >= self.m_cWnd :
+                self.m_rampCWnd = None
+            else :
+                self.m_cWnd = max(math.floor(self.m_rampCWnd), self.m_initCWnd)
+        self.m_pacing     = self.m_cc.m_pacing
+        self.m_pacingRate = self.m_cc.m_pacingRate
+        self.m_estBw      = self.m_cc.m_estBw
+        self.m_estBwMax   = self.m_cc.m_estBwMax
+        # Source packets in flight are kept within a share of the decoder window of the peer, which caps the rate
+        # once the BDP of the path exceeds it (as with the fixed window of libstreamc.so on long paths): warn once per window
+        maxInFlight = self.m_peerDecoderWindow * DecoderWindowShare
+        if self.m_rttMin != 1e6 and self.m_estBwMax * self.m_rttMin > maxInFlight and self.m_cappedDecoderWindow != self.m_peerDecoderWindow :
+            self.m_cappedDecoderWindow = self.m_peerDecoderWindow
+            self.HandleLog('WARNING', "[PEPesc] ", "BDP of %d packets exceeds the %d in flight the decoder window of %d packets of the peer allows, rate capped at %.1f Mbps" \
+                % (self.m_estBwMax * self.m_rttMin, maxInFlight, self.m_peerDecoderWindow, maxInFlight * self.m_scPacketSize * 8 / self.m_rttMin / 1e6), self.m_detailFlag)
     
 
+    def TimeToRetransmit(self, currentTime) :
+        # Without coded repair packets (null codec), a lost source packet stalls the peer's in-order point for good:
+        # retransmit the packet it waits for once the peer reports the stall, and again each recovery timeout it lasts
+        if self.m_lastAckedInorderId >= self.m_lastSentSourceId :
+            return False
+        if self.m_duplicatedInorder :
+            self.m_duplicatedInorder = False
+        elif currentTime - max(self.m_lastInorderTime, self.m_lastSentRepairTime) < self.RecoveryTimeout() :
+            return False
+        self.m_numRetransmissions += 1
+        logging.info("[Retransmit] Peer in-order point stalled at %d, retransmit source packet %d" % (self.m_lastAckedInorderId, self.m_enc.headsid))
+        return True
+
+    def RampCwnd(self, fromCWnd=None) :
+        # A probe (or a recovery timeout) is about to move the cWnd of the controller: reach it by slow start
+        # from the current one, so that a rate probed with a few packets does not open a whole BDP at once
+        if not self.m_constBw :
+            self.m_rampCWnd = fromCWnd if fromCWnd is not None else (self.m_rampCWnd or self.m_cWnd)
+
+
+    def RecoveryTimeout(self) :
+        return max(2 * self.m_rtt + 4 * self.m_rttVar, MinRecoveryTimeout)
+
+
+    def CheckRecoveryTimeout(self, currentTime) :
+        # Packets in flight are only recomputed on ACKs, a flight lost as a whole (e.g. to a full socket buffer of the peer)
+        # would hold cWnd full for good: once nothing is acked for the recovery timeout since the last packet sent,
+        # take the flight as lost, back off, probe the tail with a repair packet and ramp up again from the initial window
+        if self.m_packetsInFlight < self.m_cWnd or self.m_lastSentSourceId + self.m_lastSentRepairId == -2 :
+            return
+        if currentTime - max(self.m_lastAckTime, self.m_lastPacketSentTime, self.m_lastRecoveryTime) < self.RecoveryTimeout() :
+            return
+        logging.info("[Recovery] Nothing acked for %f ms, %d packets in flight taken as lost (cWnd: %d)" \
+            % (self.RecoveryTimeout() * 1000, self.m_packetsInFlight, self.m_cWnd))
+        self.m_numRecoveries += 1
+        self.m_lastRecoveryTime = currentTime
+        self.m_cc.OnLossDetected(currentTime, 0, math.ceil(self.m_packetsInFlight), self.m_rtt)
+        self.m_packetsInFlight = 0
+        self.m_tailProbe = True
+        self.RampCwnd(self.m_initCWnd)
+        self.UpdateCwnd()
+
+
     def SendDataAck(self) :
-        inorderAck = InorderACK(self.m_inorderAckId, self.m_dec.contents.inorder, self.m_latestRecvSourceNum, self.m_latestRecvRepairNum,
-                                self.m_latestRecvPktType, self.m_lastRecvSourceId, self.m_lastRecvRepairId)
+        inorderAck = self.PrepareDataAck(time.monotonic())
         rpkt = PepPacket(PepHeader(PepPacketType['SC_DATA_ACK']), inorderAck.packed())
-        
         self.m_udpSocket.sendto(rpkt.packed(), self.m_peerAddress)
+        logging.debug("[SendDataAck] Send data ACK %s" % inorderAck)
+
+
+    def ScheduleDataAck(self, currentTime) :
+        # Let a due ACK ride on the next data packet if one is about to be sent, otherwise send it alone
+        if self.m_peerPiggyback and self.m_peerOnline and not self.m_selfPreClose \
+            and self.m_cWnd > self.m_packetsInFlight and self.m_lastSentSourceId < self.m_currentMaxSourceId :
+            if not self.m_ackPending :
+                self.m_ackPending = True
+                self.m_ackPendingTime = currentTime
+        else :
+            self.SendDataAck()
+
+
+    def PrepareDataAck(self, currentTime) :
+        """ Build the ACK of the current decoder state and account it as sent
+        """
+        dispersion = -1.0
+        if self.m_newPairDispersion :
+            # The median keeps a pair squeezed by cross traffic or spread by a loss in a train from showing up
+            dispersion = sorted(self.m_pairDispersions)[len(self.m_pairDispersions) // 2]
+            self.m_newPairDispersion = False
+        inorderAck = InorderACK(self.m_inorderAckId, self.m_decoder.m_inorder, self.m_latestRecvSourceNum, self.m_latestRecvRepairNum,
+                                self.m_latestRecvPktType, self.m_lastRecvSourceId, self.m_lastRecvRepairId,
+                                self.m_lastRecvTimestamp, currentTime - self.m_lastRecvTime, self.m_latestRecvCeNum, dispersion)
         
         self.m_inorderAckId += 1
-        self.m_lastDataAckSendTime = time.time() 
+        if self.m_lastDataAckSendTime > 0 and currentTime > self.m_lastDataAckSendTime :
+            rate = (self.m_latestRecvSourceNum + self.m_latestRecvRepairNum - self.m_numLastAcked) / (currentTime - self.m_lastDataAckSendTime)
+            self.m_recvRate = 0.9 * self.m_recvRate + 0.1 * rate if self.m_recvRate > 0 else rate
+        self.m_lastDataAckSendTime = currentTime
         self.m_numLastAcked = self.m_latestRecvSourceNum + self.m_latestRecvRepairNum
-
-        logging.debug("[SendDataAck] Send data ACK %s" % inorderAck)
+        self.m_numRecvSinceLastAck = 0
+        self.m_firstUnackedRecvTime = -1.0
+        self.m_ackPending = False
+        self.AdaptAckInterval()
+        return inorderAck
         
 
-    def RecvDataAck(self, pkt) :
-        self.m_inorderAck.parse(pkt.body)
+    def RecvDataAck(self, data) :
+        self.m_inorderAck.parse(data)
+        # Ids and counters come as serial numbers, unwrap them against the latest acked
+        ack = self.m_inorderAck
+        ack.inorder = SeqUnwrap(ack.inorder, self.m_lastAckedInorderId)
+        ack.nsource = SeqUnwrap(ack.nsource, self.m_lastAckedSourceNum)
+        ack.nrepair = SeqUnwrap(ack.nrepair, self.m_lastAckedRepairNum)
+        ack.latestRecvSourceId = SeqUnwrap(ack.latestRecvSourceId, self.m_lastAckedSourceId)
+        ack.latestRecvRepairId = SeqUnwrap(ack.latestRecvRepairId, self.m_lastAckedRepairId)
+        ack.ceCount = SeqUnwrap(ack.ceCount, self.m_lastAckedCeNum)
         inorder, nsource, nrepair = self.m_inorderAck.inorder, self.m_inorderAck.nsource, self.m_inorderAck.nrepair
         latestRecvPktType, latestRecvSourceId, latestRecvRepairId = self.m_inorderAck.latestRecvPktType, self.m_inorderAck.latestRecvSourceId, self.m_inorderAck.latestRecvRepairId
         latestRecvPktId = latestRecvSourceId if latestRecvPktType == PacketInfoType['SOURCE_PACKET'] else latestRecvRepairId
@@ -461,31 +764,27 @@ class pepApp :
         resultInfo = self.m_pktInfoQueue.Find(latestRecvPktType, latestRecvPktId)
         sendTime, otherTypePacketNum = resultInfo.sendTime, resultInfo.anotherPktNum
         deliveredAsOfSend, firstSentTime, deliveredTime = resultInfo.delivered, resultInfo.firstSentTime, resultInfo.deliveredTime
-        recvAckTime = time.time()
+        recvAckTime = self.m_lastPktRecvTime
+        self.m_pathMeasured = True
         
-        # Available bandwidth estimation
-        #if sendTime > self.m_idleStateChangeTime :
-        #if sendTime - self.m_lastAckedPacketSentTime <= 2 * self.CalculateBytesTxTime() :
-        if self.m_useJersyFlag :
-            numAcked = nsource + nrepair - self.m_lastAckedSourceNum - self.m_lastAckedRepairNum
-            self.BwEstimationJersy(numAcked)
-        else :
-            delivered = nsource+nrepair-deliveredAsOfSend
-            ackElapsed = recvAckTime-deliveredTime
-            sendElapsed = sendTime-firstSentTime
-            self.BwEstimationBBR(delivered, ackElapsed, sendElapsed)
-
+        numAcked = nsource + nrepair - self.m_lastAckedSourceNum - self.m_lastAckedRepairNum
         self.m_lastAckTime = recvAckTime
+        if self.m_rampCWnd is not None :
+            self.m_rampCWnd += numAcked
         self.m_lastFirstSentTime = sendTime
         self.m_lastAckedPacketSentTime = sendTime
 
+        if inorder > self.m_lastAckedInorderId :
+            self.m_lastInorderTime = recvAckTime
         self.m_lastAckedInorderId = inorder
         self.m_lastAckedSourceNum = nsource
         self.m_lastAckedRepairNum = nrepair
         
-        # Only perform RTT estimation for packets whose sending time is later than the successful decoding time
-        if sendTime >= self.m_lastDecSuccTime :
-            self.RttEstimation(recvAckTime, sendTime)
+        # RTT sample from the echoed sending timestamp, excluding the time the ACK was held by the receiver
+        rttSample = -1
+        if self.m_inorderAck.echoTimestamp > 0 :
+            self.RttEstimation(recvAckTime, self.m_inorderAck.echoTimestamp + self.m_inorderAck.ackDelay)
+            rttSample = recvAckTime - self.m_inorderAck.echoTimestamp - self.m_inorderAck.ackDelay
         
         # Pe estimation
         # TODO：收到out-of-order分组的ACK时不应进行丢包率估计 (totalLoss和in-flight无法判断)
@@ -502,15 +801,47 @@ class pepApp :
         nTotalLoss = sourceSentCount + repairSentCount - nsource - nrepair
         self.PeEstimation(nTotalLoss, sourceSentCount + repairSentCount)
 
-        # Update packets-in-flight and cWnd
+        # Tell random losses from congestive ones by the RTT inflation and delivery rate at this ACK.
+        # Only random losses are fed into the loss model, in front of the newly received packets,
+        # congestive losses are left for the congestion controller to back off the sending rate.
+        numNewLoss = max(0, nTotalLoss - self.m_lastTotalLoss)
+        numRandomLoss = self.m_lossClassifier.Classify(numNewLoss, rttSample if rttSample > 0 else self.m_rtt, self.m_rttMin, self.m_estBw, self.m_estBwMax)
+        self.m_lossModel.OnAck(numRandomLoss, numAcked)
+        # the total only grows, a reordered ACK reporting fewer losses must not have them counted again on the next one
+        self.m_lastTotalLoss = max(self.m_lastTotalLoss, nTotalLoss)
+
+        # Update packets-in-flight
         self.m_lastAckedSourceId = latestRecvSourceId
         self.m_lastAckedRepairId = latestRecvRepairId
         oldPacketsInFlight = self.m_packetsInFlight
-        self.m_packetsInFlight = (self.m_lastSentSourceId - self.m_lastAckedSourceId + self.m_lastSentRepairId - self.m_lastAckedRepairId) * (1 - self.m_lossRate)
+        # Packets sent after the latest one the peer received are in flight, those sent before it and not received are lost
+        self.m_packetsInFlight = (self.m_lastSentSourceId + self.m_lastSentRepairId + 2 - sourceSentCount - repairSentCount) * (1 - self.m_lossRate)
+
+        # Congestion control: report losses, CE marks and the ACK, then update cWnd and pacing rate
+        numCeMarked = max(0, self.m_inorderAck.ceCount - self.m_lastAckedCeNum)
+        self.m_lastAckedCeNum = max(self.m_lastAckedCeNum, self.m_inorderAck.ceCount)
+        self.m_cc.OnLossDetected(recvAckTime, numRandomLoss, numNewLoss - numRandomLoss, self.m_rtt)
+        self.m_cc.OnEcnMarked(recvAckTime, numCeMarked, numAcked, self.m_rtt)
+        if numCeMarked > 0 :
+            logging.debug("[ECN] %d packets marked CE, alpha: %f rateFactor: %f" % (numCeMarked, self.m_cc.m_ecnAlpha, self.m_cc.m_rateFactor))
+        sample = AckSample(recvAckTime, numAcked, rttSample, self.m_rtt, self.m_rttMin, 
+                           nsource + nrepair - deliveredAsOfSend, recvAckTime - deliveredTime, sendTime - firstSentTime,
+                           deliveredAsOfSend, nsource + nrepair, self.m_packetsInFlight, self.m_newDataIdleState, sendTime)
+        self.m_cc.OnAckReceived(sample)
+        if self.m_inorderAck.dispersion > 0 and not self.m_constBw :
+            self.m_cc.OnDispersionSample(recvAckTime, 1 / self.m_inorderAck.dispersion, sample)
+            logging.debug("[Dispersion] pair dispersion: %f ms capacity: %f pkts/sec." % (self.m_inorderAck.dispersion * 1000, 1 / self.m_inorderAck.dispersion))
+        self.m_cc.UpdateStats(sample)
         self.UpdateCwnd()
+
+        # Re-plan repair packets for what is sent from now on
+        burstAvoid = recvAckTime - self.m_lastBurstTime < self.m_burstAvoidPeriod
+        self.m_repairScheduler.Update(recvAckTime, self.m_estBwMax, self.m_packetsInFlight, burstAvoid)
         
         if inorder >= 0 and inorder < self.m_currentMaxSourceId :
-            streamc.flush_acked_packets(self.m_enc, inorder)
+            with self.m_repairThread.m_lock :
+                self.m_enc.Flush(inorder)
+                self.m_repairThread.OnFlush()
         
         log += " latest ACKed %s packet of ID: %d" % (pktTypeStr, latestRecvPktId)
         logging.debug(log)
@@ -525,12 +856,18 @@ class pepApp :
         log += " totalSourceSent: %d" % sourceSentCount
         log += " totalRepairSent: %d" % repairSentCount
         log += " minRTT: %f" % self.m_rttMin
+        log += " rttVar: %f" % self.m_rttVar
         log += " oldPacketsInFlight: %d" % oldPacketsInFlight
+        log += " repairFreq: %f" % self.m_repairScheduler.RepairFrequency()
+        log += " repairWindow: %d" % self.m_repairScheduler.WindowLength()
         logging.debug(log)
+        logging.debug("[LossModel] %s" % self.m_lossModel)
+        logging.debug("[LossClassifier] %s" % self.m_lossClassifier)
+        logging.debug("[CongestionControl] %s" % self.m_cc)
 
         # Record current encoder status
         logging.debug("[UpdatedEncoderStatusOnAck] headsid: %d tailsid: %d nextsid: %d" \
-            % (self.m_enc.contents.headsid, self.m_enc.contents.tailsid, self.m_enc.contents.nextsid))
+            % (self.m_enc.headsid, self.m_enc.tailsid, self.m_enc.nextsid))
 
         """
         # Record the arrival time when the packet acknowledges the receipt of the ACK
@@ -544,13 +881,13 @@ class pepApp :
 
     # Calculates the transmission time at this data rate.
     def CalculateBytesTxTime(self) :
-        return ScPacketSize / self.m_pacingRate
+        return self.m_scPacketSize / self.m_pacingRate
     
 
     def SendDataPackets(self) :
         # Continue to send data packets if there is data and cWnd allows
         while self.m_cWnd > self.m_packetsInFlight :
-            currentTime = time.time()
+            currentTime = time.monotonic()
             # if pacing, sending is controlled by pacingTimer
             if self.m_pacing == True and self.m_cWnd != self.m_initCWnd :
                 remainTime = currentTime  - self.m_lastPacketSentTime - self.m_pacingTimer
@@ -559,62 +896,106 @@ class pepApp :
                 else :
                     self.m_pacingTimer = 0
 
-            # Output packet
-            cpkt = None
-            # Decide whether to send repair packet
+            # Output the packet serialized (a SerializedPacket)
+            packet = None
+            # Decide whether to send repair packet, take it from the ones encoded ahead if there is one
             if self.TimeToSendRepairPacket() == True :
-                if random.uniform(0, 1) < 0.95 :
-                    cpkt = streamc.output_repair_packet_short(self.m_enc, 128)
-                else :
-                    cpkt = streamc.output_repair_packet(self.m_enc)
-            # Decide whether to send source packet
-            elif self.m_lastSentSourceId < self.m_currentMaxSourceId and cpkt == None :
-                cpkt = streamc.output_source_packet(self.m_enc)
-            if cpkt == None :
+                with self.m_repairThread.m_lock :
+                    packet = self.m_repairThread.Pop()
+                    if packet is None :
+                        packet = self.m_repairThread.Encode(self.m_repairScheduler.WindowLength())
+                    nextSourceId = self.m_enc.nextsid
+            # Decide whether to send source packet, within the share of the decoder window of the peer
+            elif self.m_lastSentSourceId < self.m_currentMaxSourceId \
+                and self.m_lastSentSourceId - self.m_lastAckedInorderId < self.m_peerDecoderWindow * DecoderWindowShare :
+                with self.m_repairThread.m_lock :
+                    packet = self.m_enc.OutputSource()
+                    nextRepairId = self.m_repairThread.NextRepairId()
+            if packet is None :
                 break
+            sourceId, repairId = packet.sourceId, packet.repairId
 
-            # Serialize packets and do SC-UDP encapsulation
-            pktstr = streamc.serialize_packet(self.m_enc, cpkt)               # class ctypes.LP_c_ubyte
-            pp = string_at(pktstr, self.m_cp.pktsize + 4 * sizeof(c_int))     # class 'bytes'
-            pkt = PepPacket(PepHeader(PepPacketType['SC_PROTECTED_PKT']), pp)
-            #pkt = PepPacket(PepHeader(PepPacketType['SC_PROTECTED_PKT']), cpkt.contents.serialize(self.m_cp.pktsize))
+            # SC-UDP encapsulation, gathered straight from the serialized packet
+            sendTime = currentTime 
+            if self.m_ackPending :
+                # Piggyback the due ACK between the coded symbol and the timestamp
+                inorderAck = self.PrepareDataAck(currentTime)
+                header, trailer = PepHeader(PepPacketType['SC_PROTECTED_ACK_PKT']), inorderAck.packed() + struct.pack('d', sendTime)
+                logging.debug("[SendDataAck] Piggyback data ACK %s" % inorderAck)
+            else :
+                header, trailer = PepHeader(PepPacketType['SC_PROTECTED_PKT']), struct.pack('d', sendTime)
+            header.length = len(packet.View()) + len(trailer)
             
             # Send the scpkt and record the sending time
-            self.m_udpSocket.sendto(pkt.packed(), self.m_peerAddress)
-            sendTime = currentTime 
+            self.m_udpSocket.sendmsg([header.packed(), packet.View(), trailer], [], 0, self.m_peerAddress)
+            packet.Free()
             self.m_lastPacketSentTime = sendTime
 
             # Record the packet sending time and other corresponding status values
+            # Delivery-rate bookkeeping starts from this packet if nothing has been acked yet
+            firstSentTime = self.m_lastFirstSentTime if self.m_lastAckTime != -1.0 else sendTime
+            deliveredTime = self.m_lastAckTime if self.m_lastAckTime != -1.0 else sendTime
             log = ""
-            if cpkt.contents.sourceid != -1 :
-                log = "[SendDataPacket] Send SOURCE packet %d" % cpkt.contents.sourceid
-                self.m_pktInfoQueue.Add(PacketInfoType['SOURCE_PACKET'], cpkt.contents.sourceid, sendTime, self.m_enc.contents.rcount, self.m_lastAckedSourceNum+self.m_lastAckedRepairNum, self.m_lastFirstSentTime, self.m_lastAckTime)
-                self.m_lastSentSourceId = cpkt.contents.sourceid
+            if sourceId != -1 :
+                log = "[SendDataPacket] Send SOURCE packet %d" % sourceId
+                pktType, pktId = PacketInfoType['SOURCE_PACKET'], sourceId
+                if self.m_lastSentSourceId == self.m_lastAckedInorderId :
+                    self.m_lastInorderTime = currentTime
+                self.m_pktInfoQueue.Add(PacketInfoType['SOURCE_PACKET'], sourceId, sendTime, nextRepairId, self.m_lastAckedSourceNum+self.m_lastAckedRepairNum, firstSentTime, deliveredTime)
+                self.m_lastSentSourceId = sourceId
                 self.m_lastSentSourceTime = currentTime
+                self.m_numSourceSinceLastRepair += 1
+                while self.m_ingressQueue and self.m_ingressQueue[0][0] <= sourceId :
+                    _, recvTime, flow = self.m_ingressQueue.popleft()
+                    sojourn = sendTime - recvTime
+                    paused = self.m_ingressAqm and flow.codel.OnDequeue(sendTime, sojourn)
+                    self.m_admission.OnSojourn(sojourn, paused)
+                    if paused :
+                        self.PauseFlow(flow)
             else :
-                log = "[SendDataPacket] Send REPAIR packet %d" % cpkt.contents.repairid
-                self.m_pktInfoQueue.Add(PacketInfoType['REPAIR_PACKET'], cpkt.contents.repairid, sendTime, self.m_enc.contents.nextsid, self.m_lastAckedSourceNum+self.m_lastAckedRepairNum, self.m_lastFirstSentTime, self.m_lastAckTime)
-                self.m_lastSentRepairId = cpkt.contents.repairid
+                log = "[SendDataPacket] Send REPAIR packet %d" % repairId
+                pktType, pktId = PacketInfoType['REPAIR_PACKET'], repairId
+                self.m_pktInfoQueue.Add(PacketInfoType['REPAIR_PACKET'], repairId, sendTime, nextSourceId, self.m_lastAckedSourceNum+self.m_lastAckedRepairNum, firstSentTime, deliveredTime)
+                self.m_lastSentRepairId = repairId
                 self.m_lastSentRepairTime = currentTime
+                self.m_numSourceSinceLastRepair = 0
                 
             log += " Idle State: True" if self.m_newDataIdleState else " Idle State: False"
             logging.debug(log)
 
             # Record current encoder status
             logging.debug("[EncoderStatus] headsid: %d tailsid: %d nextsid: %d" \
-                % (self.m_enc.contents.headsid, self.m_enc.contents.tailsid, self.m_enc.contents.nextsid))
+                % (self.m_enc.headsid, self.m_enc.tailsid, self.m_enc.nextsid))
             
-            # Free the packet and pktstr, then count in-flight
-            streamc.free_packet(cpkt)
-            streamc.free_serialized_packet(pktstr)
+            # Start encoding the next repair packet while idle, or when it is due within RepairPrefetchLead source packets
+            # and the sender leaves a gap to encode it in: cWnd is full, or the pacing interval runs before the next
+            # packet (not sent back to back in a pair)
+            if self.m_lastSentSourceId == self.m_currentMaxSourceId :
+                self.m_repairThread.Prefetch(self.m_repairScheduler.WindowLength())
+            elif self.m_numSourceSinceLastRepair + RepairPrefetchLead >= self.m_repairScheduler.RepairSpacing() :
+                if self.m_packetsInFlight + 1 >= self.m_cWnd :
+                    self.m_repairThread.Prefetch(self.m_repairScheduler.WindowLength())
+                elif self.m_pacing == True and self.m_cWnd != self.m_initCWnd and self.m_numSentSincePair + 1 < InbandPairInterval :
+                    self.m_repairThread.Prefetch(self.m_repairScheduler.WindowLength(), sendTime + self.CalculateBytesTxTime())
+
             self.m_packetsInFlight += 1
+            self.m_cc.OnPacketSent(sendTime, pktType, pktId, self.m_packetsInFlight)
             
             # Set the next sending time according to the pacing rate
             if self.m_pacing == True :
                 if self.m_pacingTimer == 0 :
+                    # Every InbandPairInterval paced packets, send the next one back to back for in-band dispersion,
+                    # and wait for two packets' time after the pair to keep the pacing rate
+                    self.m_numSentSincePair += 1
+                    if not self.m_pairOpen and self.m_numSentSincePair >= InbandPairInterval :
+                        self.m_pairOpen = True
+                        continue
                     # print("Current Pacing Rate %f." % self.m_pacingRate)
                     # print("Timer is in expired state, activate it %f." % self.CalculateBytesTxTime())
-                    self.m_pacingTimer = self.CalculateBytesTxTime()
+                    self.m_pacingTimer = self.CalculateBytesTxTime() * (2 if self.m_pairOpen else 1)
+                    if self.m_pairOpen :
+                        self.m_pairOpen = False
+                        self.m_numSentSincePair = 0
                     break
             
             currentStreamcQueueSize = self.m_currentMaxSourceId - self.m_lastAckedSourceId
@@ -628,7 +1009,7 @@ class pepApp :
         # and use 'self.m_numSentRepairAfterIdle' to count repair packets sent. 
         # Until new data arrives, pepesc will get out of the idle state 
         # and use 'self.m_numSentRepairExcludeIdle' to count repair packets sent.
-        currentTime = time.time()
+        currentTime = time.monotonic()
         if self.m_lastSentSourceId == self.m_currentMaxSourceId :
             if self.m_newDataIdleState == False :
                 self.m_idleStateChangeTime = currentTime
@@ -639,6 +1020,15 @@ class pepApp :
             self.m_numSentRepairAfterIdle = 0
             self.m_idleCanSendRepairCount = 0
             self.m_newDataIdleState = False
+
+        # A flight was lost as a whole, probe its tail
+        if self.m_tailProbe :
+            self.m_tailProbe = False
+            return True
+
+        # The codec has no coded repair packet (null), a loss is only repaired by a retransmission
+        if not self.m_enc.RepairCapable :
+            return self.TimeToRetransmit(currentTime)
         
         # The inoder of the peer PEPesc is stuck, send repair packets earlier when the source packets are under-saturated.
         if self.m_duplicatedInorder == True :
@@ -653,7 +1043,7 @@ class pepApp :
             # heuristic
             if self.m_numSentRepairAfterIdle < 1 :
                 self.m_idleCanSendRepairCount += 1
-                if self.m_idleCanSendRepairCount == round (1 / (self.m_lossRate + ExtraRepairRate)) :
+                if self.m_idleCanSendRepairCount == round (1 / self.m_repairScheduler.RepairFrequency()) :
                     self.m_numSentRepairAfterIdle += 1
                     return True
             
@@ -662,11 +1052,13 @@ class pepApp :
             if currentTime - max(self.m_lastSentSourceTime, self.m_lastSentRepairTime) >= self.m_rttMin :
                 return True
         else :
-            # Repair the target insertion frequency of packets so that the expected mean decoding delay is 1/repairExcess packets
-            targetRepairFreq = self.m_lossRate + ExtraRepairRate
+            # Target insertion frequency of repair packets given by the loss model, 
+            # so that the chosen percentile of windows is recovered within the repair window
+            targetRepairFreq = self.m_repairScheduler.RepairFrequency()
             # Calculate the current required repair packet insertion frequency
             currentRepairFreq = self.m_numSentRepairExcludeIdle / (self.m_lastSentSourceId+1 + self.m_numSentRepairExcludeIdle) if self.m_lastSentSourceId >= 0 else 1
-            if currentRepairFreq < targetRepairFreq and self.m_enc.contents.headsid < self.m_enc.contents.nextsid - 1 :
+            if currentRepairFreq < targetRepairFreq and self.m_enc.headsid < self.m_enc.nextsid - 1 \
+                and self.m_numSourceSinceLastRepair >= self.m_repairScheduler.RepairSpacing() :
                 self.m_numSentRepairExcludeIdle += 1
                 return True
             else :
@@ -674,106 +1066,144 @@ class pepApp :
         return False
     
 
+    def AdaptAckInterval(self) :
+        # Raise N so that ACKs take at most AckReturnShare of the return link, whose bandwidth is what this entity
+        # estimates for its own sending, but keep MinAcksPerRtt ACKs per RTT for the estimators of the peer
+        interval = self.m_ackInterval
+        if self.m_recvRate > 0 and self.m_estBwMax > 0 :
+            interval = max(interval, math.ceil(self.m_recvRate * self.m_inorderAckPacketSize / (AckReturnShare * self.m_estBwMax * self.m_scPacketSize)))
+        if self.m_recvRate > 0 and self.m_rttMin != 1e6 :
+            interval = min(interval, max(1, math.floor(self.m_recvRate * self.m_rttMin / MinAcksPerRtt)))
+        self.m_currentAckInterval = min(max(interval, 1), MaxAckInterval)
+
+
+    def AckDeadlinePassed(self, currentTime) :
+        # Do not hold received packets unacked for longer than T, nor a due ACK for a data packet longer than PiggybackAckDelay
+        if self.m_ackPending :
+            return currentTime - self.m_ackPendingTime >= PiggybackAckDelay
+        return self.m_firstUnackedRecvTime > 0 and currentTime - self.m_firstUnackedRecvTime >= self.m_ackMaxDelay \
+            and self.m_latestRecvSourceNum + self.m_latestRecvRepairNum != self.m_numLastAcked
+
+
+    def CheckDelayedAck(self, currentTime) :
+        if self.AckDeadlinePassed(currentTime) :
+            self.SendDataAck()
+
+
     def RecvDataPackets(self, pkt) :      
-        buf = cast(pkt.body, POINTER(c_ubyte))
-        rpkt = streamc.deserialize_packet(self.m_dec, buf)
-        #rpkt.deserialize(buf, self.m_cp.pktsize)
-        receiveTime = time.time() 
+        if self.m_decoder is None :
+            logging.warning("[RecvDataPacket] Data packet before handshake, no decoder to decode it")
+            return
+        receiveTime = self.m_lastPktRecvTime
+        sendTimestamp = struct.unpack_from('d', pkt.body, len(pkt.body) - TimestampLength)[0]
+        # Two data packets sent back to back: their arrival dispersion is the transmission time at the bottleneck.
+        # A lost packet only spoils its own pair, which is then not back to back in sending time.
+        sendGap = sendTimestamp - self.m_lastRecvTimestamp
+        if self.m_lastRecvTimestamp > 0 and 0 < sendGap <= InbandPairMaxSendGap :
+            self.m_pairDispersions.append(max(receiveTime - self.m_lastRecvTime, sendGap))
+            self.m_newPairDispersion = True
+        self.m_lastRecvTimestamp = sendTimestamp
+        self.m_lastRecvTime = receiveTime
         outOrderRecv = False
+        # Count CE marks of every data packet, including out-dated ones, as they went through the same queues
+        ceMarked = self.m_ecnEnabled and (self.m_lastRecvTos & EcnMask) == EcnCE
+        if ceMarked :
+            self.m_latestRecvCeNum += 1
+        if self.m_firstUnackedRecvTime < 0 :
+            self.m_firstUnackedRecvTime = receiveTime
         
-        if rpkt.contents.sourceid != -1 :
+        # The packet is deserialized by the decoder, only peek at the ids leading the serialized packet (serial numbers)
+        sourceId, repairId = struct.unpack_from('ii', pkt.body)
+        sourceId = SeqUnwrap(sourceId, self.m_lastRecvSourceId)
+        repairId = SeqUnwrap(repairId, self.m_lastRecvRepairId)
+        if sourceId != -1 :
             self.m_latestRecvSourceNum += 1
-            self.m_numRecvSinceLastSourceAck += 1
+            self.m_numRecvSinceLastAck += 1
             self.m_latestRecvPktType = PacketInfoType['SOURCE_PACKET']
             # reject the received source packet
-            if rpkt.contents.sourceid <= self.m_dec.contents.inorder :
-                logging.warning("[RecvDataPacket] Received out-dated source packet: %d current inorder: %d" % (rpkt.contents.sourceid, self.m_dec.contents.inorder))
+            if sourceId <= self.m_decoder.m_inorder :
+                logging.warning("[RecvDataPacket] Received out-dated source packet: %d current inorder: %d" % (sourceId, self.m_decoder.m_inorder))
                 outOrderRecv = True
                 return
             
-            if rpkt.contents.sourceid < self.m_dec.contents.win_e :
-                logging.warning("[RecvDataPacket] Out-of-order source packet %d received, inorder: %d, win_e: %d" % (rpkt.contents.sourceid, 
-                                                                                                                      self.m_dec.contents.inorder, 
-                                                                                                                      self.m_dec.contents.win_e))
+            if sourceId < self.m_decoder.m_winE :
+                logging.warning("[RecvDataPacket] Out-of-order source packet %d received, inorder: %d, win_e: %d" % (sourceId, 
+                                                                                                                      self.m_decoder.m_inorder, 
+                                                                                                                      self.m_decoder.m_winE))
                 outOrderRecv = True
         else :
             self.m_latestRecvRepairNum += 1
+            self.m_numRecvSinceLastAck += 1
             self.m_latestRecvPktType = PacketInfoType['REPAIR_PACKET']
-            if rpkt.contents.repairid < self.m_lastRecvRepairId :
+            if repairId < self.m_lastRecvRepairId :
                 outOrderRecv = True
         
-        oldState   = self.m_dec.contents.active
-        oldInorder = self.m_dec.contents.inorder
-        
-        streamc.receive_packet(self.m_dec, rpkt)
-        # streamc.free_packet(rpkt)
-        
-        newState   = self.m_dec.contents.active
-        newInorder = self.m_dec.contents.inorder
-
-        log = "[DecoderStatus] inorder: %d" % self.m_dec.contents.inorder
-        log += " SOURCE packet %d" % rpkt.contents.sourceid if rpkt.contents.sourceid != -1 else " REPAIR packet %d" % rpkt.contents.repairid
-        
-        if rpkt.contents.repairid != -1 :
-            log += " encoding window: [ %d , %d ]" % (rpkt.contents.win_s, rpkt.contents.win_e)
-        
-        if self.m_dec.contents.active :
-            log += " current decoder state: active with window: [ %d , %d ]" % (self.m_dec.contents.win_s, self.m_dec.contents.win_e)
-        else :
-            log += " current decoder state: inactive"
-        logging.debug(log)
-
-        # Record the time of decoding source packets
-        if newInorder > oldInorder :
-            for i in range(oldInorder+1, newInorder+1) : 
-                logging.debug("[RecvDataPacket] Receive SOURCE packet %d" % i)
-         
-        # 解码器成功解码恢复出丢失分组，通知发送端解码成功
-        currentTime = time.time()
-        if oldState == 1 and newState == 0 :
-            self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['DECODE_SUCCESS']), str(currentTime).encode()).packed(), self.m_peerAddress)
-            
-            log = "[DecodingSuccess] Decoder is inactivated and delivered in-order source packets between: [%d , %d]" % (oldInorder + 1 , newInorder)
-            log += " with repair packet %d" % rpkt.contents.repairid
-            log += " arrive time: %f" % receiveTime
-            log += " decoding cost time: %f" % (currentTime - receiveTime)
-            logging.debug(log)
+        # Decoder state changes come back through HandleDecoderEvents
+        self.m_decoder.Submit(pkt.body, receiveTime)
         
         # 检测是否发生连续分组丢失现象
-        if rpkt.contents.sourceid != -1 :
-            if rpkt.contents.sourceid - self.m_lastRecvSourceId > 9 :
-                message = str(str(currentTime)) + ' SOURCE ' + str(rpkt.contents.sourceid - self.m_lastRecvSourceId)
+        currentTime = time.monotonic()
+        lossDetected = False
+        if sourceId != -1 :
+            lossDetected = sourceId > self.m_lastRecvSourceId + 1
+            if sourceId - self.m_lastRecvSourceId > 9 :
+                message = str(str(currentTime)) + ' SOURCE ' + str(sourceId - self.m_lastRecvSourceId)
                 self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['ADVERTISE_BURST']), message.encode()).packed(), self.m_peerAddress)
-            self.m_lastRecvSourceId = rpkt.contents.sourceid
+            self.m_lastRecvSourceId = sourceId
         else :
-            if rpkt.contents.repairid - self.m_lastRecvRepairId > 9 :
-                message = str(str(currentTime) + ' REPAIR ' + str(rpkt.contents.repairid - self.m_lastRecvRepairId))
+            if repairId - self.m_lastRecvRepairId > 9 :
+                message = str(str(currentTime) + ' REPAIR ' + str(repairId - self.m_lastRecvRepairId))
                 self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['ADVERTISE_BURST']), message.encode()).packed(), self.m_peerAddress)
-            self.m_lastRecvRepairId = rpkt.contents.repairid
+            self.m_lastRecvRepairId = repairId
         
         if not outOrderRecv and self.m_latestRecvSourceNum + self.m_latestRecvRepairNum != self.m_numLastAcked :
             threshold = self.m_initCWnd if self.m_activeProbeBw else 1000
-            if rpkt.contents.repairid != -1 :
-                self.SendDataAck()
-            elif self.m_numRecvSinceLastSourceAck >= SourceAckInterval or rpkt.contents.sourceid < threshold :
-                self.m_numRecvSinceLastSourceAck = 0
+            if lossDetected or ceMarked :
+                # A gap of source ids or a CE mark is fed back at once rather than after N packets
                 self.SendDataAck()
+            elif self.m_numRecvSinceLastAck >= self.m_currentAckInterval or sourceId < threshold :
+                self.ScheduleDataAck(currentTime)
             
         return 
 
 
+    def HandleDecoderEvents(self) :
+        if self.m_decoder is None :
+            return
+        while True :
+            event = self.m_decoder.PopEvent()
+            if event is None :
+                break
+            # 解码器成功解码恢复出丢失分组，通知发送端解码成功
+            currentTime = time.monotonic()
+            if event.oldState == 1 and event.newState == 0 :
+                self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['DECODE_SUCCESS']), str(currentTime).encode()).packed(), self.m_peerAddress)
+                
+                log = "[DecodingSuccess] Decoder is inactivated and delivered in-order source packets between: [%d , %d]" % (event.oldInorder + 1 , event.newInorder)
+                log += " with repair packet %d" % event.repairId
+                log += " arrive time: %f" % event.receiveTime
+                log += " decoding cost time: %f" % (currentTime - event.receiveTime)
+                logging.debug(log)
+            
+            # A decoder (in)activation or a recovery by repair is fed back at once rather than after N packets
+            if self.m_latestRecvSourceNum + self.m_latestRecvRepairNum != self.m_numLastAcked :
+                self.SendDataAck()
+        
+        return
+
+
     def SendProbePackets(self) :
         self.m_probeBw = 0
         self.m_probePacketSentTimes = []
 
         probePacketId = 0
         while probePacketId < ProbeTrainLength :
-            filler = ' ' * (ProbePacketSize - PepHeaderLength - len(str(probePacketId).encode()))
+            filler = ' ' * (self.m_scPacketSize - PepHeaderLength - len(str(probePacketId).encode()))
             self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['PROBE']), str(probePacketId).encode() + filler.encode()).packed(), self.m_peerAddress)
             probePacketId += 1
-            self.m_probePacketSentTimes.append(time.time())
+            self.m_probePacketSentTimes.append(time.monotonic())
         
-        self.m_lastProbedTime = time.time() 
+        self.m_lastProbedTime = time.monotonic() 
 
         return 
 
@@ -783,7 +1213,7 @@ class pepApp :
         if probePacketId == 0 :
             self.m_lastProbeArrivedId = 0
             self.m_probeValidity = True
-            self.m_firstProbeArriveTime = time.time()
+            self.m_firstProbeArriveTime = self.m_lastPktRecvTime
         else :
             # Regardless of whether the last packet arrived, or whether the variable was reset in the last bandwidth probe, 
             # if any of the packets in this bandwidth probe are lost (including the first one), the condition will not be valid, 
@@ -796,7 +1226,7 @@ class pepApp :
         
         if self.m_probeValidity :
             if probePacketId == ProbeTrainLength-1 :
-                trainDispersion = time.time() - self.m_firstProbeArriveTime
+                trainDispersion = self.m_lastPktRecvTime - self.m_firstProbeArriveTime
                 message = str(probePacketId) + ' ' + str(trainDispersion)
             else :
                 message = str(probePacketId) 
@@ -808,18 +1238,27 @@ class pepApp :
         probeAckId = int(message[0])
 
         sendTime = self.m_probePacketSentTimes[probeAckId]
-        recvTime = time.time()
+        recvTime = self.m_lastPktRecvTime
         self.RttEstimation(recvTime, sendTime)
 
         if probeAckId == ProbeTrainLength-1 :
             alpha = 0.9
             trainDispersion = float(message[1])
-            instantaneousEstBw = (ProbeTrainLength-1) / trainDispersion * ProbePacketSize / ScPacketSize # pkts/sec.
+            instantaneousEstBw = (ProbeTrainLength-1) / trainDispersion # pkts/sec.
             self.m_probeBw = alpha * self.m_probeBw + (1-alpha) * instantaneousEstBw  if self.m_probeBw != 0 else instantaneousEstBw # smoothed probe bandwidth
-            self.m_estBw = self.m_probeBw * 0.8
-            self.m_maxBwFilter.Insert(recvTime, self.m_estBw)
+            self.m_pathMeasured = True
+            # Validate the bandwidth seeded from the path cache against the first probe, start afresh if the path got slower
+            if self.m_pathSeedBw > 0 :
+                if self.m_probeBw < PathCacheMismatch * self.m_pathSeedBw :
+                    log = "Cached maxBw %f pkts/sec. dropped, probed %f pkts/sec." % (self.m_pathSeedBw, self.m_probeBw)
+                    self.HandleLog('WARNING', "[PathCache] ", log, self.m_detailFlag)
+                    self.CreateCongestionController()
+                self.m_pathSeedBw = 0
+            sample = AckSample(recvTime, 0, recvTime - sendTime, self.m_rtt, self.m_rttMin, packetsInFlight=self.m_packetsInFlight)
+            self.RampCwnd()
+            self.m_cc.OnBwProbe(recvTime, self.m_probeBw, sample)
             self.UpdateCwnd()
-            log = "EstBw: %f Mbps CWND: %d pkts RTT: %f ms." % (self.m_estBw*ScPacketSize*8/1024/1024, self.m_cWnd, self.m_rtt*1000)
+            log = "EstBw: %f Mbps CWND: %d pkts RTT: %f ms." % (self.m_estBw*self.m_scPacketSize*8/1024/1024, self.m_cWnd, self.m_rtt*1000)
             logging.info("[BwProbe] %s" % log)
             if self.m_detailFlag :
                 print("[%s][%s:%d] %s" % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], log))
@@ -827,9 +1266,34 @@ class pepApp :
         return 
 
 
+    def RecvPepDatagram(self) :
+        """ Receive one datagram from the tunnel socket, together with its TOS byte (ECN)
+            and arrival time (kernel timestamp) when enabled
+        """
+        if not self.m_ecnEnabled and not self.m_kernelTimestamps :
+            data, addr = self.m_udpSocket.recvfrom(UdpBufSize)
+            self.m_lastPktRecvTime = time.monotonic()
+            return data
+
+        data, ancdata, flags, addr = self.m_udpSocket.recvmsg(UdpBufSize, socket.CMSG_SPACE(1) + socket.CMSG_SPACE(struct.calcsize(TimespecFormat)))
+        currentTime = time.monotonic()
+        self.m_lastPktRecvTime = currentTime
+        self.m_lastRecvTos = 0
+        for cmsgLevel, cmsgType, cmsgData in ancdata :
+            if cmsgLevel == socket.IPPROTO_IP and cmsgType == socket.IP_TOS and len(cmsgData) > 0 :
+                self.m_lastRecvTos = cmsgData[0]
+            elif cmsgLevel == socket.SOL_SOCKET and cmsgType == SoTimestampNs and len(cmsgData) >= struct.calcsize(TimespecFormat) :
+                sec, nsec = struct.unpack_from(TimespecFormat, cmsgData)
+                # The kernel stamps CLOCK_REALTIME, move it onto the monotonic clock by its age
+                age = time.time() - (sec + nsec * 1e-9)
+                if 0 <= age <= KernelTimestampMaxAge :
+                    self.m_lastPktRecvTime = currentTime - age
+        return data
+
+
     def ReceiveAndHandlePepPacket(self) :
         # Receive pep packet
-        data, addr = self.m_udpSocket.recvfrom(UdpBufSize)
+        data = self.RecvPepDatagram()
         if len(data) == 0 :
             return
         pkt = PepPacket()
@@ -837,11 +1301,34 @@ class pepApp :
         
         # Handle pep packet
         if pkt.header.mtype == PepPacketType['HANDSHAKE'] :
-            self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['HANDSHAKE_ACK'])).packed(), self.m_peerAddress)
+            # The peer asks for the ACK frequency "N T" of its data packets, the codec to decode them with, their
+            # symbol size and the decoder window, answer with what is agreed. An empty handshake comes from a legacy
+            # peer which expects every packet acked, a handshake without codec from one which encodes with gf256,
+            # one without symbol size from one which sends symbols of MsgDataMaxLength bytes, and one without
+            # window from one which keeps DEC_ALLOC source packets in flight at most.
+            message = pkt.body.decode().split(' ') if len(pkt.body) > 0 else []
+            if len(message) >= 2 :
+                self.m_peerPiggyback = True
+                self.m_ackInterval = min(max(int(message[0]), 1), MaxAckInterval)
+                self.m_ackMaxDelay = min(max(float(message[1]), 0.0), MaxDataAckDelay)
+            self.m_currentAckInterval = self.m_ackInterval
+            if self.m_decoder is None :
+                self.CreateDecoder(message[2] if len(message) >= 3 and message[2] in Codecs else Codecs[0], self.AgreeMsgDataLength(message[3:5]),
+                                   int(message[5]) if len(message) >= 6 else DEC_ALLOC)
+            message = "%d %f %s %d %d" % (self.m_ackInterval, self.m_ackMaxDelay, self.m_decodeCodec, self.m_recvMsgDataLength, self.m_dec.capacity)
+            self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['HANDSHAKE_ACK']), message.encode()).packed(), self.m_peerAddress)
 
         elif pkt.header.mtype == PepPacketType['HANDSHAKE_ACK'] :
             self.EstablishPEPConnection(pkt)
         
+        elif pkt.header.mtype == PepPacketType['REBASE'] :
+            self.RebaseDecoder(pkt.body.decode().split(' '))
+
+        elif pkt.header.mtype == PepPacketType['REBASE_ACK'] :
+            message = pkt.body.decode().split(' ')
+            if self.m_rebase is not None and int(message[0]) == self.m_rebase[0] :
+                self.RebaseEncoder(int(message[1]))
+
         elif pkt.header.mtype == PepPacketType['WAVEHAND'] :
             self.ClosePEPConnection(pkt)
 
@@ -851,11 +1338,25 @@ class pepApp :
         elif pkt.header.mtype == PepPacketType['SC_PROTECTED_PKT'] :
             self.RecvDataPackets(pkt)
 
+        elif pkt.header.mtype == PepPacketType['SC_PROTECTED_ACK_PKT'] :
+            # Handle the piggybacked ACK first, then the data packet without it
+            ackEnd = len(pkt.body) - TimestampLength
+            ackStart = ackEnd - struct.calcsize(InorderAckFormat)
+            self.RecvDataAck(pkt.body[ackStart : ackEnd])
+            pkt.body = pkt.body[ : ackStart] + pkt.body[ackEnd : ]
+            self.RecvDataPackets(pkt)
+
         elif pkt.header.mtype == PepPacketType['SC_DATA_ACK'] :
-            self.RecvDataAck(pkt)
+            self.RecvDataAck(pkt.body)
 
         elif pkt.header.mtype == PepPacketType['PROBE'] :
             self.RecvProbePacketAndSendProbeAck(pkt)
+
+        elif pkt.header.mtype == PepPacketType['MTU_PROBE'] :
+            # It got through the path at the IP datagram size it carries, if it arrived whole
+            mtu = len(data) + TunnelHeaderLength
+            if pkt.body.split(b' ', 1)[0] == str(mtu).encode() :
+                self.m_largestProbedMtu = max(self.m_largestProbedMtu, mtu)
             
         elif pkt.header.mtype == PepPacketType['PROBE_ACK'] :
             self.RecvProbeAcks(pkt)
@@ -867,12 +1368,13 @@ class pepApp :
             burstPacketType    = message[1]
             burstPacketsNumber = int(message[2])
 
-            self.m_lastBurstTime = time.time()
+            self.m_lastBurstTime = time.monotonic()
+            self.m_lossModel.OnBurstAdvertised(self.m_lastBurstTime, burstPacketsNumber)
             
             logging.warning("[Burst] Peer PEPesc Receiver advertised burst %s %d packets." % (burstPacketType, burstPacketsNumber))
         
         elif pkt.header.mtype == PepPacketType['DECODE_SUCCESS'] :
-            self.m_lastDecSuccTime = float(pkt.body.decode())
+            logging.debug("[DECODE_SUCCESS] Peer PEPesc decoded successfully at %s." % pkt.body.decode())
         
         elif pkt.header.mtype == PepPacketType['HEARTBEAT_ACK'] :
             logging.debug("[HEARTBEAT_ACK] heartbeat ACK received.")    # nothing needs to be done here, since response update has been done when reading packets from channel
@@ -886,38 +1388,34 @@ class pepApp :
     def HandleScPayloads(self) :
         readScPayloadNumber = 0 
         maxAllowReadOnce    = 10
-        while self.m_dec.contents.inorder >= self.m_inorderNext and readScPayloadNumber < maxAllowReadOnce :
-            buf = self.m_dec.contents.recovered[self.m_inorderNext % DEC_ALLOC]
+        if self.m_decoder is None :
+            return
+        while self.m_decoder.m_inorder >= self.m_inorderNext and readScPayloadNumber < maxAllowReadOnce :
+            payload = self.m_decoder.Payload(self.m_inorderNext)     # bytes-like
             readScPayloadNumber += 1
             self.m_inorderNext += 1
-            if buf is None :
+            if payload is None :
                 break
-            payload = bytes(cast(buf, POINTER(c_ubyte * self.m_cp.pktsize))[0]) # class 'bytes'
 
             scPayLoad = SCPayload()
             scPayLoad.parse(payload)
             neighbor = scPayLoad.tcpDestinationAddr
             remote   = scPayLoad.tcpSourceAddr
-            recvAddr = (remote[0], remote[1], neighbor[0], neighbor[1])
-            sendAddr = (neighbor[0], neighbor[1], remote[0], remote[1])
+            flow     = self.m_flows.Find(neighbor, remote)
 
             if scPayLoad.msg == ScProtectedMsg['TCP_RAW_DATA'] :
                 # Use the corresponding channel for application sending
-                if recvAddr not in self.m_findChidForPEPescToSend :
+                if flow is None or flow.chid == -1 :
                     return
-                channel = self.m_channels[self.m_findChidForPEPescToSend[recvAddr]]
+                channel = self.m_channels[flow.chid]
                 channel.send(scPayLoad.msgData)
-                self.m_tcpRecvBufLen[recvAddr] += len(scPayLoad.msgData)
-
-                if recvAddr in self.m_linkToBeClosed and self.m_tcpRecvBufLen[recvAddr] == self.m_linkToBeClosed[recvAddr] :
-                    neighborRecvTcpDataLength = self.m_tcpRecvBufLen[recvAddr]
-                    neighborSentTcpDataLength = self.m_tcpSentBufLen[sendAddr]
-                    chid = self.m_findChidForPEPescToSend[recvAddr]
-                    CloseChannel(self.m_channels, chid)
-                    del self.m_findChidForPEPescToSend[recvAddr]
-                    del self.m_linkToBeClosed[recvAddr]
-                    del self.m_tcpRecvBufLen[recvAddr]
-                    del self.m_tcpSentBufLen[sendAddr]
+                flow.recvBufLen += len(scPayLoad.msgData)
+
+                if flow.recvBufLen == flow.toBeClosedLen :
+                    neighborRecvTcpDataLength = flow.recvBufLen
+                    neighborSentTcpDataLength = flow.sentBufLen
+                    CloseChannelWhenSent(self.m_channels, flow.chid)
+                    self.m_flows.Remove(flow)
                     if self.m_detailFlag :
                         print("[%s][%s:%d] Close channel with %s:%d."\
                             % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], neighbor[0], neighbor[1]))
@@ -931,20 +1429,16 @@ class pepApp :
                     print("Open channel error,Exit!")
                     sys.exit()
 
-                self.m_findChidForPEPescToSend[recvAddr] = chid
-                self.m_tcpRecvBufLen[recvAddr] = 0
-                self.m_tcpSentBufLen[sendAddr] = 0
+                flow = self.m_flows.Add(neighbor, remote)
+                flow.chid = chid
                 #print("[%s][%s:%d] Try to connect to %s:%d."\
                 #        % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], neighbor[0], neighbor[1]))
 
             elif scPayLoad.msg == ScProtectedMsg['REMOTE_EXIST'] :
-                tcpReceiver = self.m_tcpReceiverWaiting[sendAddr]
-                del self.m_tcpReceiverWaiting[sendAddr]
-                chid = OpenInConnChannel(self.m_channels, tcpReceiver, remote, maxWaitTime=0.02)
-
-                self.m_findChidForPEPescToSend[recvAddr] = chid
-                self.m_tcpRecvBufLen[recvAddr] = 0
-                self.m_tcpSentBufLen[sendAddr] = 0
+                if flow is None or flow.tcpReceiver is None :
+                    return
+                flow.chid = OpenInConnChannel(self.m_channels, flow.tcpReceiver, remote, maxWaitTime=0.02)
+                flow.tcpReceiver = None
                 
                 if self.m_detailFlag :
                     print("[%s][%s:%d] Peer PEPesc reports that connecting to %s:%d successfully."\
@@ -952,9 +1446,10 @@ class pepApp :
                 logging.info("[TCP] Connect success {%s:%d -> %s:%d}" % (neighbor[0], neighbor[1], remote[0], remote[1]))
 
             elif scPayLoad.msg == ScProtectedMsg['REMOTE_NOT_EXIST'] :
-                tcpReceiver = self.m_tcpReceiverWaiting[sendAddr]
-                tcpReceiver.close()
-                del self.m_tcpReceiverWaiting[sendAddr]
+                if flow is None or flow.tcpReceiver is None :
+                    return
+                flow.tcpReceiver.close()
+                self.m_flows.Remove(flow)
                 if self.m_detailFlag :
                     print("[%s][%s:%d] Peer PEPesc reports that failed to connect to %s:%d."\
                         % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], remote[0], remote[1]))
@@ -962,25 +1457,22 @@ class pepApp :
             elif scPayLoad.msg == ScProtectedMsg['REMOTE_EXIT'] :
                 remoteTotalSentTcpDataLength = int(scPayLoad.msgData)
                 # If I have not created a channel for the connection or has closed the channel, ignore this notification
-                if recvAddr not in self.m_findChidForPEPescToSend :
+                if flow is None or flow.chid == -1 :
                     return
                 if self.m_detailFlag :
                     print("[%s][%s:%d] Peer PEPesc reports that %s:%d has exited."\
                         % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], remote[0], remote[1]))
 
                 # If I have sent all the data, immediately closing the connection with my neighbor, or waiting to receive and send full TCP data
-                if self.m_tcpRecvBufLen[recvAddr] == remoteTotalSentTcpDataLength :
-                    chid = self.m_findChidForPEPescToSend[recvAddr]
-                    CloseChannel(self.m_channels, chid)
+                if flow.recvBufLen == remoteTotalSentTcpDataLength :
+                    CloseChannelWhenSent(self.m_channels, flow.chid)
                     
-                    neighborRecvTcpDataLength = self.m_tcpRecvBufLen[recvAddr]
-                    neighborSentTcpDataLength = self.m_tcpSentBufLen[sendAddr]
+                    neighborRecvTcpDataLength = flow.recvBufLen
+                    neighborSentTcpDataLength = flow.sentBufLen
                     self.m_totalDataSentSize += neighborSentTcpDataLength
                     self.m_totalDataRecvSize += neighborRecvTcpDataLength
                     
-                    del self.m_findChidForPEPescToSend[recvAddr]
-                    del self.m_tcpRecvBufLen[recvAddr]
-                    del self.m_tcpSentBufLen[sendAddr]
+                    self.m_flows.Remove(flow)
                     
                     if self.m_detailFlag :
                         print("[%s][%s:%d] Close channel with %s:%d."\
@@ -989,7 +1481,7 @@ class pepApp :
                             % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1],\
                             neighbor[0], neighbor[1], remote[0], remote[1], neighborSentTcpDataLength/1024/1024, neighborRecvTcpDataLength/1024/1024))
                 else :
-                    self.m_linkToBeClosed[recvAddr] = remoteTotalSentTcpDataLength
+                    flow.toBeClosedLen = remoteTotalSentTcpDataLength
 
         return 
 
@@ -997,14 +1489,15 @@ class pepApp :
     def ReadChannels(self, readableChannelIds) :
         for chid in readableChannelIds :#list(self.m_channels) :
             ch = self.m_channels[chid]
-            sendAddr = (ch.neighbor[0], ch.neighbor[1], ch.remote[0], ch.remote[1])
+            flow = self.m_flows.Find(ch.neighbor, ch.remote)
             if (ch.eventmask & CH_READ) :
                 while True :
                     tcpRawData = ch.receive() # class 'bytes'
                     if not tcpRawData :
                         break
-                    self.EnqueuePackets(ScProtectedMsg['TCP_RAW_DATA'], ch.neighbor, ch.remote, tcpRawData)
-                    self.m_tcpSentBufLen[sendAddr] += len(tcpRawData)
+                    self.EnqueuePackets(ScProtectedMsg['TCP_RAW_DATA'], ch.neighbor, ch.remote, tcpRawData, ch.lastReceived.time, flow)
+                    if flow is not None :
+                        flow.sentBufLen += len(tcpRawData)
 
                     logging.debug("[MsgQueueSize] %d %d" % (chid, self.m_channels[chid].recvq.size()))
                     logging.debug("[StreamcQueueSize] %d" % (self.m_currentMaxSourceId - self.m_lastAckedSourceId))
@@ -1014,8 +1507,9 @@ class pepApp :
     
     def HandlePollReports(self, pollReports) :
         for (chid, msg, neighbor, remote) in pollReports :
-            recvAddr = (remote[0], remote[1], neighbor[0], neighbor[1])
-            sendAddr = (neighbor[0], neighbor[1], remote[0], remote[1])
+            flow = self.m_flows.Find(neighbor, remote)
+            if flow is None :
+                continue
 
             if msg == PollChannelMsg['CONNECT_SUCCESS'] : 
                 # Notify the peer PEPesc that the connection to the original destination is successful
@@ -1036,8 +1530,8 @@ class pepApp :
                 # Notify the peer PEPesc that my neighbor has exited, 
                 # request to mark the connection as about to be closed, 
                 # and close it immediately after receiving and sending complete TCP data.
-                neighborRecvTcpDataLength = self.m_tcpRecvBufLen[recvAddr]
-                neighborSentTcpDataLength = self.m_tcpSentBufLen[sendAddr]
+                neighborRecvTcpDataLength = flow.recvBufLen
+                neighborSentTcpDataLength = flow.sentBufLen
                 self.EnqueuePackets(ScProtectedMsg['REMOTE_EXIT'], neighbor, remote, str(neighborSentTcpDataLength).encode())
                 self.m_totalDataSentSize += neighborSentTcpDataLength
                 self.m_totalDataRecvSize += neighborRecvTcpDataLength
@@ -1049,35 +1543,38 @@ class pepApp :
                         % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1],\
                         neighbor[0], neighbor[1], remote[0], remote[1], neighborSentTcpDataLength/1024/1024, neighborRecvTcpDataLength/1024/1024))
                 
-            del self.m_findChidForPEPescToSend[recvAddr]
-            del self.m_tcpRecvBufLen[recvAddr]
-            del self.m_tcpSentBufLen[sendAddr]
+            self.m_flows.Remove(flow)
         
         return
 
 
     def InterceptTcpConnection(self) :
-        tcpReceiver, neighbor = self.m_tcpListener.accept()
-        remote = self.GetOriginalDst(tcpReceiver)
-
-        if not self.m_peerOnline :
-            tcpReceiver.close()
-            log = "Peer PEPesc is offline or haven't connected, reject "
-        elif self.m_selfPreClose :
-            tcpReceiver.close()
-            log = "PEPesc will be closed, reject "
-        else :
-            sendAddr = (neighbor[0], neighbor[1], remote[0], remote[1])
-            self.m_tcpReceiverWaiting[sendAddr] = tcpReceiver
-            self.EnqueuePackets(ScProtectedMsg['REMOTE_REQUEST'], neighbor, remote)
-            log = "Intercept "
-        
-        self.m_rejectConnectionNum += 1
+        # Drain the listen backlog in one go, so that a connection storm does not take one loop per connection
+        for i in range(MaxAcceptBatch) :
+            try :
+                tcpReceiver, neighbor = self.m_tcpListener.accept()
+            except BlockingIOError :
+                break
+            remote = self.GetOriginalDst(tcpReceiver)
 
-        log += "connection request {%s:%d -> %s:%d}." % (neighbor[0], neighbor[1], remote[0], remote[1])
-        logging.info("[TCP] %s" % log)
-        if self.m_detailFlag :
-            print("[%s][%s:%d] %s" % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], log))
+            if not self.m_peerOnline :
+                tcpReceiver.close()
+                log = "Peer PEPesc is offline or haven't connected, reject "
+            elif self.m_selfPreClose :
+                tcpReceiver.close()
+                log = "PEPesc will be closed, reject "
+            else :
+                flow = self.m_flows.Add(neighbor, remote)
+                flow.tcpReceiver = tcpReceiver
+                self.EnqueuePackets(ScProtectedMsg['REMOTE_REQUEST'], neighbor, remote)
+                log = "Intercept "
+            
+            self.m_rejectConnectionNum += 1
+
+            log += "connection request {%s:%d -> %s:%d}." % (neighbor[0], neighbor[1], remote[0], remote[1])
+            logging.info("[TCP] %s" % log)
+            if self.m_detailFlag :
+                print("[%s][%s:%d] %s" % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], log))
 
         return 
 
@@ -1117,18 +1614,90 @@ class pepApp :
                 if self.m_detailFlag :
                     print("[%s][%s:%d] %s" % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], log))
             
-            self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['HANDSHAKE'])).packed(), self.m_peerAddress)
-            self.m_lastHandShakeTime = time.time()
+            # Ask for the symbol size of the MTU set, or of the largest MTU probe sent ahead of the handshake
+            if self.m_tunnelMtu :
+                largestProbeMtu = 0
+                askMsgDataLength = self.m_msgDataLength
+            else :
+                largestProbeMtu = self.SendMtuProbes()
+                askMsgDataLength = MsgDataLengthForMtu(largestProbeMtu or PmtuFallbackMtu)
+            self.m_askedDecoderWindow = self.AskDecoderWindow()
+            message = "%d %f %s %d %d %d" % (self.m_askAckInterval, self.m_askAckMaxDelay, self.m_askCodec, askMsgDataLength, largestProbeMtu, self.m_askedDecoderWindow)
+            self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['HANDSHAKE']), message.encode()).packed(), self.m_peerAddress)
+            self.m_lastHandShakeTime = time.monotonic()
         
         else :
-            # After the connection is successful, randomly backoff bandwidth probing (to avoid burst congestion)
+            # After the connection is successful, probe the capacity at once to ramp up within the first RTTs,
+            # then randomly backoff the periodic bandwidth probing (to avoid burst congestion)
             self.m_peerOnline = True
-            self.m_lastProbedTime = time.time() - random.uniform(1/2*ProbeInterval, ProbeInterval)
+            # The ACK frequency and the codec agreed by the peer, none from a legacy peer
+            message = pkt.body.decode().split(' ') if len(pkt.body) > 0 else []
+            if len(message) >= 2 :
+                self.m_peerPiggyback = True
+                self.m_peerAckInterval, self.m_peerAckMaxDelay = int(message[0]), float(message[1])
+            logging.info("[PEPesc] Peer acks every %d packets or %f ms" % (self.m_peerAckInterval, self.m_peerAckMaxDelay * 1000))
+            if self.m_enc is None :
+                codec = message[2] if len(message) >= 3 and message[2] in Codecs else Codecs[0]
+                if codec != self.m_askCodec :
+                    logging.warning("[PEPesc] Peer decodes with codec %s instead of %s" % (codec, self.m_askCodec))
+                self.CreateEncoder(codec, int(message[3]) if len(message) >= 4 else MsgDataMaxLength)
+                # The cached rates are converted to packets of the symbol size agreed
+                self.LoadPathParameters()
+                # The decoder window taken by the peer, which then also rebases its decoder at the end of a coding epoch
+                if len(message) >= 5 :
+                    self.m_peerRebase = True
+                    self.m_peerDecoderWindow = int(message[4])
+                    if self.m_peerDecoderWindow != self.m_askedDecoderWindow :
+                        logging.info("[PEPesc] Peer keeps a decoder window of %d packets instead of the %d asked" \
+                            % (self.m_peerDecoderWindow, self.m_askedDecoderWindow))
+                logging.info("[PEPesc] Peer decoder window %d packets" % self.m_peerDecoderWindow)
+            if self.m_activeProbeBw :
+                self.SendProbePackets()
+            self.m_lastProbedTime = time.monotonic() - random.uniform(0, 1/2*ProbeInterval)
             log = "Connect peer PEPesc %s:%d successfully." % (self.m_peerAddress[0], self.m_peerAddress[1])
             if self.m_detailFlag :
                 print("[%s][%s:%d] %s" % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], log))
 
     
+    def SendMtuProbes(self) :
+        # Send an MTU_PROBE of each IP datagram size of PmtuProbeMtus with DF set, ignoring the path MTU known to the
+        # kernel, and return the largest sent (0 if none). Those larger than the MTU of the interface are refused.
+        try :
+            discover = self.m_udpSocket.getsockopt(socket.IPPROTO_IP, IpMtuDiscover)
+            self.m_udpSocket.setsockopt(socket.IPPROTO_IP, IpMtuDiscover, IpPmtuDiscProbe)
+        except OSError as details :
+            logging.warning("[PMTU] Cannot set DF on MTU probes: %s" % details)
+            discover = None
+        largestProbeMtu = 0
+        for mtu in PmtuProbeMtus :
+            body = str(mtu).encode()
+            body += b' ' * (mtu - TunnelHeaderLength - PepHeaderLength - len(body))
+            try :
+                self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['MTU_PROBE']), body).packed(), self.m_peerAddress)
+                largestProbeMtu = max(largestProbeMtu, mtu)
+            except OSError as details :
+                logging.debug("[PMTU] MTU probe of %d bytes not sent: %s" % (mtu, details))
+        if discover is not None :
+            self.m_udpSocket.setsockopt(socket.IPPROTO_IP, IpMtuDiscover, discover)
+        return largestProbeMtu
+
+
+    def AgreeMsgDataLength(self, message) :
+        # The symbol size of the data packets of the peer, from the "symbol size, largest MTU probe sent" it asks for:
+        # no larger than the largest MTU probe received, when it probed, nor than the MTU set on this side
+        if len(message) < 2 :
+            return MsgDataMaxLength
+        msgDataLength, largestProbeMtu = int(message[0]), int(message[1])
+        if largestProbeMtu > 0 :
+            msgDataLength = min(msgDataLength, MsgDataLengthForMtu(self.m_largestProbedMtu or PmtuFallbackMtu))
+        if self.m_tunnelMtu :
+            msgDataLength = min(msgDataLength, MsgDataLengthForMtu(self.m_tunnelMtu))
+        msgDataLength = min(max(msgDataLength, MinMsgDataLength), MaxMsgDataLength)
+        logging.info("[PMTU] Peer sends %d-byte symbols, asked for %d, largest MTU probe sent %d received %d" \
+            % (msgDataLength, int(message[0]), largestProbeMtu, self.m_largestProbedMtu))
+        return msgDataLength
+
+
     # Close connection between PEP entities
     def ClosePEPConnection(self, pkt=None) :
         self.m_selfClose = True
@@ -1155,7 +1724,7 @@ class pepApp :
             if self.m_detailFlag :
                 print("[%s][%s:%d] %s" % (time.strftime('%Y-%m-%d %X',time.localtime()), self.m_selfAddress[0], self.m_selfAddress[1], log))
         else :
-            self.m_lastHeartBeatTime = time.time()
+            self.m_lastHeartBeatTime = time.monotonic()
             self.m_udpSocket.sendto(PepPacket(PepHeader(PepPacketType['HEARTBEAT'])).packed(), self.m_peerAddress)
 
 
@@ -1168,7 +1737,12 @@ class pepApp :
                 
                 udpPollEvents = (select.POLLIN)
 
-                currentTime = time.time()
+                currentTime = time.monotonic()
+                if self.m_peerOnline :
+                    self.m_cc.OnTimer(currentTime, self.m_packetsInFlight)
+                    self.UpdateCwnd()
+                    self.CheckRecoveryTimeout(currentTime)
+
                 if not self.m_peerOnline :
                     if currentTime - self.m_lastHandShakeTime >= HandShakeInterval :
                         udpPollEvents |= select.POLLOUT
@@ -1188,10 +1762,28 @@ class pepApp :
                                 and currentTime - max(self.m_lastProbedTime, self.m_lastSentSourceTime, self.m_lastSentRepairTime) >= ProbeInterval :
                             udpPollEvents |= select.POLLOUT
 
+                        if self.RebaseDue(currentTime) :
+                            udpPollEvents |= select.POLLOUT
+
+                # A data ACK held back for T is due
+                if self.AckDeadlinePassed(currentTime) :
+                    udpPollEvents |= select.POLLOUT
+
                 # Poll tcpListener, udpSocket and TCP channels
                 pepescAvailableBw = self.m_constBw if self.m_constBw else self.m_estBwMax # pkts/sec. 
-                tcpAvailableBwMax = (1-self.m_lossRate-ExtraRepairRate) * pepescAvailableBw * MsgDataMaxLength * 8 if pepescAvailableBw != 0 else 5 * 1024 * 1024 # bps
-                bufferRemain = MaxBufferQueueLength - (self.m_currentMaxSourceId - self.m_lastSentSourceId)
+                sourceRate = (1-self.m_lossRate-ExtraRepairRate) * pepescAvailableBw  # source pkts/sec.
+                tcpAvailableBwMax = sourceRate * self.m_msgDataLength * 8 if pepescAvailableBw != 0 else 5 * 1024 * 1024 # bps
+                # Source packets admitted into the encoder, from the unsent backlog and those not acked in order
+                backlog   = self.m_currentMaxSourceId - self.m_lastSentSourceId
+                occupancy = self.m_currentMaxSourceId - self.m_lastAckedInorderId
+                self.m_admission.Update(currentTime, sourceRate, self.m_rttMin, self.m_peerDecoderWindow * DecoderWindowShare, backlog)
+                bufferRemain = self.m_admission.Allowance(backlog, occupancy)
+                # TCP is not read past the end of a coding epoch, until the peer has rebased
+                if self.m_peerRebase and (self.m_rebase is not None or self.m_currentMaxSourceId + 1 - self.m_enc.sourceBase >= CodingEpochLength) :
+                    bufferRemain = 0
+                # Flows whose data sojourned too long in PEPesc are not read for a while, TCP flow control pushes back
+                if self.m_pausedFlows :
+                    self.ResumeFlows(currentTime)
                 (readableTcpChannelIds, pollReports) = PollChannels(self.m_channels, tcpAvailableBwMax, bufferRemain, udpPollEvents)
 
                 # tcpListener catch tcp connection
@@ -1200,7 +1792,7 @@ class pepApp :
                 
                 # Always reset the heartbeat counter and update response time when receiving something from the peer entity
                 if self.m_channels[self.m_udpChid].eventmask & CH_READ :
-                    self.m_lastResponseTime = time.time()
+                    self.m_lastResponseTime = time.monotonic()
                     self.m_heartBeatTimes = 0
                     self.ReceiveAndHandlePepPacket()
                 
@@ -1210,12 +1802,15 @@ class pepApp :
                 # Handle poll reports
                 self.HandlePollReports(pollReports)
 
-                # Handle ScPayload from source packets in decoder's recoverd queue
+                # React to decoder state changes, then handle ScPayload from source packets in decoder's recoverd queue
+                self.HandleDecoderEvents()
                 self.HandleScPayloads()
 
                 # Have something to send
-                currentTime = time.time()
+                currentTime = time.monotonic()
                 if self.m_channels[self.m_udpChid].eventmask & CH_WRITE :
+                    self.CheckDelayedAck(currentTime)
+
                     if not self.m_peerOnline :
                         if currentTime - self.m_lastHandShakeTime >= HandShakeInterval :
                             self.EstablishPEPConnection()
@@ -1236,6 +1831,9 @@ class pepApp :
                             (self.m_currentMaxSourceId == -1 or self.m_inorderAck.inorder == self.m_currentMaxSourceId) \
                                 and currentTime - max(self.m_lastProbedTime, self.m_lastSentSourceTime, self.m_lastSentRepairTime) >= ProbeInterval :
                             self.SendProbePackets()
+
+                        if self.RebaseDue(currentTime) :
+                            self.SendRebase(currentTime)
                 
                 # Update heartbeat time
                 self.m_lastHeartBeatTime = max(self.m_lastHeartBeatTime, self.m_lastHandShakeTime, self.m_lastProbedTime, self.m_lastSentSourceTime, self.m_lastSentRepairTime)
@@ -1250,9 +1848,21 @@ class pepApp :
                 
 
     def Stop(self) :
-        # Free encoder and decoder
-        streamc.free_encoder(self.m_enc)
-        streamc.free_decoder(self.m_dec)
+        self.SavePathParameters()
+        self.HandleLog('INFO', "[CongestionStats] ", str(self.m_cc.m_stats), self.m_detailFlag)
+        self.HandleLog('INFO', "[Admission] ", str(self.m_admission), self.m_detailFlag)
+        self.HandleLog('INFO', "[Recovery] ", "flights lost as a whole: %d" % self.m_numRecoveries, self.m_detailFlag)
+        if self.m_enc is not None and not self.m_enc.RepairCapable :
+            self.HandleLog('INFO', "[Retransmit] ", "source packets retransmitted: %d" % self.m_numRetransmissions, self.m_detailFlag)
+
+        # Free encoder and decoder, once the decoder thread is done with it
+        if self.m_decoder is not None :
+            self.m_decoder.Stop()
+            self.m_dec.Free()
+        if self.m_repairThread is not None :
+            self.m_repairThread.Stop()
+            self.HandleLog('INFO', "[RepairThread] ", str(self.m_repairThread), self.m_detailFlag)
+            self.m_enc.Free()
         
         # Close channels
         for i in list(self.m_channels) :
@@ -1274,14 +1884,30 @@ if __name__ == "__main__" :
     parser.add_argument('--selfPort', required=True, type=int, help="Port for local PEPesc to bind")
     parser.add_argument('--peerIp', required=True, type=str, help="Peer PEPesc's ip")
     parser.add_argument('--peerPort', required=True, type=int, help="Peer PEPesc's port")
-    parser.add_argument('--bwEstMethod', required=False, type=str, default='Jersy', choices=['Jersy', 'BBR'], help="Select the bandwidth estimation algorithm, choices:Jersy, BBR(default:Jersy)")
+    parser.add_argument('--congestionControl', required=False, type=str, default=None, choices=list(CongestionControllers), help="Select the congestion controller, choices:%s(default:Jersey)" % ', '.join(CongestionControllers))
+    parser.add_argument('--bwEstMethod', required=False, type=str, default='Jersy', choices=['Jersy', 'BBR'], help="Deprecated, use --congestionControl instead")
+    parser.add_argument('--targetQueueDelay', required=False, type=float, default=None, help="Target standing queue delay(ms) of the Delay congestion controller, also reported against in the other modes, and the delay of the backlog of TCP data admitted into the encoder(default:%d)" % (DefaultTargetQueueDelay * 1000))
+    parser.add_argument('--deactivateDecoderThread', action='store_true', default=False, help="Decode in the I/O loop instead of a dedicated thread")
+    parser.add_argument('--codec', choices=Codecs, default=Codecs[0], help="Codec the peer is asked to decode the data packets of this entity with: gf256 streaming code, xor parity (cheaper repair packets, one loss per window), or null (no coded repair packet, only retransmissions when the peer stalls, to benchmark clean links)")
+    parser.add_argument('--codecBackend', choices=('auto',) + CodecBackends, default='auto', help="Implementation of the gf256 codec: libstreamc.so, or NumPy (same packets on the wire); auto: libstreamc.so if it loads")
+    parser.add_argument('--deactivateRepairThread', action='store_true', default=False, help="Encode repair packets when they are sent instead of ahead in a dedicated thread")
+    parser.add_argument('--decoderWindow', required=False, type=int, default=0, help="Source packets the peer PEPesc is asked to keep in its decoder, which bounds those in flight to %g of it; 0 for %d BDPs of the path. libstreamc.so keeps %d whatever is asked, i.e. at most %d packets in flight per RTT (about 95 Mbps at 600 ms RTT with 1500-byte MTU packets)(default:0)" % (DecoderWindowShare, DecoderWindowBdpGain, DEC_ALLOC, DEC_ALLOC * DecoderWindowShare))
+    parser.add_argument('--tunnelMtu', required=False, type=int, default=0, help="MTU (IP datagram bytes) of the path between the PEPesc entities, which sizes the data packets; 0 to probe it at handshake(default:0)")
     parser.add_argument('--deactivateProbeBw', action='store_true', default=False, help="Deactivate the active packet-train bandwidth probe")
+    parser.add_argument('--deactivateIngressAqm', action='store_true', default=False, help="Read every TCP flow within its share of the admitted data, without pausing those whose data sojourns too long in PEPesc")
+    parser.add_argument('--deactivateEcn', action='store_true', default=False, help="Do not mark tunnel packets ECN-capable nor react to CE marks")
+    parser.add_argument('--pathCache', required=False, type=str, default=PathCacheFile, help="File of the path parameters cached per peer PEPesc(default:%s)" % PathCacheFile)
+    parser.add_argument('--deactivatePathCache', action='store_true', default=False, help="Neither seed the estimators from the path cache nor save it")
+    parser.add_argument('--ackInterval', required=False, type=int, default=SourceAckInterval, help="Ask the peer PEPesc to ack every N data packets, raised by the peer for a slow return link(default:%d)" % SourceAckInterval)
+    parser.add_argument('--ackMaxDelay', required=False, type=float, default=DataAckMaxDelay*1000, help="Ask the peer PEPesc to ack at most T ms after receiving a data packet(default:%d)" % (DataAckMaxDelay*1000))
     parser.add_argument('--maxBw', required=False, default=None, type=BandwidthParameterUnit, help="Maximum allowable bandwidth(Mbps)")
     parser.add_argument('--ConstBw', required=False, default=None, type=BandwidthParameterUnit, help="Constant rate mode(Mbps)")
     parser.add_argument('-d', '--detail', action='store_true', default=False, help="Display the details")
     parser.add_argument('-l', '--logging', required=False, type=str, default=None, choices=['INFO', 'WARNING', 'ERROR', 'DEBUG'], help="Save the logs, choices:INFO, WARNING, ERROR, DEBUG(default:ERROR)")
     
     args = parser.parse_args()
+    if args.congestionControl is None :
+        args.congestionControl = 'BBR' if args.bwEstMethod == 'BBR' else 'Jersey'
     
     logLevel = logging.ERROR if not args.logging else getattr(logging, args.logging.upper())
     logging.basicConfig(filename='./pep.log',
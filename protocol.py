@@ -1,7 +1,8 @@
 import struct
 import pickle
+import socket
 
-from ctypes import c_ushort, c_ubyte, c_int, sizeof
+from ctypes import c_ushort, c_ubyte, c_int, c_double, sizeof
 
 # Control parameters of pepesc
 
@@ -15,7 +16,8 @@ PepHeaderLength = sizeof(c_ubyte) + sizeof(c_ushort)
 # including real data length, destination address and port
 TcpHeaderLength = 4 * sizeof(c_ushort) + 8 * sizeof(c_ubyte)
 
-# The maximum length of the source data that can be filled in the sc-udp package
+# The maximum length of the source data that can be filled in the sc-udp package (the symbol size),
+# that of a legacy peer. Otherwise the symbol size of each direction is agreed at handshake.
 MsgDataMaxLength = 1430
 
 # class SCPayload's packed length
@@ -24,11 +26,72 @@ SCPayloadPackedLength = TcpHeaderLength + MsgDataMaxLength
 # class parameters in pystreamc.py
 PacketSize = SCPayloadPackedLength
 
-# streamc function serialize_packet(): sourceid, repairid, win_s, win_e and syms. And scpacket header length.
-ScPacketSize = PacketSize + 4 * sizeof(c_int) + 3 #PepHeaderLength
-
-# UDP receive buffer size
-UdpBufSize = ScPacketSize
+# Sending timestamp appended to every sc-udp packet, echoed back in InorderACK for RTT sampling
+TimestampLength = sizeof(c_double)
+
+def ScPacketLength(msgDataLength) :
+    # streamc function serialize_packet(): sourceid, repairid, win_s, win_e and syms. And timestamp and scpacket header length.
+    return TcpHeaderLength + msgDataLength + 4 * sizeof(c_int) + TimestampLength + PepHeaderLength
+
+ScPacketSize = ScPacketLength(MsgDataMaxLength)
+
+# Packing format of InorderACK
+InorderAckFormat = 'i'*8 + 'ddd'
+
+# Packet ids and the counters of InorderACK are serial numbers of 31 bits on the wire (the sign bit leaves -1 for none),
+# both ends keep them unbounded and unwrap the ones received against the latest they know
+SeqSpace = 1 << 31
+
+def SeqWrap(seq) :
+    return seq % SeqSpace if seq >= 0 else seq
+
+def SeqUnwrap(wireSeq, reference) :
+    # The id congruent to wireSeq closest to reference, i.e. RFC 1982 serial number comparison; -1 stays -1
+    if wireSeq < 0 :
+        return wireSeq
+    return reference + (wireSeq - reference + SeqSpace // 2) % SeqSpace - SeqSpace // 2
+
+# libstreamc.so counts ids in C ints: every CodingEpochLength source packets, once all are acked, the encoder and
+# decoder are replaced by ones counting from the next ids (REBASE), retried every RebaseInterval until acked
+CodingEpochLength = 1 << 30
+RebaseInterval    = 0.2     # sec.
+
+# Decoder window: the source packets a decoder keeps, asked by the data sender at handshake (and at REBASE) for
+# DecoderWindowBdpGain BDPs of the path, or DEC_ALLOC without measurement. The NumPy and lightweight decoders take it
+# within MinDecoderWindow and MaxDecoderWindowBytes of payloads, libstreamc.so keeps DEC_ALLOC. The sender keeps
+# its source packets beyond the in-order one acked within DecoderWindowShare of it, so that the payloads not yet
+# handed to TCP by the peer are not overwritten.
+DecoderWindowBdpGain  = 4
+MinDecoderWindow      = 1024
+MaxDecoderWindowBytes = 1 << 30
+DecoderWindowShare    = 0.5
+
+# IPv4 and UDP headers of a tunnel datagram
+TunnelHeaderLength = 20 + 8
+
+def MsgDataLengthForMtu(mtu) :
+    # The largest symbol size whose data packets, with an InorderACK piggybacked, fit in IP datagrams of mtu bytes
+    return mtu - TunnelHeaderLength - ScPacketLength(0) - struct.calcsize(InorderAckFormat)
+
+# Path MTU discovery of the tunnel: before the handshake, the data sender sends one MTU_PROBE of each of these IP
+# datagram sizes (jumbo, FDDI, Ethernet, PPPoE, GRE, IPsec, IPv6 minimum) with DF set, and the receiver agrees on the
+# symbol size of the largest one it got, or of PmtuFallbackMtu if none came
+PmtuProbeMtus   = (9000, 8192, 4352, 1500, 1492, 1476, 1420, 1280)
+PmtuFallbackMtu = 1280
+MaxMsgDataLength = MsgDataLengthForMtu(max(PmtuProbeMtus))
+MinMsgDataLength = 256
+# Linux values, not exported by the socket module of every Python version
+IpMtuDiscover   = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IpPmtuDiscProbe = getattr(socket, 'IP_PMTUDISC_PROBE', 3)
+
+# UDP receive buffer size, large enough for an MTU probe, or a data packet of the largest symbol size carrying an InorderACK
+UdpBufSize = max(PmtuProbeMtus) - TunnelHeaderLength
+
+# Kernel receive timestamps (SO_TIMESTAMPNS, CLOCK_REALTIME) of tunnel datagrams, converted to the monotonic clock
+# by their age. A timestamp older than this (e.g. the wall clock jumped meanwhile) is replaced by the current time.
+SoTimestampNs       = getattr(socket, 'SO_TIMESTAMPNS', 35)    # Linux value, not exported by the socket module
+TimespecFormat      = 'll'
+KernelTimestampMaxAge = 1.0     # sec.
 
 # Time interval of doing handshake
 # If the peer PEPesc does not have any response before timeout, will be considered offline.
@@ -46,11 +109,76 @@ MaxHeartBeatTimes = 3
 # (ordered decoding delay is proportional to 1/repairExcess)
 ExtraRepairRate = 0.02
 
-# max length of PEPesc's buffer queue for enqueue packets
+# parameters of the Gilbert-Elliott loss model and the burst-aware repair scheduler
+DeliveryDelayPercentile = 0.99  # percentile of windows that must be recoverable within the repair window
+RepairWindowDelay       = 0.1   # sec., extra in-order delivery delay allowed at that percentile
+MinRepairWindowLength   = 16    # source packets
+MaxRepairWindowLength   = 256   # source packets
+MaxRepairsPerWindow     = 48
+LossModelUpdateInterval = 1.0   # sec.
+LossModelForgetFactor   = 0.999 # per observed packet
+
+# ECN codepoints in the TOS byte of tunnel datagrams (RFC 3168)
+EcnMask = 0x03
+EcnECT0 = 0x02
+EcnCE   = 0x03
+# weight of the latest per-RTT fraction of CE-marked packets in its moving average (as DCTCP's g)
+EcnGain = 1 / 16
+
+# parameters of random/congestive loss classification
+CongestionRttInflation  = 0.2   # queueing delay, relative to min RTT, above which losses may be congestive
+CongestionMinQueueDelay = 0.005 # sec., lower bound of the queueing delay threshold
+CongestionRateDrop      = 0.8   # delivery rate, relative to max bandwidth, below which losses may be congestive
+CongestionBackoffFactor = 0.85  # rate reduction on a congestive loss event
+MinCongestionRateFactor = 0.3
+CongestionRecoveryStep  = 0.05  # rate recovery per RTT without congestive loss
+
+# max length of PEPesc's buffer queue for enqueue packets, until the path is measured
 MaxBufferQueueLength = 100
 
-# interval of sending ACK for source packets
-SourceAckInterval = 1
+# Admission of TCP data into the encoder once the path is measured: the unsent backlog is what the source packet rate
+# sends within the target queue delay, within [AdmissionMinBacklog, AdmissionMaxBacklog] packets, and the source
+# packets enqueued but not acked in order are at most AdmissionBdpGain BDPs (of min RTT) beyond that backlog
+AdmissionMinBacklog = 8
+AdmissionMaxBacklog = 8192
+AdmissionBdpGain    = 3
+
+# CoDel (RFC 8289) on the ingress of each TCP flow, from reading a segment to sending its source packet: when the
+# sojourn time stays above IngressCodelTarget for IngressCodelInterval, reading the socket of the flow is paused, at
+# the pace of the CoDel control law, until its segments are sent. Flows with at most IngressCodelMinQueued segments
+# queued are sparse (interactive) and never paused.
+IngressCodelTarget    = 0.005   # sec.
+IngressCodelInterval  = 0.1     # sec.
+IngressCodelMinQueued = 2
+
+# TCP ingress reads up to TcpRecvChunkSize bytes at a time into preallocated buffers, at most TcpRecvPoolSize are kept for reuse
+TcpRecvChunkSize = 64 * 1024
+TcpRecvPoolSize  = 32
+# TCP egress gathers at most this many queued messages into one sendmsg() call
+TcpSendMaxIov    = 256
+# Max. number of received packets waiting for the decoder thread, the I/O loop blocks beyond it
+DecoderQueueLength = 4096
+# Repair packets encoded ahead of time: at most RepairCacheLength are cached, encoding starts RepairPrefetchLead
+# source packets before one is due, and a cached one is dropped once it misses or wastes more than RepairMaxLag
+RepairCacheLength  = 2
+RepairPrefetchLead = 2
+RepairMaxLag       = 4
+
+# Backlog of the TCP listener, and max. connections accepted from it in one loop
+TcpListenBacklog = 4096
+MaxAcceptBatch   = 256
+
+# ACK thinning: the receiver sends a data ACK every N packets or T sec. after the first unacked one,
+# whichever comes first. N and T are asked for by the data sender at handshake, then N is raised to keep
+# ACKs within AckReturnShare of the return link, but not above the number giving MinAcksPerRtt ACKs per RTT.
+SourceAckInterval = 4       # default N (pkts)
+DataAckMaxDelay   = 0.02    # default T (sec.)
+MaxAckInterval    = 16      # upper bound of N (pkts)
+MaxDataAckDelay   = 0.2     # upper bound of T (sec.)
+AckReturnShare    = 0.05
+MinAcksPerRtt     = 4
+# A due ACK waits this long for an outgoing data packet to ride on (SC_PROTECTED_ACK_PKT), if there is data to send
+PiggybackAckDelay = 0.002   # sec.
 
 # gain of updating cWnd by using max estimate bandwidth
 CwndGain = 1.0
@@ -58,14 +186,61 @@ CwndGain = 1.0
 # length of time that the estimate bandwidth sample survives in the maxBwFilter
 BwWindowPeriod = 60 # sec.
 
+# length of time that the RTT sample survives in the minRttFilter,
+# so that min RTT follows the propagation delay after a handover or route change
+MinRttWindowPeriod = 10 # sec.
+
+# parameters of ACK aggregation detection (bunched ACKs on DVB-S2/TDMA return links)
+AckAggregationThreshold = 2     # pkts acked by a run of compressed ACKs before they are treated as aggregated
+AckCompressionRatio     = 0.5   # an ACK interval below this ratio of the send interval of the acked packets is compressed
+AckAggregationSpan      = 2     # aggregation intervals spanned by a filtered bandwidth sample
+ExtraAckedWindowPeriod  = 10    # sec., length of time that the extra-acked sample survives in its max filter
+ExtraAckedMaxTime       = 0.1   # sec., cap of the extra-acked allowance in cWnd, in time at the max bandwidth
+
 # gain of pacing
 PacingGain = 10
 
+# parameters of the BBR congestion controller
+BBRStartupGain      = 2.885     # 2/ln(2)
+BBRDrainGain        = 1 / 2.885
+BBRCwndGain         = 2.0
+BBRPacingGainCycle  = [1.25, 0.75, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0]
+BBRBwWindowRounds   = 10        # round trips that a bandwidth sample survives in the max filter
+BBRMinRttWindow     = 10.0      # sec., min RTT is re-probed if not refreshed within this period
+BBRProbeRttDuration = 0.2       # sec.
+BBRMinCWnd          = 4         # pkts
+BBRFullBwThreshold  = 1.25      # bandwidth growth per round below which the pipe is considered full
+BBRFullBwRounds     = 3
+
+# parameters of the delay-target congestion controller and the per-mode statistics
+DefaultTargetQueueDelay = 0.05      # sec., standing queue delay (RTT - min RTT) to steer toward
+DelayGain               = 1.0       # cWnd growth (pkts per RTT) at zero queue delay
+DelayDecreaseRate       = 0.5       # max. fraction of cWnd given up per RTT when the queue is twice the target
+DelayFilterLength       = 4         # RTT samples of which the min. is taken as the current RTT
+DelayMinCWnd            = 4         # pkts
+QueueDelayHistogramBin    = 0.001   # sec.
+QueueDelayHistogramLength = 2000    # bins, larger queue delays fall into the last one
+
 # parameters of packet-train bandwidth estimation
 ProbeInterval    = 30 # sec.
-ProbePacketSize  = ScPacketSize
 ProbeTrainLength = 6
 
+# A full cWnd not acked within max(2 SRTT + 4 RTTVAR, MinRecoveryTimeout) is taken as lost as a whole
+MinRecoveryTimeout = 0.2    # sec.
+
+# parameters of in-band bandwidth estimation from the arrival dispersion of back-to-back data packets
+InbandPairInterval   = 16       # pkts, every such number of paced packets, the next one is sent at once as its pair
+InbandPairMaxSendGap = 0.0005   # sec., max. gap of sending timestamps for two packets to count as back-to-back
+InbandSampleCount    = 5        # latest pair dispersions of which the median is reported in ACKs
+DispersionGain       = 0.8      # bottleneck capacity from dispersion is discounted as the packet-train probe is
+
+# parameters of the on-disk cache of path parameters per peer PEPesc
+PathCacheFile        = './pep-path-cache.json'
+PathCacheLifetime    = 6 * 3600     # sec., older entries are not trusted any more
+PathCacheMaxRtt      = 5.0          # sec., entries beyond these bounds are invalid
+PathCacheMaxLossRate = 0.5
+PathCacheMismatch    = 0.5          # the cached bandwidth is dropped if the first probe finds less than this ratio of it
+
 # Message types
 PepPacketType = {
                 # PEPesc sender to receiver
@@ -74,6 +249,9 @@ PepPacketType = {
                 'HEARTBEAT'        : 2,     # Probe peer PEPesc survival status
                 'SC_PROTECTED_PKT' : 3,     # Send tcp flows' data
                 'PROBE'            : 4,     # probe channel's bandwidth and RTT
+                'SC_PROTECTED_ACK_PKT' : 5, # SC_PROTECTED_PKT carrying an InorderACK for the reverse direction
+                'MTU_PROBE'        : 6,     # Padded to an IP datagram size sent with DF, to probe the path MTU
+                'REBASE'           : 7,     # Start a coding epoch: ids the encoder counts from, decoder window
                 # PEPesc receiver to sender
                 'HANDSHAKE_ACK'    : 10,    # ACK for handshake
                 'HEARTBEAT_ACK'    : 11,    # ACK for heartbeat
@@ -81,6 +259,7 @@ PepPacketType = {
                 'PROBE_ACK'        : 13,    # ACK for probe packets
                 'ADVERTISE_BURST'  : 14,    # Report receive buffer overflow
                 'DECODE_SUCCESS'   : 15,    # Report that decoding is successful
+                'REBASE_ACK'       : 16,    # ACK for rebase, with the decoder window
 }
 
 ScProtectedMsg = {
@@ -138,10 +317,10 @@ class SCPayload() :
         self.msgData            = msgData               # class 'bytes'
         self.msgDataLength      = len(msgData)          # int type
     
-    def packed(self) :
+    def packed(self, msgDataMaxLength=MsgDataMaxLength) :
         tcpSourceIpv4Numbers = [int(i) for i in self.tcpSourceAddr[0].split('.')]
         tcpDestIpv4Numbers   = [int(i) for i in self.tcpDestinationAddr[0].split('.')]
-        filler = ' ' * (MsgDataMaxLength - len(self.msgData))
+        filler = ' ' * (msgDataMaxLength - len(self.msgData))
 
         # C Type: unsigned short
         payload =  struct.pack('H'*4, self.msg, self.msgDataLength, self.tcpSourceAddr[1], self.tcpDestinationAddr[1])
@@ -154,17 +333,17 @@ class SCPayload() :
         return payload
 
     def parse(self, payload) :
-        if len(payload) != SCPayloadPackedLength :
-            print("Error: payload length not equal to specify packing length, cannot parse.")
+        controlDatas = struct.unpack('H'*4+'B'*8, payload[0 : TcpHeaderLength])
+        if len(payload) < TcpHeaderLength + controlDatas[1] :
+            print("Error: payload shorter than its message data, cannot parse.")
             return
         
-        controlDatas = struct.unpack('H'*4+'B'*8, payload[0 : TcpHeaderLength])
         self.msg                = controlDatas[0]
         self.msgDataLength      = controlDatas[1]
         self.tcpSourceAddr      = ('.'.join([str(i) for i in controlDatas[4:8]]), controlDatas[2])
         self.tcpDestinationAddr = ('.'.join([str(i) for i in controlDatas[8:12]]), controlDatas[3])
 
-        self.msgData = payload[TcpHeaderLength : TcpHeaderLength+self.msgDataLength]
+        self.msgData = bytes(payload[TcpHeaderLength : TcpHeaderLength+self.msgDataLength])
 
 class PepPacket :
     def __init__(self, header = None, body = None) :
@@ -238,7 +417,7 @@ class PacketInfo :
         infoStr += ' firstSentTime: %d'    % self.firstSentTime
         infoStr += ' deliveredTime: %d'    % self.deliveredTime
         return infoStr
-    
+
 class InorderACK :
     """ACK is the information that the client feeds back to the sender in real time. 
     The server learns in real time to make decisions based on the status information of the client. 
@@ -249,9 +428,14 @@ class InorderACK :
         - number of repair packets;
         - type of the latest received packet;
         - id of the latest received SOURCE packet;
-        - id of the latest received REPAIR packet.
+        - id of the latest received REPAIR packet;
+        - number of CE-marked packets received;
+        - sending timestamp carried by the latest received packet;
+        - time between receiving the latest packet and sending this ACK;
+        - median arrival dispersion of recent back-to-back data packet pairs (-1 if no new pair).
     """
-    def __init__(self, ackId=0, inorder=-1, sourceNum=0, repairNum=0, latestRecvPktType=-1, latestRecvSourceId=-1, latestRecvRepairId=-1) :
+    def __init__(self, ackId=0, inorder=-1, sourceNum=0, repairNum=0, latestRecvPktType=-1, latestRecvSourceId=-1, latestRecvRepairId=-1, 
+                 echoTimestamp=-1.0, ackDelay=0.0, ceCount=0, dispersion=-1.0) :
         self.ackId    = ackId
         self.inorder  = inorder
         self.nsource  = sourceNum
@@ -259,12 +443,17 @@ class InorderACK :
         self.latestRecvPktType  = latestRecvPktType
         self.latestRecvSourceId = latestRecvSourceId
         self.latestRecvRepairId = latestRecvRepairId
+        self.ceCount            = ceCount
+        self.echoTimestamp      = echoTimestamp
+        self.ackDelay           = ackDelay
+        self.dispersion         = dispersion
             
     def packed(self) :
-        return struct.pack('i'*7, self.ackId, self.inorder, self.nsource, self.nrepair, self.latestRecvPktType, self.latestRecvSourceId, self.latestRecvRepairId)
+        return struct.pack(InorderAckFormat, SeqWrap(self.ackId), SeqWrap(self.inorder), SeqWrap(self.nsource), SeqWrap(self.nrepair), self.latestRecvPktType,
+                           SeqWrap(self.latestRecvSourceId), SeqWrap(self.latestRecvRepairId), SeqWrap(self.ceCount), self.echoTimestamp, self.ackDelay, self.dispersion)
         
     def parse(self, data) :
-        hdr = struct.unpack('i'*7, data)
+        hdr = struct.unpack(InorderAckFormat, data)
         self.ackId    = hdr[0]
         self.inorder  = hdr[1]
         self.nsource  = hdr[2]
@@ -272,9 +461,13 @@ class InorderACK :
         self.latestRecvPktType  = hdr[4]
         self.latestRecvSourceId = hdr[5]
         self.latestRecvRepairId = hdr[6]
+        self.ceCount            = hdr[7]
+        self.echoTimestamp      = hdr[8]
+        self.ackDelay           = hdr[9]
+        self.dispersion         = hdr[10]
 
     def getPackedSize(self) :
-        return len(struct.pack('i'*7, 1, 1, 1, 1, 1, 1, 1))
+        return struct.calcsize(InorderAckFormat)
         
     def __str__(self) :
         infoStr =  'ACK id: %d'     % (self.ackId) 
@@ -287,7 +480,9 @@ class InorderACK :
             infoStr += ' latestRecvPktType: REPAIR'
         infoStr += ' latestRecvSourceId: %d' % (self.latestRecvSourceId)
         infoStr += ' latestRecvRepairId: %d' % (self.latestRecvRepairId)
+        infoStr += ' ceCount: %d' % (self.ceCount)
+        infoStr += ' echoTimestamp: %f' % (self.echoTimestamp)
+        infoStr += ' ackDelay: %f' % (self.ackDelay)
+        infoStr += ' dispersion: %f' % (self.dispersion)
 
         return infoStr
-
-
@@ -1,5 +1,9 @@
 #This file wraps APIs from libstreamc.so in Python
-from ctypes import cdll, c_int, c_double, c_ubyte, c_ulong, Structure, POINTER
+import os
+import struct
+from ctypes import cdll, c_int, c_double, c_ubyte, c_ulong, c_void_p, Structure, POINTER, byref, cast, sizeof
+
+from protocol import SeqWrap, SeqUnwrap
 N = 624
 EWIN = 100
 DEC_ALLOC = 10000
@@ -59,77 +63,401 @@ class decoder(Structure):
                 ("prng"      , MT19937)]
 
 
-streamc = cdll.LoadLibrary("libstreamc.so")
-
-##########################
-# Wrap encoder functions #
-##########################
-
-streamc.initialize_encoder.argtypes = [POINTER(parameters), POINTER(c_ubyte), c_int]
-streamc.initialize_encoder.restype  = POINTER(encoder)
-
-streamc.enqueue_packet.argtypes = [POINTER(encoder), c_int, POINTER(c_ubyte)]
-streamc.enqueue_packet.restype  = c_int
-
-streamc.output_repair_packet.argtypes = [POINTER(encoder)]
-streamc.output_repair_packet.restype  = POINTER(packet)
-
-streamc.output_repair_packet_short.argtypes = [POINTER(encoder), c_int]
-streamc.output_repair_packet_short.restype  = POINTER(packet)
-
-streamc.output_source_packet.argtypes = [POINTER(encoder)]
-streamc.output_source_packet.restype  = POINTER(packet)
+# Prebuilt libraries, in one directory per Ubuntu release they are built on
+StreamcPrebuiltDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libstreamc')
 
-streamc.flush_acked_packets.argtypes = [POINTER(encoder), c_int]
-streamc.flush_acked_packets.restype  = None
 
-streamc.visualize_buffer.argtypes = [POINTER(encoder)]
-streamc.visualize_buffer.restype  = None
+def HostRelease() :
+    """ VERSION_ID of /etc/os-release, '' if unknown
+    """
+    try :
+        with open('/etc/os-release') as f :
+            for line in f :
+                if line.startswith('VERSION_ID=') :
+                    return line.split('=', 1)[1].strip().strip('"')
+    except OSError :
+        pass
+    return ''
 
-streamc.free_packet.argtypes = [POINTER(packet)]
-streamc.free_packet.restype  = None
 
-streamc.serialize_packet.argtypes = [POINTER(encoder), POINTER(packet)]
-streamc.serialize_packet.restype  = POINTER(c_ubyte)
+def LoadStreamc() :
+    """ Load libstreamc.so, trying in order: the file named by $STREAMC_LIBRARY, libstreamc.so on the
+        search path of the dynamic loader (e.g. LD_LIBRARY_PATH), the prebuilt library of the host
+        release, then the other prebuilt ones from the newest (one built against an older glibc
+        loads on a newer host, not the other way around)
+    """
+    candidates = []
+    if os.environ.get('STREAMC_LIBRARY') :
+        candidates.append(os.environ['STREAMC_LIBRARY'])
+    candidates.append('libstreamc.so')
+    if os.path.isdir(StreamcPrebuiltDir) :
+        releases = sorted(os.listdir(StreamcPrebuiltDir), reverse=True)
+        releases.sort(key=lambda release : release != HostRelease())
+        candidates += [os.path.join(StreamcPrebuiltDir, release, 'libstreamc.so') for release in releases]
 
-streamc.free_serialized_packet.argtypes = [POINTER(c_ubyte)]
-streamc.free_serialized_packet.restype  = None
+    errors = []
+    for path in candidates :
+        try :
+            return cdll.LoadLibrary(path), path
+        except OSError as e :
+            errors.append(str(e))
+    raise OSError("Cannot load libstreamc.so: " + '; '.join(errors))
 
-streamc.free_encoder.argtypes = [POINTER(encoder)]
-streamc.free_encoder.restype  = None
 
-##########################
-# Wrap decoder functions #
-##########################
+# Without the library, only the codec backend of npstreamc.py is available
+try :
+    streamc, StreamcLibraryPath = LoadStreamc()
+    StreamcLoadError = None
+except OSError as e :
+    streamc, StreamcLibraryPath = None, None
+    StreamcLoadError = str(e)
 
-streamc.initialize_decoder.argtypes = [POINTER(parameters)]
-streamc.initialize_decoder.restype  = POINTER(decoder)
+if streamc is not None :
+    ##########################
+    # Wrap encoder functions #
+    ##########################
 
-streamc.activate_decoder.argtypes = [POINTER(decoder), POINTER(packet)]
-streamc.activate_decoder.restype  = c_int
+    streamc.initialize_encoder.argtypes = [POINTER(parameters), POINTER(c_ubyte), c_int]
+    streamc.initialize_encoder.restype  = POINTER(encoder)
 
-streamc.deactivate_decoder.argtypes = [POINTER(decoder)]
-streamc.deactivate_decoder.restype  = c_int
+    streamc.enqueue_packet.argtypes = [POINTER(encoder), c_int, POINTER(c_ubyte)]
+    streamc.enqueue_packet.restype  = c_int
 
-streamc.receive_packet.argtypes = [POINTER(decoder), POINTER(packet)]
-streamc.receive_packet.restype  = c_int
+    streamc.output_repair_packet.argtypes = [POINTER(encoder)]
+    streamc.output_repair_packet.restype  = POINTER(packet)
 
-streamc.process_packet.argtypes = [POINTER(decoder), POINTER(packet)]
-streamc.process_packet.restype  = c_int
+    streamc.output_repair_packet_short.argtypes = [POINTER(encoder), c_int]
+    streamc.output_repair_packet_short.restype  = POINTER(packet)
 
-streamc.deserialize_packet.argtypes = [POINTER(decoder), POINTER(c_ubyte)]
-streamc.deserialize_packet.restype  = POINTER(packet)
+    streamc.output_source_packet.argtypes = [POINTER(encoder)]
+    streamc.output_source_packet.restype  = POINTER(packet)
 
-streamc.free_decoder.argtypes = [POINTER(decoder)]
-streamc.free_decoder.restype  = None
+    streamc.flush_acked_packets.argtypes = [POINTER(encoder), c_int]
+    streamc.flush_acked_packets.restype  = None
 
-#################################################
-# Wrap pseudo-random number generator functions #
-#################################################
+    streamc.visualize_buffer.argtypes = [POINTER(encoder)]
+    streamc.visualize_buffer.restype  = None
 
-#streamc.mt19937_init.argtypes = [c_ulong, c_ulong]
-#streamc.mt19937_init.restype  = None
+    streamc.free_packet.argtypes = [POINTER(packet)]
+    streamc.free_packet.restype  = None
 
-#streamc.mt19937_randint.argtypes = [POINTER(c_ulong) , POINTER(c_int)]
-#streamc.mt19937_randint.restype  = c_ulong
+    streamc.serialize_packet.argtypes = [POINTER(encoder), POINTER(packet)]
+    streamc.serialize_packet.restype  = POINTER(c_ubyte)
 
+    streamc.free_serialized_packet.argtypes = [POINTER(c_ubyte)]
+    streamc.free_serialized_packet.restype  = None
+
+    streamc.free_encoder.argtypes = [POINTER(encoder)]
+    streamc.free_encoder.restype  = None
+
+    ##########################
+    # Wrap decoder functions #
+    ##########################
+
+    streamc.initialize_decoder.argtypes = [POINTER(parameters)]
+    streamc.initialize_decoder.restype  = POINTER(decoder)
+
+    streamc.activate_decoder.argtypes = [POINTER(decoder), POINTER(packet)]
+    streamc.activate_decoder.restype  = c_int
+
+    streamc.deactivate_decoder.argtypes = [POINTER(decoder)]
+    streamc.deactivate_decoder.restype  = c_int
+
+    streamc.receive_packet.argtypes = [POINTER(decoder), POINTER(packet)]
+    streamc.receive_packet.restype  = c_int
+
+    streamc.process_packet.argtypes = [POINTER(decoder), POINTER(packet)]
+    streamc.process_packet.restype  = c_int
+
+    streamc.deserialize_packet.argtypes = [POINTER(decoder), POINTER(c_ubyte)]
+    streamc.deserialize_packet.restype  = POINTER(packet)
+
+    streamc.free_decoder.argtypes = [POINTER(decoder)]
+    streamc.free_decoder.restype  = None
+
+    #################################################
+    # Wrap pseudo-random number generator functions #
+    #################################################
+
+    #streamc.mt19937_init.argtypes = [c_ulong, c_ulong]
+    #streamc.mt19937_init.restype  = None
+
+    #streamc.mt19937_randint.argtypes = [POINTER(c_ulong) , POINTER(c_int)]
+    #streamc.mt19937_randint.restype  = c_ulong
+
+
+    ##################################
+    # Session API over the functions #
+    ##################################
+
+    # Prototypes of its own for the functions taking or returning buffers, as c_void_p: bytes and ctypes
+    # arrays are passed as they are and addresses come back as int, without a cast() per call
+    session_enqueue_packet = streamc['enqueue_packet']
+    session_enqueue_packet.argtypes = [POINTER(encoder), c_int, c_void_p]
+    session_enqueue_packet.restype  = c_int
+
+    session_serialize_packet = streamc['serialize_packet']
+    session_serialize_packet.argtypes = [POINTER(encoder), POINTER(packet)]
+    session_serialize_packet.restype  = c_void_p
+
+    session_free_serialized_packet = streamc['free_serialized_packet']
+    session_free_serialized_packet.argtypes = [c_void_p]
+    session_free_serialized_packet.restype  = None
+
+    session_deserialize_packet = streamc['deserialize_packet']
+    session_deserialize_packet.argtypes = [POINTER(decoder), c_void_p]
+    session_deserialize_packet.restype  = POINTER(packet)
+
+
+def BufferArgument(data, length) :
+    """ A bytes-like object of at least length bytes as a c_void_p argument. bytes and writable
+        buffers are passed without a copy, other read-only buffers are copied.
+    """
+    if not isinstance(data, bytes) :
+        view = memoryview(data)
+        data = (c_ubyte * view.nbytes).from_buffer(view) if not view.readonly else view.tobytes()
+    if len(data) < length :
+        raise ValueError("Buffer of %d bytes, %d expected" % (len(data), length))
+    return data
+
+
+# Header of a serialized packet: sourceid, repairid, win_s, win_e
+SerializedHeaderFormat = 'iiii'
+
+
+class SerializedPacket :
+    """ A coded packet output by an Encoder and serialized as serialize_packet() lays it out on the
+        wire. It owns C memory until Free(), View() is a memoryview over it and is only valid until then.
+        Ids counted by the encoder from sourceBase and repairBase are rewritten in place.
+    """
+    __slots__ = ('sourceId', 'repairId', 'winS', 'winE', 'm_data', 'm_view')
+
+    def __init__(self, enc, cpkt, arrayType, sourceBase=0, repairBase=0) :
+        pkt = cpkt.contents
+        self.sourceId = pkt.sourceid
+        self.repairId = pkt.repairid
+        self.winS     = pkt.win_s
+        self.winE     = pkt.win_e
+        self.m_data   = session_serialize_packet(enc, cpkt)
+        streamc.free_packet(cpkt)
+        self.m_view   = memoryview(arrayType.from_address(self.m_data))
+        if sourceBase or repairBase :
+            if self.sourceId != -1 :
+                self.sourceId += sourceBase
+            else :
+                self.repairId += repairBase
+                self.winS     += sourceBase
+                self.winE     += sourceBase
+            struct.pack_into(SerializedHeaderFormat, self.m_view, 0, SeqWrap(self.sourceId), SeqWrap(self.repairId),
+                             SeqWrap(self.winS), SeqWrap(self.winE))
+
+    def View(self) :
+        return self.m_view
+
+    def Free(self) :
+        if self.m_data is not None :
+            self.m_view.release()
+            session_free_serialized_packet(self.m_data)
+            self.m_data = None
+
+
+class Encoder :
+    """ A streamc encoder. The encoder struct is viewed once, its counters are read through
+        properties without building a ctypes proxy per access. The C encoder counts ids from 0 in
+        C ints, they are offset by the ids the encoder starts from, sourceBase and repairBase.
+    """
+    RepairCapable = True     # outputs coded repair packets, the encoder of the null codec only retransmits
+
+    def __init__(self, cp, sourceBase=0, repairBase=0) :
+        if streamc is None :
+            raise OSError(StreamcLoadError)
+        self.m_cp      = cp     # the C encoder keeps a pointer to it
+        self.m_pktsize = cp.pktsize
+        self.m_serializedType = c_ubyte * (cp.pktsize + 4 * sizeof(c_int))
+        self.m_ptr     = streamc.initialize_encoder(byref(cp), None, 0)
+        self.m_state   = self.m_ptr.contents
+        self.sourceBase = sourceBase
+        self.repairBase = repairBase
+
+    @property
+    def headsid(self) :
+        headsid = self.m_state.headsid
+        return headsid + self.sourceBase if headsid != -1 else -1
+
+    @property
+    def tailsid(self) :
+        tailsid = self.m_state.tailsid
+        return tailsid + self.sourceBase if tailsid != -1 else -1
+
+    @property
+    def nextsid(self) :
+        return self.m_state.nextsid + self.sourceBase
+
+    @property
+    def rcount(self) :
+        return self.m_state.rcount + self.repairBase
+
+    @rcount.setter
+    def rcount(self, value) :
+        self.m_state.rcount = value - self.repairBase
+
+    def Enqueue(self, sourceId, data) :
+        """ Append a source packet: a bytes-like object of pktsize bytes
+        """
+        return session_enqueue_packet(self.m_ptr, sourceId - self.sourceBase, BufferArgument(data, self.m_pktsize))
+
+    def OutputSource(self) :
+        """ The next source packet as a SerializedPacket, None if all are output
+        """
+        cpkt = streamc.output_source_packet(self.m_ptr)
+        return SerializedPacket(self.m_ptr, cpkt, self.m_serializedType, self.sourceBase, self.repairBase) if cpkt else None
+
+    def OutputRepair(self, windowLength=None) :
+        """ A repair packet over the last windowLength source packets output, or over all
+            unacknowledged ones, as a SerializedPacket
+        """
+        if windowLength is None :
+            cpkt = streamc.output_repair_packet(self.m_ptr)
+        else :
+            cpkt = streamc.output_repair_packet_short(self.m_ptr, windowLength)
+        return SerializedPacket(self.m_ptr, cpkt, self.m_serializedType, self.sourceBase, self.repairBase) if cpkt else None
+
+    def Flush(self, inorder) :
+        streamc.flush_acked_packets(self.m_ptr, max(inorder - self.sourceBase, -1))
+
+    def Free(self) :
+        if self.m_ptr is not None :
+            streamc.free_encoder(self.m_ptr)
+            self.m_ptr, self.m_state = None, None
+
+
+class Decoder :
+    """ A streamc decoder. The decoder struct and its table of recovered packets are viewed once,
+        recovered payloads are memoryviews over decoder memory. Its window is the table of DEC_ALLOC
+        packets compiled into libstreamc.so, any other capacity is refused. Ids are those of an Encoder counting
+        from sourceBase and repairBase: once they are offset, received ids are unwrapped, packets
+        of the epoch before are dropped, and the others handed to the C decoder with the ids it counts.
+    """
+    FixedCapacity = DEC_ALLOC
+
+    def __init__(self, cp, capacity=DEC_ALLOC, sourceBase=0, repairBase=0) :
+        if streamc is None :
+            raise OSError(StreamcLoadError)
+        if capacity != self.FixedCapacity :
+            raise ValueError("libstreamc.so keeps a decoder window of %d packets, %d requested" % (self.FixedCapacity, capacity))
+        self.m_cp      = cp     # the C decoder keeps a pointer to it
+        self.m_pktsize = cp.pktsize
+        self.m_payloadType = c_ubyte * cp.pktsize
+        self.m_serializedSize = cp.pktsize + 4 * sizeof(c_int)
+        self.m_ptr     = streamc.initialize_decoder(byref(cp))
+        self.m_state   = self.m_ptr.contents
+        self.m_recovered = cast(self.m_state.recovered, POINTER(c_void_p))
+        self.capacity   = DEC_ALLOC
+        self.sourceBase = sourceBase
+        self.repairBase = repairBase
+        self.m_maxRepairId = repairBase - 1
+
+    @property
+    def active(self) :
+        return self.m_state.active
+
+    @property
+    def inorder(self) :
+        return self.m_state.inorder + self.sourceBase
+
+    @property
+    def winS(self) :
+        return self.m_state.win_s + self.sourceBase
+
+    @property
+    def winE(self) :
+        return self.m_state.win_e + self.sourceBase
+
+    @property
+    def dof(self) :
+        return self.m_state.dof
+
+    def Receive(self, data) :
+        """ Deserialize a packet from a bytes-like object laid out by serialize_packet() and decode it,
+            return its (sourceid, repairid, win_s, win_e). The decoder keeps the deserialized packet.
+        """
+        if self.sourceBase or self.repairBase :
+            return self.ReceiveOffset(data)
+        rpkt = session_deserialize_packet(self.m_ptr, BufferArgument(data, self.m_serializedSize))
+        pkt = rpkt.contents
+        ids = (pkt.sourceid, pkt.repairid, pkt.win_s, pkt.win_e)
+        streamc.receive_packet(self.m_ptr, rpkt)
+        return ids
+
+    def ReceiveOffset(self, data) :
+        sourceId, repairId, winS, winE = struct.unpack_from(SerializedHeaderFormat, data)
+        inorder = self.inorder
+        if sourceId != -1 :
+            sourceId = SeqUnwrap(sourceId, inorder)
+            if sourceId <= inorder :
+                return sourceId, repairId, winS, winE
+            header = (sourceId - self.sourceBase, repairId, winS, winE)
+        else :
+            repairId = SeqUnwrap(repairId, self.m_maxRepairId)
+            winS, winE = SeqUnwrap(winS, inorder), SeqUnwrap(winE, inorder)
+            if winE <= inorder or winS < self.sourceBase :
+                return sourceId, repairId, winS, winE
+            self.m_maxRepairId = max(self.m_maxRepairId, repairId)
+            header = (-1, repairId - self.repairBase, winS - self.sourceBase, winE - self.sourceBase)
+        data = bytearray(data)
+        struct.pack_into(SerializedHeaderFormat, data, 0, *header)
+        rpkt = session_deserialize_packet(self.m_ptr, BufferArgument(data, self.m_serializedSize))
+        streamc.receive_packet(self.m_ptr, rpkt)
+        return sourceId, repairId, winS, winE
+
+    def Recovered(self, sourceId) :
+        """ memoryview over the payload of an in-order source packet, None if there is none. It is only
+            valid until the decoder reuses the slot DEC_ALLOC source packets later, or is freed.
+        """
+        address = self.m_recovered[(sourceId - self.sourceBase) % DEC_ALLOC]
+        if not address :
+            return None
+        return memoryview(self.m_payloadType.from_address(address))
+
+    def Free(self) :
+        if self.m_ptr is not None :
+            streamc.free_decoder(self.m_ptr)
+            self.m_ptr, self.m_state = None, None
+
+
+# Codec backends, as (encoder class, decoder class) factories: both put the same packets on the wire
+CodecBackends = ('streamc', 'numpy')
+
+
+def CodecBackend(name) :
+    """ Encoder and Decoder classes of a codec backend: 'streamc' wraps libstreamc.so, 'numpy'
+        is npstreamc.py (imported here, so that NumPy is only needed when it is chosen), 'auto'
+        is streamc if the library is loaded, numpy otherwise
+    """
+    if name == 'auto' :
+        name = 'streamc' if streamc is not None else 'numpy'
+    if name == 'streamc' :
+        return Encoder, Decoder
+    if name == 'numpy' :
+        import npstreamc
+        return npstreamc.Encoder, npstreamc.Decoder
+    raise ValueError("Unknown codec backend %s" % name)
+
+
+# Codecs a data sender may ask its peer to decode with at handshake, the first is the one of a peer which does not tell
+Codecs = ('gf256', 'xor', 'null')
+
+
+def Codec(name, backend='auto') :
+    """ Encoder and Decoder classes of a codec: 'gf256' is the streaming code of libstreamc, in the
+        implementation of the codec backend given; 'xor' (XOR parity) and 'null' (no coding) are
+        the lightweight codecs of xorstreamc.py
+    """
+    if name == 'gf256' :
+        return CodecBackend(backend)
+    import xorstreamc
+    if name == 'xor' :
+        return xorstreamc.XorEncoder, xorstreamc.XorDecoder
+    if name == 'null' :
+        return xorstreamc.NullEncoder, xorstreamc.XorDecoder
+    raise ValueError("Unknown codec %s" % name)
@@ -0,0 +1,123 @@
+import math
+import time
+import random
+import logging
+import threading
+
+from collections import deque
+
+from protocol    import RepairCacheLength, RepairMaxLag
+
+
+class RepairThread(threading.Thread) :
+    """ Encodes repair packets over the current encoder window in the background, so that sending
+        one in the pacing loop is a pop from a small cache of SerializedPackets: ctypes releases
+        the GIL during output_repair_packet(). The streamc Encoder is not thread-safe, every call
+        on it is made with m_lock held. Repair ids are drawn from the encoder when a packet is encoded, so
+        invalidated entries hand their ids back by rewinding rcount, and the peer never sees a gap.
+        As the encoder is locked while a packet is encoded, one is only encoded ahead in a gap of
+        the pacer, when it fits before the pacer next needs the encoder; otherwise the pacer
+        encodes it when due. With threaded=False nothing is encoded ahead and Pop() always misses.
+    """
+    def __init__(self, enc, threaded=True) :
+        threading.Thread.__init__(self, name='repair', daemon=True)
+        self.m_enc      = enc
+        self.m_threaded = threaded
+        self.m_lock     = threading.Lock()
+        self.m_wakeup   = threading.Event()
+        self.m_cache    = deque()
+        self.m_windowLength = 0
+        self.m_deadline = 0.0       # the pacer needs the encoder again
+        self.m_encodeTime = 0.0     # moving average of the time to encode a repair packet
+        self.m_running  = True
+
+        self.m_numEncoded = 0
+        self.m_numHits    = 0
+        self.m_numDropped = 0
+        self.m_numNoGap   = 0
+
+    def Encode(self, windowLength) :
+        """ Output the next repair packet, with m_lock held
+        """
+        return self.m_enc.OutputRepair(windowLength if random.uniform(0, 1) < 0.95 else None)
+
+    def Prefetch(self, windowLength, deadline=math.inf) :
+        """ A repair packet is due soon, encode it over a window of windowLength source packets
+            if that is done before deadline (time.monotonic()), when the pacer needs the encoder again
+        """
+        if not self.m_threaded :
+            return
+        self.m_windowLength = windowLength
+        self.m_deadline = deadline
+        if len(self.m_cache) < RepairCacheLength :
+            self.m_wakeup.set()
+
+    def run(self) :
+        while True :
+            self.m_wakeup.wait()
+            self.m_wakeup.clear()
+            if not self.m_running :
+                break
+            while self.m_running and len(self.m_cache) < RepairCacheLength :
+                if time.monotonic() + self.m_encodeTime > self.m_deadline :
+                    # the pacer would wait on the lock, it encodes the packet when due
+                    self.m_numNoGap += 1
+                    break
+                with self.m_lock :
+                    if self.m_enc.headsid >= self.m_enc.nextsid :
+                        # nothing sent and unacknowledged to protect
+                        break
+                    start = time.monotonic()
+                    packet = self.Encode(self.m_windowLength)
+                    if packet is None :
+                        break
+                    self.m_encodeTime += (time.monotonic() - start - self.m_encodeTime) / 8
+                    self.m_cache.append(packet)
+                    self.m_numEncoded += 1
+
+    def Pop(self) :
+        """ The oldest cached repair packet, None if there is none or it misses too many
+            recently sent source packets, with m_lock held
+        """
+        if not self.m_cache :
+            return None
+        if self.m_enc.nextsid - 1 - self.m_cache[0].winE > RepairMaxLag :
+            self.Invalidate()
+            return None
+        self.m_numHits += 1
+        return self.m_cache.popleft()
+
+    def NextRepairId(self) :
+        """ Id of the next repair packet to be sent, with m_lock held
+        """
+        return self.m_cache[0].repairId if self.m_cache else self.m_enc.rcount
+
+    def OnFlush(self) :
+        """ flush_acked_packets() moved the window, with m_lock held: drop the cache once it
+            spends more than RepairMaxLag packets of a window on what the peer has acknowledged
+        """
+        headsid = self.m_enc.headsid
+        if any(headsid - entry.winS > RepairMaxLag for entry in self.m_cache) :
+            self.Invalidate()
+
+    def Invalidate(self) :
+        if not self.m_cache :
+            return
+        self.m_enc.rcount = self.m_cache[0].repairId
+        self.m_numDropped += len(self.m_cache)
+        logging.debug("[RepairThread] Drop %d cached repair packets from %d" % (len(self.m_cache), self.m_cache[0].repairId))
+        for packet in self.m_cache :
+            packet.Free()
+        self.m_cache.clear()
+
+    def Stop(self) :
+        if self.m_threaded and self.is_alive() :
+            self.m_running = False
+            self.m_wakeup.set()
+            self.join()
+        with self.m_lock :
+            self.Invalidate()
+
+    def __str__(self) :
+        return "encoded ahead: %d sent from cache: %d dropped: %d no gap to encode in: %d encode time: %.1f us" \
+            % (self.m_numEncoded, self.m_numHits, self.m_numDropped, self.m_numNoGap, self.m_encodeTime * 1e6)
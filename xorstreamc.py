@@ -0,0 +1,254 @@
+#This file implements lightweight codecs with the interface of the pystreamc session API, in plain
+#Python: XOR parity over a sliding window, and no coding at all. They put packets on the wire in the
+#serialize_packet() layout, but are only understood by a peer decoding with the same codec.
+import struct
+
+from protocol import SeqWrap, SeqUnwrap
+from pystreamc import DEC_ALLOC
+
+SerializedHeaderFormat = 'iiii'     # sourceid, repairid, win_s, win_e
+SerializedHeaderLength = struct.calcsize(SerializedHeaderFormat)
+
+
+class SerializedPacket :
+    """ A coded packet serialized as serialize_packet() lays it out, with the interface of
+        pystreamc.SerializedPacket. Its memory is Python's, Free() only ends the View().
+    """
+    __slots__ = ('sourceId', 'repairId', 'winS', 'winE', 'm_data')
+
+    def __init__(self, sourceId, repairId, winS, winE, symbol) :
+        self.sourceId = sourceId
+        self.repairId = repairId
+        self.winS     = winS
+        self.winE     = winE
+        self.m_data   = struct.pack(SerializedHeaderFormat, SeqWrap(sourceId), SeqWrap(repairId), SeqWrap(winS), SeqWrap(winE)) + symbol
+
+    def View(self) :
+        return memoryview(self.m_data)
+
+    def Free(self) :
+        self.m_data = None
+
+
+class XorEncoder :
+    """ Sliding-window encoder whose repair packets are the XOR of the source packets in their
+        window, i.e. all coefficients are 1: a repair packet costs one big-integer XOR per source
+        packet, and recovers one loss in its window. Windows are chosen as by libstreamc; as XOR
+        repair packets over the same window repeat each other, repair packets asked again over
+        a window are encoded over its halves, then quarters and so on, so that while the window
+        stands still (e.g. waiting for the peer to decode), every loss ends up alone in the window
+        of some repair packet. Until then, two losses in the same windows stall the peer's
+        in-order point. Ids count from sourceBase and repairBase.
+    """
+    RepairCapable = True
+
+    def __init__(self, cp, sourceBase=0, repairBase=0) :
+        self.m_pktsize = cp.pktsize
+        self.m_symbols = {}     # source id -> (payload, payload as an integer)
+        self.count     = 0
+        self.sourceBase = sourceBase
+        self.repairBase = repairBase
+        self.nextsid   = sourceBase
+        self.rcount    = repairBase
+        self.headsid   = -1
+        self.tailsid   = -1
+        self.m_numSplits = {}       # window asked for -> repair packets over parts of it since
+
+    def Enqueue(self, sourceId, data) :
+        """ Append a source packet: a bytes-like object of pktsize bytes
+        """
+        data = bytes(data[:self.m_pktsize])
+        if self.headsid == -1 :
+            self.headsid = sourceId
+        self.tailsid = sourceId
+        self.m_symbols[sourceId] = (data, int.from_bytes(data, 'little'))
+        return 0
+
+    def OutputSource(self) :
+        """ The next source packet as a SerializedPacket, None if all are output
+        """
+        if self.headsid == -1 or self.nextsid > self.tailsid :
+            return None
+        packet = SerializedPacket(self.nextsid, -1, 0, 0, self.m_symbols[self.nextsid][0])
+        self.count   += 1
+        self.nextsid += 1
+        return packet
+
+    def OutputRepair(self, windowLength=None) :
+        """ A repair packet over the last windowLength source packets output, or over all
+            unacknowledged ones, as a SerializedPacket, None if no packet output is unacknowledged
+        """
+        if self.headsid == -1 or self.headsid >= self.nextsid :
+            return None
+        winS, winE = self.headsid, self.nextsid - 1
+        if windowLength is not None and winE - winS + 1 > windowLength :
+            # every other short window is at the front, where the peer waits for a loss to be recovered
+            if self.rcount % 2 :
+                winE = winS + windowLength - 1
+            else :
+                winS = winE - windowLength + 1
+        window = (winS, winE)
+        if window in self.m_numSplits :
+            self.m_numSplits[window] += 1
+            winS, winE = self.Split(winS, winE, self.m_numSplits[window])
+        else :
+            self.m_numSplits[window] = 0
+        parity = 0
+        for sourceId in range(winS, winE + 1) :
+            parity ^= self.m_symbols[sourceId][1]
+        packet = SerializedPacket(-1, self.rcount, winS, winE, parity.to_bytes(self.m_pktsize, 'little'))
+        self.count  += 1
+        self.rcount += 1
+        return packet
+
+    @staticmethod
+    def Split(winS, winE, k) :
+        """ The k-th part of a window split in halves, quarters and so on, breadth first
+            (k=1, 2 are the halves, 3 to 6 the quarters), from the whole window again past single packets
+        """
+        length = winE - winS + 1
+        k %= (1 << length.bit_length()) - 1
+        level = (k + 1).bit_length() - 1
+        i = k + 1 - (1 << level)
+        return winS + i * length // (1 << level), winS + (i + 1) * length // (1 << level) - 1
+
+    def Flush(self, inorder) :
+        if inorder < self.headsid :
+            return
+        for sourceId in range(self.headsid, min(inorder, self.tailsid) + 1) :
+            del self.m_symbols[sourceId]
+        if inorder >= self.tailsid :
+            self.headsid, self.tailsid = -1, -1
+        else :
+            self.headsid = inorder + 1
+        # windows are split while the head stands still only: over a moving head, the window asked
+        # for may repeat an earlier one at the other end, whose halves would only group losses
+        self.m_numSplits = {}
+
+    def Free(self) :
+        self.m_symbols = {}
+
+
+class NullEncoder(XorEncoder) :
+    """ Systematic packets only, no coded repair packet: the cost of the transport without coding.
+        Its only repair packet is the oldest unacknowledged source packet again (a window of one),
+        which the sender retransmits when the peer's in-order point stalls on a loss.
+    """
+    RepairCapable = False
+
+    def OutputRepair(self, windowLength=None) :
+        """ The oldest unacknowledged source packet as a repair packet over it alone,
+            None if no packet output is unacknowledged
+        """
+        if self.headsid == -1 or self.headsid >= self.nextsid :
+            return None
+        packet = SerializedPacket(-1, self.rcount, self.headsid, self.headsid, self.m_symbols[self.headsid][0])
+        self.count  += 1
+        self.rcount += 1
+        return packet
+
+
+class XorDecoder :
+    """ Decoder of XorEncoder (and NullEncoder) packets. A repair packet is reduced by the source
+        packets of its window already known and kept while more than one is missing, indexed by
+        each of its missing ids; whenever one becomes known, the repair packets waiting on it are
+        reduced in turn (peeling), and those left with one missing packet recover it. An id's
+        repair packets are dropped once it is known, i.e. before the in-order point passes it.
+        Received ids are unwrapped to those of an encoder counting from sourceBase and repairBase.
+    """
+    def __init__(self, cp, capacity=DEC_ALLOC, sourceBase=0, repairBase=0) :
+        self.m_pktsize   = cp.pktsize
+        self.capacity    = capacity
+        self.m_recovered = [None] * capacity     # payloads as integers
+        self.m_slotIds   = [-1] * capacity
+        self.m_pending   = {}       # missing source id -> [[set of missing source ids, parity over them]]
+        self.m_numPending = 0
+        self.sourceBase  = sourceBase
+        self.repairBase  = repairBase
+        self.m_maxSeen   = sourceBase - 1
+        self.m_maxRepairId = repairBase - 1
+        self.inorder     = sourceBase - 1
+
+    @property
+    def active(self) :
+        return 1 if self.m_maxSeen > self.inorder else 0
+
+    @property
+    def winS(self) :
+        return self.inorder + 1
+
+    @property
+    def winE(self) :
+        return self.m_maxSeen
+
+    @property
+    def dof(self) :
+        return self.m_numPending
+
+    def Known(self, sourceId) :
+        return self.m_slotIds[sourceId % self.capacity] == sourceId
+
+    def Receive(self, data) :
+        """ Decode a packet from a bytes-like object laid out by serialize_packet(),
+            return its (sourceid, repairid, win_s, win_e)
+        """
+        sourceId, repairId, winS, winE = struct.unpack_from(SerializedHeaderFormat, data)
+        symbol = int.from_bytes(data[SerializedHeaderLength : SerializedHeaderLength + self.m_pktsize], 'little')
+        if sourceId != -1 :
+            sourceId = SeqUnwrap(sourceId, self.inorder)
+            if sourceId > self.inorder and not self.Known(sourceId) :
+                self.m_maxSeen = max(self.m_maxSeen, sourceId)
+                self.Recover(sourceId, symbol)
+            return sourceId, repairId, winS, winE
+        repairId = SeqUnwrap(repairId, self.m_maxRepairId)
+        winS, winE = SeqUnwrap(winS, self.inorder), SeqUnwrap(winE, self.inorder)
+        if winE > self.inorder and winS > self.inorder - self.capacity and winS >= self.sourceBase :
+            self.m_maxSeen = max(self.m_maxSeen, winE)
+            self.m_maxRepairId = max(self.m_maxRepairId, repairId)
+            missing = set()
+            for i in range(winS, winE + 1) :
+                if self.Known(i) :
+                    symbol ^= self.m_recovered[i % self.capacity]
+                elif i <= self.inorder :
+                    # its slot was taken by a later packet, the repair packet is of no use
+                    return sourceId, repairId, winS, winE
+                else :
+                    missing.add(i)
+            if len(missing) == 1 :
+                self.Recover(missing.pop(), symbol)
+            elif missing :
+                equation = [missing, symbol]
+                for i in missing :
+                    self.m_pending.setdefault(i, []).append(equation)
+                self.m_numPending += 1
+        return sourceId, repairId, winS, winE
+
+    def Recover(self, sourceId, symbol) :
+        known = [(sourceId, symbol)]
+        while known :
+            sourceId, symbol = known.pop()
+            if self.Known(sourceId) :
+                continue
+            self.m_recovered[sourceId % self.capacity] = symbol
+            self.m_slotIds[sourceId % self.capacity] = sourceId
+            for equation in self.m_pending.pop(sourceId, []) :
+                missing = equation[0]
+                if sourceId not in missing :
+                    continue    # solved through another of its ids
+                missing.discard(sourceId)
+                equation[1] ^= symbol
+                if len(missing) == 1 :
+                    known.append((missing.pop(), equation[1]))
+                    self.m_numPending -= 1
+        while self.Known(self.inorder + 1) :
+            self.inorder += 1
+
+    def Recovered(self, sourceId) :
+        """ Payload (class 'bytes') of a received or decoded source packet, None if there is none
+        """
+        if not self.Known(sourceId) :
+            return None
+        return self.m_recovered[sourceId % self.capacity].to_bytes(self.m_pktsize, 'little')
+
+    def Free(self) :
+        self.m_recovered, self.m_pending = None, {}